@@ -1,18 +1,32 @@
 """ Core FastAPI logic
 """
 
-from fastapi import FastAPI,Request
+import os
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+from fastapi import FastAPI,APIRouter,Depends,Request,Response
+from fastapi.responses import JSONResponse,StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List
+from typing import List,Optional
 
-from utils.rpc_wrapper import tx_handler
-from utils.rate_limiter import rate_limiter
+from utils.chain_registry import chain_registry
+from utils.tracer import start_trace,finish_trace
+from utils.codec import fast_json_response,encode_response,decode_batch_body,dumps_json
+from utils.admission import PRIORITY_HIGH,PRIORITY_LOW,overloaded_error,start_admission,finish_admission,parse_deadline
+from utils.etag import start_versioning,finish_versioning,request_digest,make_etag,etag_matches
 
-tx_handler = tx_handler("./abis/")
-rate_limiter = rate_limiter(100)
+chains = chain_registry("./abis/")
+tx_handler = chains.default.handler # the default chain, served by the unprefixed routes
+stream_chunk_size = int(os.getenv('STREAM_CHUNK_SIZE','500')) # pairs per line of a streamed batch
+watchlist_refresh_interval = float(os.getenv('WATCHLIST_REFRESH_INTERVAL','1')) # seconds between watchlist refreshes
+admission_deadline_s = float(os.getenv('ADMISSION_DEADLINE_MS','5000'))/1000 # default time a request has to finish
+admission_max_deadline_s = float(os.getenv('ADMISSION_MAX_DEADLINE_MS','30000'))/1000 # max a client can ask for
 
 
-class DataV1(BaseModel):
+class DataV1(BaseModel): # batch bodies are parsed by utils.codec, the models document the schema
     base_assets: List[str]
     quote_assets: List[str]
 
@@ -21,97 +35,482 @@ class DataV2(BaseModel):
     quote_assets: List[str]
     bin_steps: List[int]
 
-app = FastAPI()
+class DataQuote(BaseModel):
+    base_asset: str
+    quote_asset: str
+    bin_step: int
+    amounts_in: List[int] = []
+    amounts_out: List[int] = []
+    bin_window: int = 50
 
+class DataDepthV1(BaseModel):
+    base_assets: List[str]
+    quote_assets: List[str]
+    min_liquidity_usd: float = 100
 
-@app.get("/")
-async def check_uptime():
-    """ Used to determine if endpoint is up
+class DataDepthV2(BaseModel):
+    base_assets: List[str]
+    quote_assets: List[str]
+    bin_steps: List[int]
+    bin_window: int = 5
+    min_liquidity_per_bin_usd: float = 10
+
+class DataTwap(BaseModel):
+    base_assets: List[str]
+    quote_assets: List[str]
+    bin_steps: List[int]
+    windows: List[int]
+
+class DataAlert(BaseModel):
+    version: str
+    base_asset: str
+    quote_asset: str
+    bin_step: Optional[int] = None
+    lower: Optional[float] = None
+    upper: Optional[float] = None
+    stream_token: Optional[str] = None
+    callback_url: Optional[str] = None
+
+
+def batch_body_schema(model):
+    """ OpenAPI request body for the batch endpoints, which read the raw body instead of a model
     """
-    return "yes"
+    schema = model.model_json_schema()
+    return {'requestBody':{'required':True,'content':{'application/json':{'schema':schema},
+                                                       'application/msgpack':{'schema':schema}}}}
 
+async def warm_up_until_ready(handler,max_backoff=30):
+    """ Retries warming up the handler until the RPC is reachable, backing off between attempts
+    """
+    backoff = 1
+    while not handler.ready:
+        try:
+            await run_in_threadpool(handler.warm_up)
+        except Exception: # e.g. RPC briefly unavailable
+            await asyncio.sleep(backoff)
+            backoff = min(backoff*2,max_backoff)
 
-@app.get("/v1/prices/{base_asset}/{quote_asset}")
-async def get_single_v1_price(base_asset:str,quote_asset:str):
-    """ Gets a single price per v1 pool, as defined by base_asset,quote_asset
+
+async def refresh_watchlist_forever(handler,interval):
+    """ Keeps the watched pools fresh, refreshing them in the background every interval (~ every block)
     """
-    try:
-        limit_str = rate_limiter.attempt_call()
-        if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
+    while True:
+        await asyncio.sleep(interval)
+        if not handler.ready:
+            continue
+        try:
+            await run_in_threadpool(handler.refresh_watchlist)
+        except Exception: # e.g. RPC briefly unavailable, the snapshot ages out & requests take the normal path
+            pass
 
-        return tx_handler.handle_v1_requests([base_asset],[quote_asset])
-    except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
 
+@asynccontextmanager
+async def lifespan(app):
+    """ Builds the contracts at startup & warms the caches in the background
+        -the worker accepts connections immediately, /ready reports when it should be sent traffic
+        -the watchlist refreshers run for the lifetime of the worker
+        -every chain is warmed & refreshed independently, so an unreachable RPC only affects its own chain
+    """
+    tasks = []
+    for chain in chains:
+        chain.handler.connect()
+        tasks.append(asyncio.create_task(warm_up_until_ready(chain.handler)))
+        tasks.append(asyncio.create_task(refresh_watchlist_forever(chain.handler,watchlist_refresh_interval)))
+    yield
+    for task in tasks:
+        task.cancel()
+    for chain in chains:
+        chain.handler.alert_delivery.shutdown()
+    chains.decoder.shutdown()
 
-@app.get("/v2/prices/{base_asset}/{quote_asset}/{bin_step}")
-async def get_single_v2_price(base_asset:str,quote_asset:str,bin_step:int):
-    """ Gets a single price per v2 pool, as defined by base_asset,quote_asset,bin_step
+
+app = FastAPI(lifespan=lifespan,default_response_class=fast_json_response)
+router = APIRouter() # chain specific endpoints, served unprefixed for the default chain & under /{chain}
+
+
+async def chain_path_param(chain:str):
+    """ Documents the chain prefix of the prefixed routes, unknown chains are rejected by request_chain
     """
-    try:
-        limit_str = rate_limiter.attempt_call()
-        if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
+    return chain
 
-        return tx_handler.handle_v2_requests([base_asset],[quote_asset],[bin_step])
-    except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
+
+def request_chain(request):
+    """ Returns the served chain of the request, from its route prefix (the default chain if unprefixed)
+        -None if the chain isn't served
+    """
+    return chains.get(request.path_params.get('chain'))
 
 
-@app.get("/v2_1/prices/{base_asset}/{quote_asset}/{bin_step}")
-async def get_single_v2_1_price(base_asset:str,quote_asset:str,bin_step:int):
-    """ Gets a single price per v2_1 pool, as defined by base_asset,quote_asset,bin_step
+def unknown_chain_response(request):
+    """ Response to a request for a chain which isn't served
+    """
+    return encode_response(request,{'status':'ERROR','output':"Chain '{}' isn't served.".format(
+                                    request.path_params.get('chain'))},status_code=404)
+
+
+def trace_requested(request):
+    """ Tracing is opted into per request, via the X-Trace header or the trace query param
+    """
+    flag = request.headers.get('x-trace',request.query_params.get('trace',''))
+    return flag.lower() in ('1','true','yes')
+
+
+def request_deadline(request):
+    """ Seconds the request has to finish, clients can lower/raise it with the X-Deadline-Ms header
+    """
+    return parse_deadline(request.headers.get('x-deadline-ms'),admission_deadline_s,admission_max_deadline_s)
+
+
+def overloaded_response(request,e):
+    """ Fast rejection of a request which wasn't admitted
+    """
+    return encode_response(request,{'status':'ERROR','output':str(e)},status_code=503,
+                           headers={'Retry-After':str(e.retry_after)})
+
+
+async def handle_request(request,method,*args,priority=PRIORITY_HIGH,conditional=False):
+    """ Shared endpoint logic: rate limiting, admission control, error handling & the optional cost breakdown
+        -method is the name of the tx_handler method, called on the handler of the request's chain
+        -the handler runs in the threadpool, so RPC calls don't block the event loop
+        -requests which aren't admitted in front of the RPC layer get a 503 with Retry-After
+        -conditional (price) requests get a block-based (weak) ETag, & a 304 if it matches If-None-Match
     """
+    chain = request_chain(request)
+    if chain is None:
+        return unknown_chain_response(request)
+    handler = getattr(chain.handler,method)
+
+    trace,token = start_trace() if trace_requested(request) else (None,None)
+    version,version_token = start_versioning() if conditional and trace is None else (None,None)
+    ticket,ticket_token = start_admission(priority,request_deadline(request))
     try:
-        limit_str = rate_limiter.attempt_call()
+        limit_str = chain.rate_limiter.attempt_call()
         if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
-
-        return tx_handler.handle_v2_1_requests([base_asset],[quote_asset],[bin_step])
+            response = {'status':'ERROR','output':limit_str}
+        else:
+            context = contextvars.copy_context() # carries the trace & admission ticket into the thread
+            response = await run_in_threadpool(context.run,handler,*args)
+    except overloaded_error as e:
+        return overloaded_response(request,e)
     except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
+        response = {'status':'ERROR','output':str(e)}
+    finally:
+        finish_admission(chain.handler.admission,ticket,ticket_token)
+        if version is not None:
+            finish_versioning(version_token)
+        if trace is not None:
+            trace_summary = finish_trace(trace,token)
 
+    if trace is not None:
+        response['trace'] = trace_summary
 
-@app.post("/v1/batch-prices")
-async def get_batch_v1_prices(data:DataV1):
-    """ Gets batch of prices for v1 pools, as defined by base_assets,quote_assets
+    headers = None
+    if version is not None and version.block_number is not None and response['status'] == 'SUCCESS':
+        digest = request_digest(request.method,request.url.path,request.query_params,
+                                request.headers.get('accept'),await request.body())
+        etag = make_etag(version.block_number,digest)
+        if etag_matches(request.headers.get('if-none-match'),etag): # client already has these prices
+            return Response(status_code=304,headers={'ETag':etag})
+        headers = {'ETag':etag}
+    return encode_response(request,response,headers=headers)
+
+
+def stream_requested(request):
+    """ Streaming is opted into per batch request, via Accept: application/x-ndjson or the stream query param
+    """
+    return ('application/x-ndjson' in request.headers.get('accept','') or
+            request.query_params.get('stream','').lower() in ('1','true','yes'))
+
+
+async def stream_request(request,method,*args):
+    """ Streams a batch back as newline-delimited json, one line per chunk of stream_chunk_size pairs
+        -lines are written as each chunk's multicalls finish, so memory & time to first result
+         don't grow with the size of the batch
+        -the stream is admitted (at low priority) before anything is written, & holds its slot until the
+         response ends, however it ends
     """
+    chain = request_chain(request)
+    if chain is None:
+        return unknown_chain_response(request)
+    handler = chain.handler
+
+    limit_str = chain.rate_limiter.attempt_call()
+    if limit_str != "":
+        return encode_response(request,{'status':'ERROR','output':limit_str})
+
+    if len(set(len(request_list) for request_list in args)) > 1: # fail before streaming anything
+        return encode_response(request,{'status':'ERROR','output':'Length of request lists needs to be equal.'})
+
+    ticket,_ = start_admission(PRIORITY_LOW,request_deadline(request))
     try:
-        limit_str = rate_limiter.attempt_call()
-        if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
+        await acquire_slot(handler.admission,ticket)
+    except overloaded_error as e:
+        return overloaded_response(request,e)
 
-        return tx_handler.handle_v1_requests(data.base_assets,data.quote_assets)
-    except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
+    def lines():
+        for result in handler.stream_requests(getattr(handler,method),stream_chunk_size,*args):
+            yield dumps_json(result)+b"\n"
 
+    # released by a background task, which runs once the response ends even if the client disconnected
+    # before the first line (a generator that never started doesn't run its finally when closed)
+    return StreamingResponse(lines(),media_type='application/x-ndjson',
+                             background=BackgroundTask(finish_admission,handler.admission,ticket))
 
-@app.post("/v2/batch-prices")
-async def get_batch_v2_prices(data:DataV2):
-    """ Gets batch of prices for v2 pools, as defined by base_assets,quote_assets,bin_steps
+
+async def acquire_slot(controller,ticket):
+    """ Waits for an admission slot in the threadpool, without leaking it if the request is cancelled meanwhile
+        -the acquire can't be interrupted, so if the request goes away first the slot is freed once it's taken
     """
+    acquiring = asyncio.ensure_future(run_in_threadpool(controller.acquire,ticket))
     try:
-        limit_str = rate_limiter.attempt_call()
-        if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(lambda future:future.cancelled() or future.exception() is not None or
+                                    finish_admission(controller,ticket))
+        raise
 
-        return tx_handler.handle_v2_requests(data.base_assets,data.quote_assets,data.bin_steps)
-    except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
 
+async def read_batch_body(request,with_bin_steps):
+    """ Parses the raw batch body, returns (base_assets,quote_assets,bin_steps) or an error response
+    """
+    try:
+        return decode_batch_body(await request.body(),request.headers.get('content-type'),with_bin_steps)
+    except ValueError as e:
+        return encode_response(request,{'status':'ERROR','output':str(e)},status_code=422)
 
-@app.post("/v2_1/batch-prices")
-async def get_batch_v2_1_prices(data:DataV2):
+
+@app.get("/")
+async def check_uptime():
+    """ Used to determine if endpoint is up
+    """
+    return "yes"
+
+
+@router.get("/ready")
+async def check_ready(request:Request):
+    """ Used to determine if the worker is warm & can take traffic, kept separate from the uptime check
+        -per chain, /ready is the default chain & /{chain}/ready any other
+    """
+    chain = request_chain(request)
+    if chain is None:
+        return unknown_chain_response(request)
+    if not chain.handler.ready:
+        return JSONResponse(status_code=503,content={'status':'ERROR','output':'Not ready.'})
+    return {'status':'SUCCESS','output':'ready'}
+
+
+@router.get("/v1/prices/{base_asset}/{quote_asset}")
+async def get_single_v1_price(request:Request,base_asset:str,quote_asset:str,
+                              max_age:float=None,max_blocks_behind:int=None):
+    """ Gets a single price per v1 pool, as defined by base_asset,quote_asset
+        -max_age/max_blocks_behind accept a cached price within those bounds, see README
+    """
+    return await handle_request(request,'handle_v1_requests',[base_asset],[quote_asset],
+                                max_age,max_blocks_behind,conditional=True)
+
+
+@router.get("/v2/prices/{base_asset}/{quote_asset}/{bin_step}")
+async def get_single_v2_price(request:Request,base_asset:str,quote_asset:str,bin_step:int,
+                                max_age:float=None,max_blocks_behind:int=None):
+    """ Gets a single price per v2 pool, as defined by base_asset,quote_asset,bin_step
+        -max_age/max_blocks_behind accept a cached price within those bounds, see README
+    """
+    return await handle_request(request,'handle_v2_requests',[base_asset],[quote_asset],[bin_step],
+                                max_age,max_blocks_behind,conditional=True)
+
+
+@router.get("/v2_1/prices/{base_asset}/{quote_asset}/{bin_step}")
+async def get_single_v2_1_price(request:Request,base_asset:str,quote_asset:str,bin_step:int,
+                                max_age:float=None,max_blocks_behind:int=None):
+    """ Gets a single price per v2_1 pool, as defined by base_asset,quote_asset,bin_step
+        -max_age/max_blocks_behind accept a cached price within those bounds, see README
+    """
+    return await handle_request(request,'handle_v2_1_requests',[base_asset],[quote_asset],[bin_step],
+                                max_age,max_blocks_behind,conditional=True)
+
+
+@router.post("/v1/batch-prices",openapi_extra=batch_body_schema(DataV1))
+async def get_batch_v1_prices(request:Request,max_age:float=None,max_blocks_behind:int=None):
+    """ Gets batch of prices for v1 pools, as defined by base_assets,quote_assets
+        -max_age/max_blocks_behind accept cached prices within those bounds, see README
+    """
+    data = await read_batch_body(request,with_bin_steps=False)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,_ = data
+    if stream_requested(request):
+        return await stream_request(request,'handle_v1_requests',base_assets,quote_assets)
+    return await handle_request(request,'handle_v1_requests',base_assets,quote_assets,
+                                max_age,max_blocks_behind,priority=PRIORITY_LOW,conditional=True)
+
+
+@router.post("/v2/batch-prices",openapi_extra=batch_body_schema(DataV2))
+async def get_batch_v2_prices(request:Request,max_age:float=None,max_blocks_behind:int=None):
+    """ Gets batch of prices for v2 pools, as defined by base_assets,quote_assets,bin_steps
+        -max_age/max_blocks_behind accept cached prices within those bounds, see README
+    """
+    data = await read_batch_body(request,with_bin_steps=True)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,bin_steps = data
+    if stream_requested(request):
+        return await stream_request(request,'handle_v2_requests',base_assets,quote_assets,bin_steps)
+    return await handle_request(request,'handle_v2_requests',base_assets,quote_assets,bin_steps,
+                                max_age,max_blocks_behind,priority=PRIORITY_LOW,conditional=True)
+
+
+@router.post("/v2_1/batch-prices",openapi_extra=batch_body_schema(DataV2))
+async def get_batch_v2_1_prices(request:Request,max_age:float=None,max_blocks_behind:int=None):
     """ Gets batch of prices for v2_1 pools, as defined by base_assets,quote_assets,bin_steps
+        -max_age/max_blocks_behind accept cached prices within those bounds, see README
     """
-    try:
-        limit_str = rate_limiter.attempt_call()
-        if limit_str != "":
-            return {'status':'ERROR','output':limit_str}
+    data = await read_batch_body(request,with_bin_steps=True)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,bin_steps = data
+    if stream_requested(request):
+        return await stream_request(request,'handle_v2_1_requests',base_assets,quote_assets,bin_steps)
+    return await handle_request(request,'handle_v2_1_requests',base_assets,quote_assets,bin_steps,
+                                max_age,max_blocks_behind,priority=PRIORITY_LOW,conditional=True)
 
-        return tx_handler.handle_v2_1_requests(data.base_assets,data.quote_assets,data.bin_steps)
-    except Exception as e: # will catch e.g. RPC errors
-        return {'status':'ERROR','output':str(e)}
+
+@router.post("/v1/batch-prices/changes",openapi_extra=batch_body_schema(DataV1))
+async def get_v1_price_changes(request:Request,since_block:int,max_age:float=None,max_blocks_behind:int=None):
+    """ Gets the prices of the v1 pools in the batch which changed after since_block, along with the head block
+    """
+    data = await read_batch_body(request,with_bin_steps=False)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,_ = data
+    return await handle_request(request,'handle_v1_price_changes',base_assets,quote_assets,since_block,
+                                max_age,max_blocks_behind,priority=PRIORITY_LOW)
+
+
+@router.post("/v2/batch-prices/changes",openapi_extra=batch_body_schema(DataV2))
+async def get_v2_price_changes(request:Request,since_block:int,max_age:float=None,max_blocks_behind:int=None):
+    """ Gets the prices of the v2 pools in the batch which changed after since_block, along with the head block
+    """
+    data = await read_batch_body(request,with_bin_steps=True)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,bin_steps = data
+    return await handle_request(request,'handle_v2_price_changes',base_assets,quote_assets,bin_steps,
+                                since_block,max_age,max_blocks_behind,priority=PRIORITY_LOW)
+
+
+@router.post("/v2_1/batch-prices/changes",openapi_extra=batch_body_schema(DataV2))
+async def get_v2_1_price_changes(request:Request,since_block:int,max_age:float=None,max_blocks_behind:int=None):
+    """ Gets the prices of the v2_1 pools in the batch which changed after since_block, along with the head block
+    """
+    data = await read_batch_body(request,with_bin_steps=True)
+    if not isinstance(data,tuple): # malformed body
+        return data
+    base_assets,quote_assets,bin_steps = data
+    return await handle_request(request,'handle_v2_1_price_changes',base_assets,quote_assets,bin_steps,
+                                since_block,max_age,max_blocks_behind,priority=PRIORITY_LOW)
+
+
+@router.post("/v2/quote")
+async def get_v2_quote(request:Request,data:DataQuote):
+    """ Quotes swaps of base_asset for quote_asset in a v2 pool, for any number of amounts in/out
+    """
+    return await handle_request(request,'handle_v2_quote_requests',data.base_asset,data.quote_asset,
+                                data.bin_step,data.amounts_in,data.amounts_out,data.bin_window)
+
+
+@router.post("/v2_1/quote")
+async def get_v2_1_quote(request:Request,data:DataQuote):
+    """ Quotes swaps of base_asset for quote_asset in a v2_1 pool, for any number of amounts in/out
+    """
+    return await handle_request(request,'handle_v2_1_quote_requests',data.base_asset,data.quote_asset,
+                                data.bin_step,data.amounts_in,data.amounts_out,data.bin_window)
+
+
+@router.post("/v1/depth")
+async def get_v1_depth(request:Request,data:DataDepthV1):
+    """ Gets the price & USD liquidity of v1 pools, with a client chosen liquidity threshold
+    """
+    return await handle_request(request,'handle_v1_depth_requests',data.base_assets,data.quote_assets,
+                                data.min_liquidity_usd,priority=PRIORITY_LOW)
+
+
+@router.post("/v2/depth")
+async def get_v2_depth(request:Request,data:DataDepthV2):
+    """ Gets the price & per-bin USD depth either side of the active bin of v2 pools
+    """
+    return await handle_request(request,'handle_v2_depth_requests',data.base_assets,data.quote_assets,
+                                data.bin_steps,data.bin_window,data.min_liquidity_per_bin_usd,priority=PRIORITY_LOW)
+
+
+@router.post("/v2_1/depth")
+async def get_v2_1_depth(request:Request,data:DataDepthV2):
+    """ Gets the price & per-bin USD depth either side of the active bin of v2_1 pools
+    """
+    return await handle_request(request,'handle_v2_1_depth_requests',data.base_assets,data.quote_assets,
+                                data.bin_steps,data.bin_window,data.min_liquidity_per_bin_usd,priority=PRIORITY_LOW)
+
+
+@router.post("/v2_1/twap")
+async def get_v2_1_twap(request:Request,data:DataTwap):
+    """ Gets time-weighted average prices of v2_1 pools over several windows, from the pools' oracles
+    """
+    return await handle_request(request,'handle_v2_1_twap_requests',data.base_assets,data.quote_assets,
+                                data.bin_steps,data.windows,priority=PRIORITY_LOW)
+
+
+@router.post("/alerts")
+async def register_alert(request:Request,data:DataAlert):
+    """ Registers an alert which fires once the price of a pool leaves [lower,upper]
+        -triggered alerts are pushed to a stream (see /alerts/stream) or posted to callback_url, stream alerts
+         return the stream's token, which further alerts can be added to the stream with
+    """
+    return await handle_request(request,'handle_alert_registration',data.version,data.base_asset,data.quote_asset,
+                                data.bin_step,data.lower,data.upper,data.stream_token,data.callback_url)
+
+
+@router.delete("/alerts/{alert_id}")
+async def remove_alert(request:Request,alert_id:int):
+    """ Removes an alert which hasn't fired yet
+    """
+    return await handle_request(request,'handle_alert_removal',alert_id)
+
+
+@router.get("/alerts/stream")
+async def stream_alerts(request:Request):
+    """ Streams the triggered alerts of a stream as newline-delimited json, for as long as the client is connected
+        -the stream's token (returned when registering its alerts) is sent in the X-Stream-Token header
+        -alerts triggered while no client was connected are written first, the stream ends once every
+         alert registered to it has fired & been written
+    """
+    chain = request_chain(request)
+    if chain is None:
+        return unknown_chain_response(request)
+
+    limit_str = chain.rate_limiter.attempt_call()
+    if limit_str != "":
+        return encode_response(request,{'status':'ERROR','output':limit_str})
+
+    stream_token = request.headers.get('x-stream-token','')
+    if not chain.handler.alert_delivery.has_stream(stream_token):
+        return encode_response(request,{'status':'ERROR','output':"No alert stream with this token."},status_code=404)
+
+    return StreamingResponse(chain.handler.alert_delivery.stream(stream_token),media_type='application/x-ndjson')
+
+
+@app.get("/chains")
+async def get_chains():
+    """ Lists the chains served, with the state of each chain's handler
+        -the first chain is the default, served by the unprefixed routes
+    """
+    output = []
+    for chain in chains:
+        handler = chain.handler
+        output.append({'name':chain.name,'default':chain is chains.default,'ready':handler.ready,
+                       'pools_cached':len(handler.pool_store),'watched_pools':len(handler.watchlist.watched_pools()),
+                       'alerts':len(handler.alerts),'in_flight':handler.admission.in_flight,'rejected':handler.admission.rejected,
+                       'rate_limit_per_min':chain.rate_limiter.max_calls_per_min})
+    return {'status':'SUCCESS','output':output}
 
 
+app.include_router(router) # default chain, registered first so its routes take precedence
+app.include_router(router,prefix="/{chain}",dependencies=[Depends(chain_path_param)])
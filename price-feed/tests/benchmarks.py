@@ -0,0 +1,286 @@
+""" Microbenchmarks for the pure compute parts of tx_handler, with regression gating against a stored baseline
+    -runs on synthetic multicall outputs & token lists, no RPC calls are made
+    -each benchmark is timed at batch sizes from 1 to 100k pairs, reporting ns/pair (fastest of repeats, the least noisy estimate)
+     & bytes allocated per pair (tracemalloc peak, measured in a separate run)
+    -exits with 1 if a benchmark is slower than the baseline by more than the time tolerance, or
+     allocates more than the allocation tolerance
+    -timings are machine specific, so no baseline is committed: the machine running the gate records one from
+     the base revision (--update-baseline) & then compares the change against it
+    -to tolerate noisy machines, the baseline timings are scaled by a calibration loop run alongside
+     the benchmarks, & regressions are re-measured before they fail the run
+"""
+
+# python benchmarks.py                      compare against benchmark_baseline.json
+# python benchmarks.py --update-baseline    record a new baseline
+# python benchmarks.py --baseline /tmp/base.json [--update-baseline]
+# python benchmarks.py --sizes 1,100 --only decode_active_ids
+
+import sys
+sys.path.append("../")
+import os
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+# the contracts are instantiated but never called
+os.environ.setdefault('RPC','http://127.0.0.1:8545')
+os.environ.setdefault('FACTORY_V1','0xaE4EC9901c3076D0DdBe76A520F9E90a6227aCB7')
+os.environ.setdefault('FACTORY_V2','0x1886D09C9Ade0c5DB822D85D21678Db67B6c2982')
+os.environ.setdefault('FACTORY_V2_1','0x8e42f2F4101563bF679975178e880FD87d3eFd4e')
+os.environ.setdefault('MULTICALL','0x842eC2c7D803033Edf55E478F461FC547Bc54EB2')
+
+from utils.rpc_wrapper import tx_handler
+from utils.parallel_decode import abi_decoder
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmark_baseline.json')
+SIZES = [1,10,100,1_000,10_000,100_000]
+ACTIVE_ID = 8388608 # bin id at which the LB price is 1
+BINS_PER_PAIR = 10 # bins checked by the v2/v2_1 liquidity check
+
+
+def build_handler():
+    """ Handler with the core token prices cached indefinitely, so the liquidity checks make no RPC calls
+    """
+    handler = tx_handler("../abis/")
+    handler.connect()
+    prices = {token:{'price':2000.0 if info['name']=='wETH' else 1.0,'token_precision':info['token_precision']}
+              for token,info in handler.chainlink_info.items()}
+    handler.core_prices_cache = (float('inf'),prices)
+    handler.valuation_graph.ttl = float('inf') # routes are only rebuilt once, rather than at random points in a run
+    return handler
+
+
+def word(value):
+    """ 32 byte ABI word of an unsigned integer
+    """
+    return value.to_bytes(32,'big')
+
+
+class synthetic_batch:
+    """ Inputs & multicall outputs of a batch of n pairs, half of which include a core token
+    """
+    def __init__(self,handler,n,seed=0):
+        """ Init
+        """
+        rng = random.Random(seed)
+        core = list(handler.chainlink_info)
+        others = ['0x'+format(rng.getrandbits(160),'040x') for _ in range(1000)] # tokens repeat, as in real traffic
+
+        self.base_assets,self.quote_assets = [],[]
+        for i in range(n):
+            base = rng.choice(core) if i%2 == 0 else rng.choice(others)
+            quote = rng.choice(others)
+            self.base_assets.append(base)
+            self.quote_assets.append(quote)
+        self.bin_steps = [rng.choice([1,5,10,15,20,25]) for _ in range(n)]
+
+        self.base_tokens,self.quote_tokens = handler.check_valid_inputs(self.base_assets,self.quote_assets)
+        self.pair_addresses = ['0x'+format(rng.getrandbits(160),'040x') for _ in range(n)]
+        self.active_ids = [ACTIVE_ID+rng.randint(-5000,5000) for _ in range(n)]
+        self.reserves = [(rng.getrandbits(80)+1,rng.getrandbits(80)+1) for _ in range(n)]
+        self.prices = handler.return_v1_prices(self.base_tokens,self.quote_tokens,self.reserves)
+        self.bin_reserves = [[(rng.getrandbits(70),rng.getrandbits(70)) for _ in range(BINS_PER_PAIR)]
+                             for _ in range(min(n,1000))] # reused across pairs, to bound memory
+
+        # return data of each multicall, as the RPC would send it
+        self.pair_address_outputs = [word(15)+bytes(12)+bytes.fromhex(address[2:])+word(1)+word(0)
+                                     for address in self.pair_addresses] # getLBPairInformation
+        self.active_id_outputs = [word(reserve_x)+word(reserve_y)+word(active_id) # getReservesAndId
+                                  for (reserve_x,reserve_y),active_id in zip(self.reserves,self.active_ids)]
+        self.bin_outputs = [word(reserve_x)+word(reserve_y) # getBin, the same bins for every pair
+                            for reserve_x,reserve_y in self.bin_reserves[0]]*n
+        self.usd_rates = handler.gather_usd_rates()
+
+
+def bench_check_valid_inputs(handler,batch):
+    handler.check_valid_inputs(batch.base_assets,batch.quote_assets)
+
+def bench_calculate_lb_pool_price(handler,batch):
+    for active_id,bin_step in zip(batch.active_ids,batch.bin_steps):
+        handler.calculate_lb_pool_price(active_id,bin_step)
+
+def bench_return_v2_and_v2_1_prices(handler,batch):
+    handler.return_v2_and_v2_1_prices(batch.base_tokens,batch.quote_tokens,batch.bin_steps,batch.active_ids)
+
+def bench_return_v1_prices(handler,batch):
+    handler.return_v1_prices(batch.base_tokens,batch.quote_tokens,batch.reserves)
+
+def bench_convert_bin_reserves_to_price(handler,batch):
+    for i in range(len(batch.base_tokens)):
+        if batch.base_tokens[i].value in batch.usd_rates or batch.quote_tokens[i].value in batch.usd_rates:
+            handler.convert_bin_reserves_to_price(batch.base_tokens[i],batch.quote_tokens[i],batch.prices[i],
+                                                  batch.bin_reserves[i%len(batch.bin_reserves)],batch.usd_rates,10)
+
+def bench_check_v1_liquidity(handler,batch):
+    handler.check_v1_liquidity(batch.base_tokens,batch.quote_tokens,batch.reserves,list(batch.prices),
+                               batch.pair_addresses)
+
+def bench_decode_pair_addresses(handler,batch):
+    handler.decoder.decode(batch.pair_address_outputs,((1,'address'),))
+
+def bench_decode_active_ids(handler,batch):
+    handler.decoder.decode(batch.active_id_outputs,((2,'uint'),))
+
+def bench_decode_bin_reserves(handler,batch):
+    handler.decoder.decode(batch.bin_outputs,((0,'uint'),(1,'uint')))
+
+# the same decode across the process pool at every size, workers as configured for the server (or 1 per cpu)
+parallel_decoder = abi_decoder(workers=int(os.getenv('PARALLEL_DECODE_WORKERS','0')) or os.cpu_count() or 1,
+                               min_parallel_items=0)
+
+def bench_parallel_decode_bin_reserves(handler,batch):
+    parallel_decoder.decode(batch.bin_outputs,((0,'uint'),(1,'uint')))
+
+
+BENCHMARKS = {
+    'check_valid_inputs':bench_check_valid_inputs,
+    'calculate_lb_pool_price':bench_calculate_lb_pool_price,
+    'return_v2_and_v2_1_prices':bench_return_v2_and_v2_1_prices,
+    'return_v1_prices':bench_return_v1_prices,
+    'convert_bin_reserves_to_price':bench_convert_bin_reserves_to_price,
+    'check_v1_liquidity':bench_check_v1_liquidity,
+    'decode_pair_addresses':bench_decode_pair_addresses,
+    'decode_active_ids':bench_decode_active_ids,
+    'decode_bin_reserves':bench_decode_bin_reserves, # BINS_PER_PAIR bins per pair
+    'parallel_decode_bin_reserves':bench_parallel_decode_bin_reserves,
+}
+
+
+def measure(function,handler,batch,pairs,min_repeats=5,min_time=0.2):
+    """ Returns (ns/pair,bytes allocated/pair) of a benchmark
+        -time is the fastest of at least min_repeats runs, repeated until min_time seconds have passed
+        -like timeit, the garbage collector is paused while timing, as its pauses depend on the whole heap
+    """
+    function(handler,batch) # warm up (e.g. interning, valuation graph)
+
+    timings = []
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        while len(timings) < min_repeats or time.perf_counter()-started < min_time:
+            start = time.perf_counter_ns()
+            function(handler,batch)
+            timings.append(time.perf_counter_ns()-start)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    function(handler,batch)
+    _,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings)/pairs,peak/pairs
+
+
+def calibrate(repeats=5):
+    """ Returns the ns taken by a fixed pure python workload, which measures the current speed of the machine
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        values = {}
+        for i in range(100_000):
+            values[i%1000] = values.get(i%1000,0)+i*3//7
+        timings.append(time.perf_counter_ns()-start)
+    return min(timings)
+
+
+def run_benchmarks(sizes,only=None,verbose=True):
+    """ Runs every benchmark at every size, returns {name:{size:{'ns_per_pair','bytes_per_pair'}}}
+    """
+    handler = build_handler()
+    results = {}
+    for size in sizes:
+        batch = synthetic_batch(handler,size)
+        for name,function in BENCHMARKS.items():
+            if only is not None and name not in only:
+                continue
+            ns_per_pair,bytes_per_pair = measure(function,handler,batch,size)
+            results.setdefault(name,{})[str(size)] = {'ns_per_pair':round(ns_per_pair,1),
+                                                      'bytes_per_pair':round(bytes_per_pair,1)}
+            if verbose:
+                print("{:<32}{:>8}{:>14.1f} ns/pair{:>12.1f} B/pair".format(name,size,ns_per_pair,bytes_per_pair))
+    return results
+
+
+def compare_to_baseline(results,baseline,speed,time_tolerance,alloc_tolerance,time_slack=500,alloc_slack=64):
+    """ Returns a list of (name,size,description) of results that are slower or allocate more than the baseline allows
+        -speed is the calibration time now relative to when the baseline was recorded, baseline timings are scaled by it
+        -time_slack (ns per call) & alloc_slack (bytes/pair) absorb the noise & fixed costs which dominate tiny batches
+    """
+    regressions = []
+    for name,sizes in results.items():
+        for size,result in sizes.items():
+            expected = baseline.get(name,{}).get(size)
+            if expected is None: # new benchmark or size
+                continue
+            expected_ns = expected['ns_per_pair']*speed
+            if result['ns_per_pair'] > expected_ns*(1+time_tolerance)+time_slack/int(size):
+                regressions.append((name,size,"{} @ {}: {} ns/pair vs baseline {:.1f} (scaled)".format(
+                                    name,size,result['ns_per_pair'],expected_ns)))
+            if result['bytes_per_pair'] > expected['bytes_per_pair']*(1+alloc_tolerance)+alloc_slack:
+                regressions.append((name,size,"{} @ {}: {} B/pair vs baseline {}".format(
+                                    name,size,result['bytes_per_pair'],expected['bytes_per_pair'])))
+    return regressions
+
+
+def machine():
+    """ Description of the machine the benchmarks ran on, stored with the baseline
+    """
+    return {'python':platform.python_version(),'machine':platform.machine(),'processor':platform.processor(),
+            'cpus':os.cpu_count()}
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--update-baseline',action='store_true',help="record the results as the new baseline")
+    parser.add_argument('--baseline',default=BASELINE_PATH,help="path of the baseline file")
+    parser.add_argument('--sizes',default=','.join(str(size) for size in SIZES),help="comma separated batch sizes")
+    parser.add_argument('--only',default=None,help="comma separated benchmark names")
+    parser.add_argument('--time-tolerance',type=float,default=0.25,help="allowed slowdown, as a fraction")
+    parser.add_argument('--alloc-tolerance',type=float,default=0.1,help="allowed extra allocation, as a fraction")
+    parser.add_argument('--retries',type=int,default=2,help="times a regression is re-measured before failing")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    calibration_ns = calibrate()
+    results = run_benchmarks(sizes,args.only.split(',') if args.only else None)
+    calibration_ns = min(calibration_ns,calibrate()) # machine speed over the run
+
+    if args.update_baseline:
+        with open(args.baseline,'w') as f:
+            json.dump({'machine':machine(),'calibration_ns':calibration_ns,'results':results},f,indent=1,sort_keys=True)
+        print("-baseline written to",args.baseline)
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print("-no baseline, run with --update-baseline on the base revision first")
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['machine'] != machine():
+        print("-warning: baseline was recorded on a different machine",baseline['machine'])
+
+    speed = calibration_ns/baseline['calibration_ns']
+    regressions = compare_to_baseline(results,baseline['results'],speed,args.time_tolerance,args.alloc_tolerance)
+    for _ in range(args.retries): # re-measure, keeping the best result, so a noisy moment doesn't fail the run
+        if len(regressions) == 0:
+            break
+        for name,size,_ in regressions:
+            retried = run_benchmarks([int(size)],[name],verbose=False)[name][size]
+            best = results[name][size]
+            results[name][size] = {key:min(best[key],retried[key]) for key in best}
+        speed = min(calibration_ns,calibrate())/baseline['calibration_ns']
+        regressions = compare_to_baseline(results,baseline['results'],speed,args.time_tolerance,args.alloc_tolerance)
+
+    print("-------------------------------------")
+    print("-machine speed vs baseline: {:.2f}x time".format(speed))
+    for _,_,regression in regressions:
+        print("-regression:",regression)
+    print("-{} regressions".format(len(regressions)))
+    sys.exit(1 if len(regressions) > 0 else 0)
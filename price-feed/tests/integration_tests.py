@@ -4,6 +4,8 @@
 import sys
 sys.path.append("../")
 import json
+import time
+import msgpack
 import unittest
 from fastapi.testclient import TestClient
 
@@ -28,6 +30,20 @@ class TestTxHandler(unittest.TestCase):
         self.assertEqual(response.json(),"yes")
 
 
+    def test_ready_after_warm_up(self):
+        """ Checks that /ready reports ready once the lifespan startup has warmed the handler
+        """
+        with TestClient(app) as lifespan_client: # runs the lifespan startup
+            for _ in range(20):
+                resp = lifespan_client.get("/ready")
+                if resp.status_code == 200:
+                    break
+                time.sleep(0.5)
+
+        self.assertEqual(resp.status_code,200)
+        self.assertEqual(resp.json()['status'],'SUCCESS')
+
+
     def test_invalid_endpoint_used(self):
         """ Testing that 404 is returned when trying to used an invalid endpoint
         """
@@ -266,6 +282,163 @@ class TestTxHandler(unittest.TestCase):
         self.assertTrue(rpc_out['output'][1] != -1)
 
 
+    def test_trace_breakdown_returned(self):
+        """ Test that a traced request returns its cost breakdown, and an untraced one doesn't
+        """
+        resp = client.get("/v2/prices/{}/{}/{}".format(usdc_e,weth,15),headers={'X-Trace':'true'})
+
+        self.assertEqual(resp.status_code,200)
+
+        rpc_out = resp.json()
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertTrue(rpc_out['trace']['rpc_round_trips'] > 0)
+        self.assertTrue(rpc_out['trace']['multicall_sub_calls'] >= rpc_out['trace']['rpc_round_trips'])
+        self.assertTrue(rpc_out['trace']['block_number'] > 0)
+        self.assertTrue('check_liquidity' in rpc_out['trace']['stages_ms'])
+
+        resp = client.get("/v2/prices/{}/{}/{}".format(usdc_e,weth,15))
+        self.assertTrue('trace' not in resp.json())
+
+
+    def test_bin_prefetch_fused_with_state(self):
+        """ Test that once a pool's active id is known, its bins are read along with its state, so the liquidity
+            check doesn't need its own round trip unless the active id moved
+        """
+        client.get("/v2/prices/{}/{}/{}".format(weth,usdc_e,15)) # learns the active id
+        resp = client.get("/v2/prices/{}/{}/{}".format(weth,usdc_e,15),headers={'X-Trace':'true'})
+        rpc_out = resp.json()
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        trace = rpc_out['trace']
+        if trace['rpc_round_trips'] > 0: # not served from the watchlist
+            prefetch = trace['cache']['bin_prefetch']
+            self.assertEqual(prefetch['hit']+prefetch['miss'],1)
+            self.assertEqual('gather_bin_reserves' in trace['stages_ms'],prefetch['miss']==1)
+
+
+    def test_stale_while_revalidate(self):
+        """ Test that a request accepting stale prices is answered from the cache, with the age of the price
+        """
+        fresh = client.get("/v2_1/prices/{}/{}/{}".format(usdc_e,weth,15)).json()
+        self.assertTrue('age' not in fresh)
+
+        resp = client.get("/v2_1/prices/{}/{}/{}?max_age=60".format(weth,usdc_e,15),headers={'X-Trace':'true'})
+        rpc_out = resp.json()
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertTrue(perc_diff(rpc_out['output'][0]**-1,fresh['output'][0])<0.01)
+        self.assertTrue(0 <= rpc_out['age'] <= 60)
+        self.assertTrue(rpc_out['block_number'] > 0)
+        self.assertEqual(rpc_out['trace']['rpc_round_trips'],0)
+
+        resp = client.get("/v2_1/prices/{}/{}/{}?max_age=-1".format(weth,usdc_e,15))
+        self.assertEqual(resp.json()['status'],'ERROR')
+
+
+    def test_etag_not_modified(self):
+        """ Test that a price response carries an ETag, and that sending it back returns 304 while the price is unchanged
+        """
+        resp = client.get("/v2_1/prices/{}/{}/{}?max_age=60".format(usdc_e,weth,15))
+        self.assertEqual(resp.status_code,200)
+        etag = resp.headers['etag']
+        self.assertTrue(etag.startswith('W/"')) # the body's age & block_number can differ for the same prices
+
+        resp = client.get("/v2_1/prices/{}/{}/{}?max_age=60".format(usdc_e,weth,15),headers={'If-None-Match':etag})
+        self.assertEqual(resp.status_code,304)
+        self.assertEqual(resp.content,b'')
+
+        resp = client.get("/v2_1/prices/{}/{}/{}?max_age=60".format(usdc_e,weth,15),headers={'If-None-Match':etag[2:]})
+        self.assertEqual(resp.status_code,304) # If-None-Match uses the weak comparison
+
+        resp = client.get("/v2_1/prices/{}/{}/{}".format(weth,usdc_e,15),headers={'If-None-Match':etag})
+        self.assertEqual(resp.status_code,200) # different request, different ETag
+
+
+    def test_price_changes_since_block(self):
+        """ Test that a first poll returns the whole watched set, and a poll from the returned head block only what changed
+        """
+        body = {'base_assets':[usdc_e,weth],'quote_assets':[weth,usdc_e],'bin_steps':[15,15]}
+        rpc_out = client.post("/v2_1/batch-prices/changes?since_block=0",json=body).json()
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertTrue(rpc_out['output']['full'])
+        self.assertEqual(rpc_out['output']['indexes'],[0,1])
+        self.assertTrue(perc_diff(rpc_out['output']['prices'][0],rpc_out['output']['prices'][1]**-1)<0.0001)
+
+        head_block = rpc_out['output']['head_block']
+        rpc_out = client.post("/v2_1/batch-prices/changes?since_block={}".format(head_block),json=body).json()
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertFalse(rpc_out['output']['full'])
+        self.assertTrue(rpc_out['output']['head_block'] >= head_block)
+        self.assertEqual(len(rpc_out['output']['indexes']),len(rpc_out['output']['prices']))
+
+        rpc_out = client.post("/v2_1/batch-prices/changes?since_block=-1",json=body).json()
+        self.assertEqual(rpc_out['status'],'ERROR')
+
+
+    def test_chain_prefixed_routes(self):
+        """ Test that the default chain is served both unprefixed & under its name, & unknown chains get a 404
+        """
+        chains = client.get("/chains").json()
+        self.assertEqual(chains['status'],'SUCCESS')
+        default_chain = [chain['name'] for chain in chains['output'] if chain['default']][0]
+
+        rpc_out_1 = client.get("/v2_1/prices/{}/{}/15".format(usdc_e,weth)).json()
+        rpc_out_2 = client.get("/{}/v2_1/prices/{}/{}/15".format(default_chain,usdc_e,weth)).json()
+        self.assertEqual(rpc_out_2['status'],'SUCCESS')
+        self.assertTrue(perc_diff(rpc_out_1['output'][0],rpc_out_2['output'][0])<0.0001)
+
+        resp = client.get("/not-a-chain/v2_1/prices/{}/{}/15".format(usdc_e,weth))
+        self.assertEqual(resp.status_code,404)
+        self.assertEqual(resp.json()['status'],'ERROR')
+
+
+    def test_msgpack_batch_request(self):
+        """ Test that a batch can be sent & returned as MessagePack
+        """
+        data = msgpack.packb({'base_assets':[usdc_e,weth],'quote_assets':[weth,usdc_e],'bin_steps':[15,15]})
+        resp = client.post("/v2/batch-prices",content=data,
+                           headers={'Content-Type':'application/msgpack','Accept':'application/msgpack'})
+
+        self.assertEqual(resp.status_code,200)
+        self.assertEqual(resp.headers['content-type'],'application/msgpack')
+
+        rpc_out = msgpack.unpackb(resp.content)
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertTrue(perc_diff(rpc_out['output'][0]**-1,rpc_out['output'][1])<0.01)
+
+
+    def test_malformed_batch_body(self):
+        """ Test that a batch body missing a list is rejected
+        """
+        data = json.dumps({'base_assets':[usdc_e],'quote_assets':[weth]})
+        resp = client.post("/v2/batch-prices",data=data)
+
+        self.assertEqual(resp.status_code,422)
+        self.assertEqual(resp.json()['status'],'ERROR')
+
+
+    def test_streamed_batch_matches_batch(self):
+        """ Test that a streamed batch returns one line per chunk, matching the non-streamed output
+        """
+        data = json.dumps({'base_assets':[usdc_e,weth],'quote_assets':[weth,usdc_e],'bin_steps':[15,15]})
+        resp = client.post("/v2_1/batch-prices?stream=true",data=data)
+
+        self.assertEqual(resp.status_code,200)
+        self.assertEqual(resp.headers['content-type'],'application/x-ndjson')
+
+        lines = [json.loads(line) for line in resp.text.splitlines()]
+
+        self.assertEqual(lines[0]['status'],'SUCCESS')
+        self.assertEqual(lines[0]['offset'],0)
+
+        prices = [price for line in lines for price in line['output']]
+        self.assertEqual(len(prices),2)
+        self.assertTrue(perc_diff(prices[0]**-1,prices[1])<0.01)
+
+
 
 if __name__ == '__main__':
 
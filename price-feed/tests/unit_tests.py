@@ -3,14 +3,35 @@
 
 import sys
 sys.path.append("../")
+import time
+import socket
+import asyncio
 import unittest
+import threading
+import http.server
+from eth_abi import abi
 
 from utils.rpc_wrapper import tx_handler
+from utils.quote_engine import quote_exact_in,quote_exact_out
+from utils.valuation_graph import valuation_graph
+from utils.watchlist import watchlist
+from utils.admission import admission_controller,admission_ticket,overloaded_error,parse_deadline,PRIORITY_HIGH,PRIORITY_LOW
+from utils.parallel_decode import abi_decoder
+from utils.pool_store import pool_store,HAS_PRICE,HAS_ACTIVE_ID
+from utils.change_index import change_index
+from utils.chain_config import parse_chain_configs
+from utils.alert_index import alert_index
+from utils.alert_delivery import alert_delivery,check_callback_url
 
 rpc_endpoint = tx_handler("../abis/")
 usdc_e = "0xFF970A61A04b1cA14834A43f5dE4533eBDDB5CC8"
 weth = "0x82aF49447D8a07e3bd95BD0d56f35241523fBab1"
 
+class unexpected_rpc_call(Exception):
+    """ Raised by tests which expect to be served without calling the RPC
+    """
+    pass
+
 def perc_diff(val1,val2):
     return abs(val1-val2)/((val1+val2)/2)
 
@@ -183,6 +204,471 @@ class TestTxHandler(unittest.TestCase):
         self.assertTrue(rpc_out['output'][1] != -1)
 
 
+    def test_lowercase_addresses_not_modified(self):
+        """ Test that non-checksum addresses are accepted, and that the caller's lists are left untouched
+        """
+        base_assets = [usdc_e.lower()]
+        quote_assets = [weth.lower()]
+
+        rpc_out_1 = rpc_endpoint.handle_v2_1_requests(base_assets,quote_assets,[15])
+        rpc_out_2 = rpc_endpoint.handle_v2_1_requests([usdc_e],[weth],[15])
+
+        self.assertEqual(rpc_out_1['status'],'SUCCESS')
+        self.assertEqual(base_assets,[usdc_e.lower()])
+        self.assertEqual(quote_assets,[weth.lower()])
+        self.assertTrue(perc_diff(rpc_out_1['output'][0],rpc_out_2['output'][0])<0.01)
+
+
+    def test_address_interning(self):
+        """ Test that differently cased addresses intern to the same token, with the core tokens flagged
+        """
+        token_1 = rpc_endpoint.tokens.intern(usdc_e.lower())
+        token_2 = rpc_endpoint.tokens.intern(usdc_e)
+
+        self.assertTrue(token_1 is token_2)
+        self.assertEqual(token_1.address,usdc_e)
+        self.assertTrue(token_1.is_core)
+        self.assertTrue(rpc_endpoint.tokens.intern(weth).value < token_1.value)
+
+        for malformed in [usdc_e[2:].rjust(42,'0'),' '+usdc_e[:-1],'+'+usdc_e[:-1],'0x'+usdc_e[2:-1]+'_','0X'+usdc_e[2:]]:
+            with self.assertRaises(ValueError):
+                rpc_endpoint.tokens.intern(malformed)
+            self.assertEqual(rpc_endpoint.check_valid_inputs([malformed],[weth]),"Asset addresses are incorrectly formatted.")
+
+
+    def test_repeated_and_inverted_pairs_deduplicated(self):
+        """ Test that repeated & inverted pairs in a batch are planned as a single pool, and filled in consistently
+        """
+        base_tokens,quote_tokens = rpc_endpoint.check_valid_v2_inputs([usdc_e,weth,usdc_e],[weth,usdc_e,weth],[15,15,15])
+        unique_base,unique_quote,unique_bin_steps,request_plan = rpc_endpoint.plan_unique_pools(base_tokens,quote_tokens,
+                                                                                                [15,15,15])
+        self.assertEqual(len(unique_base),1)
+        self.assertEqual(request_plan[0],request_plan[2])
+        self.assertNotEqual(request_plan[0][1],request_plan[1][1])
+
+        rpc_out = rpc_endpoint.handle_v2_1_requests([usdc_e,weth,usdc_e],[weth,usdc_e,weth],[15,15,15])
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertEqual(rpc_out['output'][0],rpc_out['output'][2])
+        self.assertTrue(perc_diff(rpc_out['output'][0]**-1,rpc_out['output'][1])<0.0001)
+
+
+    def test_quote_engine_crosses_bins(self):
+        """ Test the swap simulation against hand-computed bins, with a price of 2 Y per X & no fee
+        """
+        bins = [(8388608,0,100,2.0),(8388607,0,100,2.0)] # swapping X for Y moves down through the bins
+
+        amount_in,amount_out,bins_crossed,complete = quote_exact_in(bins,75,True,0)
+        self.assertEqual((amount_in,amount_out,bins_crossed,complete),(75,150,1,True))
+
+        amount_in,amount_out,bins_crossed,complete = quote_exact_in(bins,150,True,0)
+        self.assertEqual((amount_in,amount_out,complete),(100,200,False)) # only 100 of X could be swapped
+
+        amount_in,amount_out,bins_crossed,complete = quote_exact_out(bins,150,True,0)
+        self.assertEqual((amount_in,amount_out,bins_crossed,complete),(75,150,1,True))
+
+
+    def test_valuation_graph_routes(self):
+        """ Test that tokens are valued through multi-hop routes to a core token, & lose their value when a pool is removed
+            -token 2 is priced against token 1, which is priced against wETH ($2000, 18 decimals)
+        """
+        weth_value = int(weth,16)
+        core_prices = {weth:{'price':2000,'token_precision':1e18}}
+        graph = valuation_graph([weth_value],ttl=0)
+        graph.add_pool(1,weth_value,0.5,'pool_1') # 1 raw token 1 = 0.5 raw wETH
+        graph.add_pool(2,1,4,'pool_2') # 1 raw token 2 = 4 raw token 1
+
+        usd_rates = graph.get_usd_rates(core_prices)
+        self.assertTrue(perc_diff(usd_rates[1],2000/1e18*0.5)<0.0001)
+        self.assertTrue(perc_diff(usd_rates[2],2000/1e18*2)<0.0001)
+        self.assertEqual(graph.get_route(2),[2,1,weth_value])
+
+        graph.remove_pool(1,weth_value,'pool_1')
+        usd_rates = graph.get_usd_rates(core_prices)
+        self.assertTrue(1 not in usd_rates and 2 not in usd_rates)
+
+
+    def test_watchlist_served_from_memory(self):
+        """ Test that frequently requested pools are learned, refreshed & then served without calling the RPC
+            -this is using the USDC/ETH pool
+        """
+        handler = tx_handler("../abis/") # own watchlist & caches, so other tests aren't affected
+        handler.watchlist = watchlist(min_hits=2,learn_interval=0)
+        price_out = handler.handle_v2_1_requests([usdc_e],[weth],[15])
+        handler.handle_v2_1_requests([weth],[usdc_e],[15])
+
+        self.assertTrue(handler.refresh_watchlist() is not None)
+        self.assertEqual(len(handler.watchlist.watched_pools()),1)
+
+        def no_rpc_calls(multicall_inputs):
+            raise unexpected_rpc_call("The watched pool should have been served without calling the RPC.")
+        handler.attempt_multicall_request = no_rpc_calls
+        watched_out = handler.handle_v2_1_requests([usdc_e],[weth],[15])
+        self.assertTrue(perc_diff(watched_out['output'][0],price_out['output'][0])<0.01)
+
+
+    def test_watchlist_counts_are_bounded(self):
+        """ Test that the request counts stop growing at max_tracked, dropping the least requested pools first
+        """
+        pools = watchlist(max_tracked=8)
+        token_x,token_y = sorted([rpc_endpoint.tokens.intern(usdc_e),rpc_endpoint.tokens.intern(weth)],key=lambda t:t.value)
+        for _ in range(5):
+            pools.record_requests('v2_1',[token_x],[token_y],[15])
+        for bin_step in range(100): # distinct pools, each requested once
+            pools.record_requests('v2',[token_x],[token_y],[bin_step])
+
+        self.assertTrue(len(pools.hits) <= 8)
+        self.assertEqual(pools.hits[('v2_1',token_x.value,token_y.value,15)][0],5)
+
+
+    def test_watchlist_respects_staleness_bounds(self):
+        """ Test that a watched pool is only served from the snapshot if it meets the client's max_age/max_blocks_behind
+            -served from a primed snapshot, requests which fall through to the RPC raise
+        """
+        handler = tx_handler("../abis/")
+        token_x,token_y = sorted([handler.tokens.intern(usdc_e),handler.tokens.intern(weth)],key=lambda t:t.value)
+        handler.watchlist.update_snapshot({('v2_1',token_x.value,token_y.value,15):2e-9},100)
+        handler.price_cache.observe_block(100)
+
+        def no_rpc_calls(multicall_inputs):
+            raise unexpected_rpc_call("The snapshot should have been rejected before any RPC call.")
+        handler.attempt_multicall_request = no_rpc_calls
+
+        self.assertEqual(handler.handle_v2_1_requests([usdc_e],[weth],[15])['status'],'SUCCESS')
+        self.assertEqual(handler.handle_v2_1_requests([usdc_e],[weth],[15],max_age=60)['status'],'SUCCESS')
+
+        prices,block_number,_ = handler.watchlist.snapshot
+        handler.watchlist.snapshot = (prices,block_number,time.time()-1) # a second old
+        with self.assertRaises(unexpected_rpc_call):
+            handler.handle_v2_1_requests([usdc_e],[weth],[15],max_age=0.5)
+
+        handler.price_cache.observe_block(101) # the snapshot is a block behind
+        self.assertEqual(handler.handle_v2_1_requests([usdc_e],[weth],[15],max_blocks_behind=1)['status'],'SUCCESS')
+        with self.assertRaises(unexpected_rpc_call): # without bounds, only the latest block is served
+            handler.handle_v2_1_requests([usdc_e],[weth],[15])
+
+
+    def test_revalidation_gets_the_requested_lists(self):
+        """ Test that a stale-while-revalidate hit refreshes the batch as requested, not its unique pools
+            -served from a primed price cache, so no RPC calls are made
+        """
+        handler = tx_handler("../abis/")
+        token_x,token_y = sorted([handler.tokens.intern(usdc_e),handler.tokens.intern(weth)],key=lambda t:t.value)
+        handler.price_cache.update('v2_1',[token_x],[token_y],[15],[2e-9],1)
+
+        revalidated = []
+        handler.revalidate = lambda key,handle_requests,*request_lists: revalidated.append(request_lists)
+        rpc_out = handler.handle_v2_1_requests([usdc_e,weth],[weth,usdc_e],[15,15],max_age=60)
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertEqual(revalidated,[([usdc_e,weth],[weth,usdc_e],[15,15])])
+
+
+    def test_admission_sheds_load(self):
+        """ Test that requests over the in-flight limit queue, that a full queue rejects with a retry time, and that
+            a higher priority request displaces a lower priority waiter
+        """
+        controller = admission_controller(max_in_flight=1,max_queue=1)
+        deadline = time.monotonic()+10
+
+        running = admission_ticket(PRIORITY_HIGH,deadline)
+        controller.acquire(running) # takes the only slot
+
+        batch = admission_ticket(PRIORITY_LOW,deadline)
+        batch_errors = []
+        def wait_for_slot(ticket,errors):
+            try:
+                controller.acquire(ticket)
+            except overloaded_error as e:
+                errors.append(e)
+        thread = threading.Thread(target=wait_for_slot,args=(batch,batch_errors))
+        thread.start()
+        while len(controller.waiters) == 0:
+            time.sleep(0.001)
+
+        with self.assertRaises(overloaded_error) as e: # queue is full of an equal priority request
+            controller.acquire(admission_ticket(PRIORITY_LOW,deadline))
+        self.assertTrue(e.exception.retry_after >= 1)
+
+        single = admission_ticket(PRIORITY_HIGH,deadline)
+        single_errors = []
+        single_thread = threading.Thread(target=wait_for_slot,args=(single,single_errors))
+        single_thread.start()
+        thread.join(timeout=5)
+        self.assertEqual(len(batch_errors),1) # displaced
+
+        controller.release(running)
+        single_thread.join(timeout=5)
+        self.assertEqual(len(single_errors),0)
+        self.assertTrue(single.admitted_at is not None)
+        controller.release(single)
+        self.assertEqual(controller.in_flight,0)
+
+
+    def test_admission_bad_deadlines(self):
+        """ Test that non-finite deadlines get the default, and that a wait which raises doesn't leave a slot taken
+        """
+        self.assertEqual(parse_deadline('inf',5,30),5)
+        self.assertEqual(parse_deadline('nan',5,30),5)
+        self.assertEqual(parse_deadline('-1',5,30),5)
+        self.assertEqual(parse_deadline(None,5,30),5)
+        self.assertEqual(parse_deadline('1e9',5,30),30)
+        self.assertEqual(parse_deadline('250',5,30),0.25)
+
+        controller = admission_controller(max_in_flight=1,max_queue=4)
+        running = admission_ticket(PRIORITY_HIGH,time.monotonic()+10)
+        controller.acquire(running)
+        for deadline in (float('inf'),float('nan')): # the wait raises (inf) or times out straight away (nan)
+            with self.assertRaises((OverflowError,ValueError,overloaded_error)):
+                controller.acquire(admission_ticket(PRIORITY_HIGH,deadline))
+        self.assertEqual(len(controller.waiters),0)
+
+        controller.release(running)
+        self.assertEqual(controller.in_flight,0)
+        controller.acquire(admission_ticket(PRIORITY_HIGH,time.monotonic()+10)) # the slot is free again
+        self.assertEqual(controller.in_flight,1)
+
+
+    def test_parallel_decode_matches_abi(self):
+        """ Test that return data decoded from raw words, in process & across the process pool, matches abi.decode
+        """
+        reserves = [abi.encode(['uint256','uint256','uint256'],[i*10**18,i,8388608+i]) for i in range(50)]
+        pairs = [abi.encode(['uint16','address','bool','bool'],[15,weth,True,False]) for i in range(50)]
+        expected_reserves = [list(column) for column in zip(*[abi.decode(['uint256']*3,item) for item in reserves])]
+        expected_pairs = [abi.decode(['uint16','address','bool','bool'],item)[1] for item in pairs]
+
+        decoder = abi_decoder(workers=2,min_parallel_items=1)
+        try:
+            for current in (abi_decoder(),decoder):
+                self.assertEqual(current.decode(reserves,((0,'uint'),(1,'uint'),(2,'uint'))),expected_reserves)
+                self.assertEqual(current.decode(pairs,((1,'address'),))[0],expected_pairs)
+        finally:
+            decoder.shutdown()
+
+
+    def test_pool_store_columns(self):
+        """ Test that the pool store tracks when prices change, keeps state per pool & evicts the least recently used pools
+        """
+        store = pool_store(max_size=8)
+        keys = [('v2',i,i+100,15) for i in range(8)]
+        for i,key in enumerate(keys):
+            store.set_price(key,1.5,100,0.0,15)
+            store.set_active_id(key,8388608+i,100)
+
+        self.assertEqual(store.set_price(keys[0],1.5,101,1.0),100) # unchanged price keeps its block
+        self.assertEqual(store.set_price(keys[0],2.5,102,2.0),102)
+        self.assertEqual(store.set_price(keys[0],1.5,101,3.0),102) # older block is ignored
+        self.assertEqual(store.get(keys[0]).price,2.5)
+        state = store.get(keys[3])
+        self.assertEqual((state.active_id,state.price,state.flags),(8388611,1.5,HAS_PRICE|HAS_ACTIVE_ID))
+
+        store.set_price(('v1',1000,1001,None),3.0,103,3.0) # full, evicts the least recently used pool
+        self.assertEqual(len(store),8)
+        self.assertTrue(store.get(keys[1]) is None)
+        self.assertTrue(store.get(keys[0]) is not None)
+
+        _,values = store.snapshot([keys[0],keys[1]],('price','changed_block'))
+        self.assertEqual(values,{'price':[2.5,None],'changed_block':[102,None]})
+        all_keys,columns = store.snapshot()
+        self.assertEqual(sum(1 for key in all_keys if key is not None),8)
+        self.assertEqual(len(columns['flags']),len(all_keys))
+
+
+    def test_change_index_ranges(self):
+        """ Test that changes are found by block range, and that ranges the index no longer covers return None
+        """
+        index = change_index(max_blocks=3)
+        self.assertTrue(index.changed_between(0,100) is None) # nothing recorded yet
+        index.record(100,['a','b'])
+        index.record(102,['b'])
+        index.record(101,['c']) # recorded out of order
+
+        self.assertEqual(index.changed_between(99,102),{'a','b','c'})
+        self.assertEqual(index.changed_between(100,101),{'c'})
+        self.assertEqual(index.changed_between(102,110),set())
+        self.assertTrue(index.changed_between(98,102) is None) # from before the first recorded block
+
+        index.record(103,['d']) # evicts block 100
+        self.assertEqual(len(index),3)
+        self.assertTrue(index.changed_between(99,103) is None)
+        self.assertEqual(index.changed_between(100,103),{'b','c','d'})
+
+
+    def test_v2_1_quote_matches_price(self):
+        """ Test that a small quote executes close to the pool price, and that larger sizes get worse prices
+            -this is using the USDC/ETH pool
+        """
+        rpc_out = rpc_endpoint.handle_v2_1_quote_requests(weth,usdc_e,15,amounts_in=[10**15,10**21])
+        price_out = rpc_endpoint.handle_v2_1_requests([weth],[usdc_e],[15])
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+
+        small_quote,large_quote = rpc_out['output']['exact_in']
+        self.assertTrue(perc_diff(rpc_out['output']['spot_price'],price_out['output'][0])<0.01)
+        self.assertTrue(small_quote['price_impact']<0.01)
+        self.assertTrue(large_quote['price_impact']>small_quote['price_impact'])
+
+
+    def test_v2_depth_matches_price(self):
+        """ Test that the depth of a pool returns the same price as the price request, with sides swapped when inverted
+            -this is using the USDC/ETH pool
+        """
+        rpc_out = rpc_endpoint.handle_v2_1_depth_requests([usdc_e,weth],[weth,usdc_e],[15,15],bin_window=3)
+        price_out = rpc_endpoint.handle_v2_1_requests([usdc_e],[weth],[15])
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+
+        depth_1,depth_2 = rpc_out['output']
+        self.assertTrue(perc_diff(depth_1['price'],price_out['output'][0])<0.01)
+        self.assertEqual(len(depth_1['bids_usd']),3)
+        self.assertEqual(depth_1['bids_usd'],depth_2['asks_usd'])
+        self.assertEqual(depth_1['cumulative_asks_usd'][-1],sum(depth_1['asks_usd']))
+
+
+    def test_v1_depth_threshold(self):
+        """ Test that a client chosen liquidity threshold is applied to v1 pools
+            -this is using the USDC/ETH pool
+        """
+        rpc_out = rpc_endpoint.handle_v1_depth_requests([usdc_e],[weth],min_liquidity_usd=0)
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        self.assertTrue(rpc_out['output'][0]['price'] != -1)
+
+        total_usd = rpc_out['output'][0]['total_usd']
+        rpc_out = rpc_endpoint.handle_v1_depth_requests([usdc_e],[weth],min_liquidity_usd=total_usd*10)
+        self.assertEqual(rpc_out['output'][0]['price'],-1)
+
+
+    def test_v2_1_twap(self):
+        """ Test that a short TWAP is close to the current price, & inverted pairs return the inverse
+            -this is using the USDC/ETH pool
+        """
+        rpc_out = rpc_endpoint.handle_v2_1_twap_requests([usdc_e,weth],[weth,usdc_e],[15,15],[60])
+        price_out = rpc_endpoint.handle_v2_1_requests([usdc_e],[weth],[15])
+
+        self.assertEqual(rpc_out['status'],'SUCCESS')
+        twap_1,twap_2 = rpc_out['output'][0][0],rpc_out['output'][1][0]
+        self.assertTrue(perc_diff(twap_1,price_out['output'][0])<0.05)
+        self.assertTrue(perc_diff(twap_1,twap_2**-1)<0.0001)
+
+        rpc_out = rpc_endpoint.handle_v2_1_twap_requests([usdc_e],[weth],[15],[0])
+        self.assertEqual(rpc_out['status'],'ERROR')
+
+
+    def test_chain_configs_parsed(self):
+        """ Test that chain configs read '$NAME' values from the env, & that bad configs are rejected
+        """
+        chainlink = {usdc_e:{'token_precision':1e6,'name':'USDC.e','chainlink_address':weth}}
+        config = {'rpc':'$FACTORY_V1','factory_v1':'$FACTORY_V1','factory_v2':'$FACTORY_V2',
+                  'factory_v2_1':'$FACTORY_V2_1','multicall':'$MULTICALL','chainlink':chainlink}
+        chain = parse_chain_configs({'arbitrum':config})[0]
+        self.assertEqual(chain.name,'arbitrum')
+        self.assertEqual(chain.factory_v2,rpc_endpoint.chain.factory_v2)
+        self.assertEqual(chain.chainlink_info[usdc_e]['token_precision'],1e6)
+        self.assertEqual(chain.rate_limit_per_min,100)
+
+        with self.assertRaises(ValueError): # clashes with the unprefixed routes
+            parse_chain_configs({'v2':config})
+        with self.assertRaises(ValueError):
+            parse_chain_configs({'arbitrum':{'rpc':'http://localhost'}})
+
+
+    def test_alert_index_bounds(self):
+        """ Test that alerts fire once when the price leaves their bounds, in either direction of the pair
+        """
+        token_a,token_b = sorted([rpc_endpoint.tokens.intern(usdc_e),rpc_endpoint.tokens.intern(weth)],key=lambda t:t.value)
+        key = ('v2_1',token_a.value,token_b.value,15)
+        alerts = alert_index()
+        band = alerts.add(key,token_a,token_b,1.0,2.0,stream_token='s')
+        above = alerts.add(key,token_a,token_b,None,3.0,stream_token='s')
+        inverted = alerts.add(key,token_b,token_a,0.25,None,stream_token='s') # fires when token_a/token_b > 4
+
+        self.assertEqual(alerts.evaluate(key,1.5),[])
+        self.assertEqual(alerts.evaluate(key,-1),[]) # not enough liquidity
+        self.assertEqual(alerts.evaluate(key,2.5),[band])
+        self.assertEqual(alerts.evaluate(key,0.5),[]) # already fired
+        self.assertEqual(alerts.evaluate(key,5),[above,inverted])
+        self.assertEqual(len(alerts),0)
+        self.assertFalse(alerts.has_alerts(key))
+
+        alert = alerts.add(key,token_a,token_b,1.0,2.0,callback_url='http://localhost')
+        self.assertEqual(alerts.remove(alert.alert_id),alert)
+        self.assertIsNone(alerts.remove(alert.alert_id))
+        self.assertEqual(alerts.pools(),set())
+
+
+    def test_callback_url_checked(self):
+        """ Test that webhooks can't target internal addresses unless their host is explicitly allowed
+        """
+        for callback_url in ["http://127.0.0.1/hook","http://10.0.0.1/hook","http://169.254.169.254/latest/meta-data",
+                             "http://[::1]/hook","http://[::ffff:192.168.0.1]/hook","http://0.0.0.0/hook"]:
+            self.assertNotEqual(check_callback_url(callback_url),"")
+        self.assertNotEqual(check_callback_url("file:///etc/passwd"),"")
+        self.assertEqual(check_callback_url("https://8.8.8.8/hook"),"")
+
+        self.assertEqual(check_callback_url("http://127.0.0.1/hook",{'127.0.0.1'}),"")
+        self.assertNotEqual(check_callback_url("https://8.8.8.8/hook",{'127.0.0.1'}),"")
+        self.assertEqual(check_callback_url("http://hook.test/hook",{'hook.test'}),"callback_url host can't be resolved.")
+
+
+    def test_webhook_posts_to_checked_address(self):
+        """ Test that a webhook is posted to the address its host was checked against, not resolved a second time
+            -hook.test only resolves (to a local server) for the check, so the post can only reach it through that address
+        """
+        received = []
+        class hook(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append((self.headers['Host'],self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.end_headers()
+            def log_message(self,*args):
+                pass
+        server = http.server.HTTPServer(('127.0.0.1',0),hook)
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        port = server.server_address[1]
+
+        getaddrinfo = socket.getaddrinfo
+        checked = []
+        def resolve_once(host,*args,**kwargs):
+            if host == 'hook.test':
+                checked.append(host)
+                host = '127.0.0.1'
+            return getaddrinfo(host,*args,**kwargs)
+        socket.getaddrinfo = resolve_once
+        try:
+            delivery = alert_delivery(allowed_hosts=('hook.test',))
+            delivery.post_webhook("http://hook.test:{}/hook".format(port),{'alert_id':1})
+        finally:
+            socket.getaddrinfo = getaddrinfo
+            server.shutdown()
+        self.assertEqual(checked,['hook.test'])
+        self.assertEqual(received,[('hook.test:{}'.format(port),b'{"alert_id":1}')])
+        self.assertEqual(delivery.webhook_failures,0)
+
+
+    def test_alert_streams_need_a_token(self):
+        """ Test that streams only exist while they have alerts or unread events, & are only read with their token
+        """
+        delivery = alert_delivery()
+        self.assertIsNone(delivery.open_stream("guessed"))
+        self.assertEqual(len(delivery.outboxes),0)
+
+        stream_token = delivery.open_stream()
+        self.assertEqual(delivery.open_stream(stream_token),stream_token) # a second alert on the same stream
+        delivery.close_stream(stream_token) # removed before firing
+        self.assertTrue(delivery.has_stream(stream_token))
+
+        alert = alert_index().add(('v1',1,2,None),rpc_endpoint.tokens.intern(weth),rpc_endpoint.tokens.intern(usdc_e),
+                                  1.0,None,stream_token=stream_token)
+        delivery.publish(alert,{'alert_id':alert.alert_id})
+        self.assertTrue(delivery.has_stream(stream_token)) # until the event is read
+
+        async def read_stream():
+            return [line async for line in delivery.stream(stream_token)]
+        lines = asyncio.run(read_stream())
+        self.assertEqual(len(lines),1) # the stream ends once its last alert has been written
+        self.assertFalse(delivery.has_stream(stream_token))
+        delivery.shutdown()
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,82 @@
+""" Interning of addresses (tokens & pairs)
+    -maps an address, in whatever case the client sent it, to a single interned record holding its
+     checksum address, a small integer id & the integer value of the address
+    -the integer value is what the pools use to order their tokens (tokenX is the 'smaller' address),
+     so ordering checks become integer comparisons & the keccak for the checksum is computed once
+    -bounded LRU, pinned addresses (e.g. the core tokens) are never evicted
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from web3 import Web3
+
+
+ADDRESS_FORMAT = re.compile('0x[0-9a-fA-F]{40}')
+
+
+class interned_address:
+    """ Interned record for a single address
+    """
+    __slots__ = ('id','address','value','is_core')
+
+    def __init__(self,id,address,value,is_core):
+        """ Init
+        """
+        self.id = id # small integer id, unique for the lifetime of the registry
+        self.address = address # checksum address
+        self.value = value # integer value of the address, used for token ordering
+        self.is_core = is_core # whether this token has a chainlink USD price
+
+
+class address_registry:
+    """ Bounded registry of interned addresses
+    """
+    def __init__(self,core_addresses=(),max_size=100_000):
+        """ Init
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.by_value = OrderedDict() # address value -> interned_address, in LRU order
+
+        self.core_values = set(int(address,16) for address in core_addresses)
+        for address in core_addresses:
+            self.intern(address)
+
+
+    def intern(self,address):
+        """ Returns the interned record for an address
+            -raises ValueError if the address isn't 0x followed by 40 hex digits, checked before the conversion
+             as int() also accepts e.g. a missing 0x, underscores or surrounding whitespace
+        """
+        if type(address)!=str or ADDRESS_FORMAT.fullmatch(address) is None:
+            raise ValueError("Address '{}' isn't 0x followed by 40 hex digits.".format(address))
+        value = int(address,16)
+        with self.lock:
+            record = self.by_value.get(value)
+            if record is not None:
+                self.by_value.move_to_end(value)
+                return record
+
+            record = interned_address(self.next_id,Web3.toChecksumAddress(address),value,value in self.core_values)
+            self.next_id += 1
+            self.by_value[value] = record
+            self.evict()
+            return record
+
+
+    def evict(self):
+        """ Evicts the least recently used addresses while over max_size, skipping pinned addresses
+            -must hold the lock
+        """
+        for _ in range(len(self.by_value)):
+            if len(self.by_value) <= self.max_size:
+                return
+            value,record = self.by_value.popitem(last=False)
+            if record.is_core: # pinned, move back to the most recently used end
+                self.by_value[value] = record
+
+
+    def __len__(self):
+        return len(self.by_value)
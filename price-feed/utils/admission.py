@@ -0,0 +1,187 @@
+""" Admission control in front of the RPC layer
+    -caps the no. requests doing RPC work at once, with a bounded, prioritised wait queue behind it
+    -a request only takes a slot on its first multicall, so requests served from memory (watchlist,
+     price cache) never wait, & keeps the slot until it finishes so it isn't re-queued between calls
+    -requests are rejected straight away when the queue is full, or when they are not expected to finish
+     before their deadline (based on an average of recent service times), the caller turns this into a
+     503 with Retry-After
+    -when the queue is full, a higher priority request (e.g. single GET) displaces the lowest priority
+     waiter (e.g. big batch) rather than being rejected
+    -the current request's ticket is held in a contextvar, so tx_handler doesn't need to be passed it
+"""
+
+import math
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+
+
+PRIORITY_HIGH = 0 # single pool requests
+PRIORITY_LOW = 1 # batches & other multi-pool requests
+
+current_ticket = contextvars.ContextVar('current_ticket',default=None)
+
+
+class overloaded_error(Exception):
+    """ Raised when a request isn't admitted, retry_after is the suggested wait in seconds
+    """
+    def __init__(self,reason,retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class admission_ticket:
+    """ Admission state of a single request
+    """
+    __slots__ = ('priority','deadline','admitted_at','event','rejection')
+
+    def __init__(self,priority,deadline):
+        """ Init
+        """
+        self.priority = priority
+        self.deadline = deadline # time.monotonic() by which the request needs to have finished
+        self.admitted_at = None # set once the request holds a slot
+        self.event = None # set while waiting in the queue
+        self.rejection = None # overloaded_error, if dropped while waiting
+
+
+class admission_controller:
+    """ Concurrency limiter with a bounded priority queue & deadline-aware dropping
+    """
+    def __init__(self,max_in_flight=16,max_queue=16,initial_service_time=0.2):
+        """ Init
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiters = [] # heap of (priority,sequence no.,ticket)
+        self.sequence = itertools.count()
+        self.service_time = initial_service_time # moving average of seconds a request holds a slot
+        self.rejected = 0
+
+
+    def retry_after(self):
+        """ Suggested seconds before retrying, the time for the current queue to drain
+            -must hold the lock
+        """
+        return max(1,math.ceil((len(self.waiters)+1)*self.service_time/self.max_in_flight))
+
+
+    def reject(self,reason):
+        """ Builds the error for a rejected request
+            -must hold the lock
+        """
+        self.rejected += 1
+        return overloaded_error(reason,self.retry_after())
+
+
+    def acquire(self,ticket):
+        """ Blocks until the request holds a slot, raises overloaded_error if it isn't admitted
+        """
+        with self.lock:
+            if self.in_flight < self.max_in_flight and len(self.waiters) == 0:
+                self.in_flight += 1
+                ticket.admitted_at = time.monotonic()
+                return
+
+            if time.monotonic()+self.service_time > ticket.deadline: # wouldn't finish in time even if admitted now
+                raise self.reject("Server overloaded, request can't finish before its deadline.")
+
+            if len(self.waiters) >= self.max_queue:
+                worst = max(self.waiters) # lowest priority, most recent
+                if worst[0] <= ticket.priority:
+                    raise self.reject("Server overloaded, retry later.")
+                self.waiters.remove(worst) # displaced by a higher priority request
+                heapq.heapify(self.waiters)
+                self.drop(worst[2],"Server overloaded, retry later.")
+
+            ticket.event = threading.Event()
+            heapq.heappush(self.waiters,(ticket.priority,next(self.sequence),ticket))
+
+        try:
+            ticket.event.wait(timeout=max(ticket.deadline-time.monotonic(),0))
+        except BaseException: # e.g. interrupted, the ticket mustn't be left queued or holding a slot
+            with self.lock:
+                admitted = ticket.admitted_at is not None
+                if not admitted:
+                    self.waiters = [waiter for waiter in self.waiters if waiter[2] is not ticket]
+                    heapq.heapify(self.waiters)
+            if admitted: # the slot was handed over meanwhile, the caller won't know it holds it
+                self.release(ticket)
+                ticket.admitted_at = None
+            raise
+        with self.lock:
+            if ticket.admitted_at is not None:
+                return
+            if ticket.rejection is None: # timed out in the queue
+                self.waiters = [waiter for waiter in self.waiters if waiter[2] is not ticket]
+                heapq.heapify(self.waiters)
+                ticket.rejection = self.reject("Server overloaded, request can't finish before its deadline.")
+            raise ticket.rejection
+
+
+    def drop(self,ticket,reason):
+        """ Wakes a waiting request with a rejection
+            -must hold the lock
+        """
+        ticket.rejection = self.reject(reason)
+        ticket.event.set()
+
+
+    def release(self,ticket):
+        """ Frees the slot held by a request, handing it to the next waiter which can still meet its deadline
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.service_time = 0.9*self.service_time+0.1*(now-ticket.admitted_at)
+            while len(self.waiters) > 0:
+                _,_,waiter = heapq.heappop(self.waiters)
+                if now+self.service_time > waiter.deadline:
+                    self.drop(waiter,"Server overloaded, request can't finish before its deadline.")
+                    continue
+                waiter.admitted_at = now # slot is handed over, in_flight is unchanged
+                waiter.event.set()
+                return
+            self.in_flight -= 1
+
+
+def parse_deadline(deadline_ms,default_s,max_s):
+    """ Seconds a request has to finish, from the X-Deadline-Ms header
+        -missing, malformed, non-finite or non-positive values get the default, others are capped at max_s
+    """
+    try:
+        deadline_s = float(deadline_ms)/1000
+    except (TypeError,ValueError):
+        return default_s
+    if not math.isfinite(deadline_s) or deadline_s <= 0:
+        return default_s
+    return min(deadline_s,max_s)
+
+
+def start_admission(priority,deadline_s):
+    """ Starts a ticket for the current request, returns the ticket & the token needed to finish it
+    """
+    ticket = admission_ticket(priority,time.monotonic()+deadline_s)
+    return ticket,current_ticket.set(ticket)
+
+
+def admit(controller):
+    """ Takes a slot for the current request if it doesn't already hold one, called before each RPC call
+        -no-op for work outside of a request (e.g. background refreshes)
+    """
+    ticket = current_ticket.get()
+    if ticket is None or ticket.admitted_at is not None:
+        return
+    controller.acquire(ticket)
+
+
+def finish_admission(controller,ticket,token=None):
+    """ Frees the current request's slot, if it took one
+    """
+    if token is not None:
+        current_ticket.reset(token)
+    if ticket.admitted_at is not None:
+        controller.release(ticket)
@@ -0,0 +1,273 @@
+""" Push delivery of triggered price alerts, to an NDJSON stream or to a webhook
+    -alerts are triggered in the watchlist refresher's thread, so delivery never blocks it:
+     stream events are queued & the waiting streams woken on their event loop, webhooks are posted
+     from a small thread pool
+    -a stream is identified by a random token the server hands out when its first alert is registered,
+     further alerts are added to it with the token, & only holders of the token can read it
+    -a stream's outbox only exists while it has alerts which haven't fired, or events which haven't been
+     read: events of a stream without a connected client are kept (up to buffer_size, oldest dropped) &
+     written as soon as it connects, unread events are dropped once the outbox has been idle for retention
+     seconds, a stream is expected to be read by a single client
+    -webhooks are posted once, with a timeout & without following redirects, failures are only counted
+    -webhook urls are supplied by clients, so to keep the server from being used to reach internal services
+     their host needs to be in allowed_hosts (ALERT_WEBHOOK_ALLOWED_HOSTS) if that's set, & otherwise needs
+     to resolve only to public addresses, checked both when the alert is registered & before each post
+    -the post connects to the address that was checked, with the url's host kept for the Host header & TLS,
+     so a host can't resolve to a public address for the check & an internal one for the post (dns rebinding)
+"""
+
+import time
+import socket
+import asyncio
+import secrets
+import ipaddress
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit,urlunsplit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.codec import dumps_json
+
+
+def resolve_callback_url(callback_url,allowed_hosts=()):
+    """ Checks a webhook url & resolves its host, returns (error string,address to connect to)
+        -the error is an empty string if the url can be posted to, the address is then one of the checked ones
+        -with allowed_hosts, only those hosts are accepted, otherwise every address the host resolves to needs
+         to be public (not loopback, private, link-local e.g. cloud metadata, reserved or multicast)
+    """
+    if type(callback_url)!=str:
+        return "callback_url needs to be an http(s) url.",None
+    try:
+        url = urlsplit(callback_url)
+        port = url.port or (443 if url.scheme == 'https' else 80)
+    except ValueError: # e.g. malformed port
+        return "callback_url needs to be an http(s) url.",None
+    if url.scheme not in ('http','https') or not url.hostname:
+        return "callback_url needs to be an http(s) url.",None
+    if len(allowed_hosts) > 0 and url.hostname.lower() not in allowed_hosts:
+        return "callback_url host isn't allowed.",None
+
+    try:
+        addresses = socket.getaddrinfo(url.hostname,port,proto=socket.IPPROTO_TCP)
+    except (socket.gaierror,UnicodeError):
+        return "callback_url host can't be resolved.",None
+    ips = []
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0]) # drops the ipv6 scope
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if len(allowed_hosts) == 0 and (not ip.is_global or ip.is_multicast):
+            return "callback_url needs to resolve to a public address.",None
+        ips.append(ip)
+    return "",ips[0]
+
+
+def check_callback_url(callback_url,allowed_hosts=()):
+    """ Checks a webhook url, returns an error string, or an empty string if it can be posted to
+        -see resolve_callback_url
+    """
+    return resolve_callback_url(callback_url,allowed_hosts)[0]
+
+
+def pinned_url(callback_url,ip):
+    """ Returns the url with its host replaced by a resolved address, & the Host header of the original url
+    """
+    url = urlsplit(callback_url)
+    host = "[{}]".format(ip) if ip.version == 6 else str(ip)
+    if url.port is not None:
+        host += ":{}".format(url.port)
+    return urlunsplit((url.scheme,host,url.path,url.query,'')),url.netloc.rsplit('@',1)[-1]
+
+
+class pinned_host_adapter(HTTPAdapter):
+    """ Transport adapter for urls pinned to an address (see pinned_url), TLS is still checked against the host
+        -the SNI & the certificate's expected name are the original host rather than the address connected to
+    """
+    def __init__(self,hostname):
+        """ Init
+        """
+        self.hostname = hostname
+        super().__init__()
+
+
+    def init_poolmanager(self,connections,maxsize,block=False,**pool_kwargs):
+        pool_kwargs['server_hostname'] = self.hostname
+        pool_kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(connections,maxsize,block,**pool_kwargs)
+
+
+class stream_outbox:
+    """ Events waiting to be written to a stream, & the clients waiting for them
+    """
+    __slots__ = ('events','waiters','alerts','updated_at')
+
+    def __init__(self,buffer_size):
+        """ Init
+        """
+        self.events = deque(maxlen=buffer_size)
+        self.waiters = [] # (event loop,asyncio.Event) of each connected client
+        self.alerts = 0 # no. alerts registered to the stream which haven't fired
+        self.updated_at = time.monotonic()
+
+
+    def is_idle(self):
+        """ Whether nothing more can be delivered or read
+        """
+        return self.alerts == 0 and len(self.events) == 0 and len(self.waiters) == 0
+
+
+class alert_delivery:
+    """ Delivers alert events to streams or webhooks
+    """
+    def __init__(self,buffer_size=1000,webhook_workers=2,webhook_timeout=5,allowed_hosts=(),retention=3600):
+        """ Init
+        """
+        self.buffer_size = buffer_size
+        self.retention = retention # seconds unread events of a stream without alerts or clients are kept for
+        self.swept_at = time.monotonic()
+        self.webhook_timeout = webhook_timeout
+        self.allowed_hosts = {host.lower() for host in allowed_hosts} # webhook hosts, any public host if empty
+        self.lock = threading.Lock()
+        self.outboxes = {} # stream token -> stream_outbox
+        self.webhook_executor = ThreadPoolExecutor(max_workers=webhook_workers,thread_name_prefix='webhook')
+        self.webhook_failures = 0
+
+
+    def open_stream(self,stream_token=None):
+        """ Counts an alert towards a stream, a new stream if stream_token is None
+            -returns the stream's token, None if there's no stream with the given token
+        """
+        with self.lock:
+            self.sweep()
+            if stream_token is None:
+                stream_token = secrets.token_urlsafe(24)
+                self.outboxes[stream_token] = stream_outbox(self.buffer_size)
+            outbox = self.outboxes.get(stream_token)
+            if outbox is None:
+                return None
+            outbox.alerts += 1
+            return stream_token
+
+
+    def close_stream(self,stream_token):
+        """ Stops counting an alert towards its stream, e.g. because it was removed before firing
+        """
+        with self.lock:
+            outbox = self.outboxes.get(stream_token)
+            if outbox is not None:
+                outbox.alerts -= 1
+                self.drop_if_idle(stream_token,outbox)
+
+
+    def has_stream(self,stream_token):
+        """ Whether a stream exists
+        """
+        with self.lock:
+            return stream_token in self.outboxes
+
+
+    def drop_if_idle(self,stream_token,outbox):
+        """ Drops an outbox once nothing more can be delivered or read
+            -must hold the lock
+        """
+        if outbox.is_idle() and self.outboxes.get(stream_token) is outbox:
+            del self.outboxes[stream_token]
+
+
+    def sweep(self,interval=60):
+        """ Drops the unread events of streams without alerts or clients, idle for longer than retention
+            -must hold the lock, runs at most once per interval
+        """
+        now = time.monotonic()
+        if now-self.swept_at < interval:
+            return
+        self.swept_at = now
+        for stream_token,outbox in list(self.outboxes.items()):
+            if outbox.alerts == 0 and len(outbox.waiters) == 0 and now-outbox.updated_at > self.retention:
+                del self.outboxes[stream_token]
+
+
+    def publish(self,alert,event):
+        """ Delivers the event of a triggered alert, safe to call from any thread
+        """
+        if alert.callback_url is not None:
+            self.webhook_executor.submit(self.post_webhook,alert.callback_url,event)
+            return
+
+        with self.lock:
+            outbox = self.outboxes.get(alert.stream_token)
+            if outbox is None: # dropped by the sweep, can't happen while the alert counts towards it
+                return
+            outbox.alerts -= 1 # fired
+            outbox.events.append(event)
+            outbox.updated_at = time.monotonic()
+            for loop,wake_up in outbox.waiters:
+                loop.call_soon_threadsafe(wake_up.set)
+
+
+    def check_callback_url(self,callback_url):
+        """ Checks a webhook url against this delivery's allowed hosts, see check_callback_url
+        """
+        return check_callback_url(callback_url,self.allowed_hosts)
+
+
+    def post_webhook(self,callback_url,event):
+        """ Posts an event to a webhook, runs in the webhook executor
+            -the url is checked again, as what its host resolves to may have changed since registration, &
+             the post connects to the checked address rather than resolving the host again
+        """
+        error,ip = resolve_callback_url(callback_url,self.allowed_hosts)
+        if error != "":
+            self.webhook_failures += 1
+            return
+        url,host = pinned_url(callback_url,ip)
+        parsed = urlsplit(callback_url)
+        auth = (parsed.username,parsed.password or '') if parsed.username is not None else None
+        try:
+            with requests.Session() as session:
+                session.mount('https://',pinned_host_adapter(parsed.hostname))
+                response = session.post(url,data=dumps_json(event),timeout=self.webhook_timeout,auth=auth,
+                                        headers={'Content-Type':'application/json','Host':host},allow_redirects=False)
+            if response.status_code >= 300: # redirects aren't followed, they could point anywhere
+                self.webhook_failures += 1
+        except requests.RequestException: # e.g. unreachable or timed out
+            self.webhook_failures += 1
+
+
+    async def stream(self,stream_token):
+        """ Yields the events of a stream as NDJSON lines, waiting for new events until the client disconnects
+            -ends once every alert of the stream has fired & been written, the stream is then gone
+            -callers check the stream exists first (has_stream), an unknown stream yields nothing
+        """
+        wake_up = asyncio.Event()
+        waiter = (asyncio.get_running_loop(),wake_up)
+        with self.lock:
+            outbox = self.outboxes.get(stream_token)
+            if outbox is None:
+                return
+            outbox.waiters.append(waiter)
+        try:
+            while True:
+                wake_up.clear() # cleared before draining, so an event published meanwhile sets it again
+                with self.lock:
+                    events = list(outbox.events)
+                    outbox.events.clear()
+                    outbox.updated_at = time.monotonic()
+                    finished = outbox.alerts == 0
+                for event in events:
+                    yield dumps_json(event)+b"\n"
+                if finished:
+                    return
+                if len(events) == 0:
+                    await wake_up.wait()
+        finally:
+            with self.lock:
+                outbox.waiters.remove(waiter)
+                self.drop_if_idle(stream_token,outbox)
+
+
+    def shutdown(self):
+        """ Stops posting webhooks
+        """
+        self.webhook_executor.shutdown(wait=False)
@@ -0,0 +1,176 @@
+""" Index of price-threshold alerts, evaluated against every new price of the pools they watch
+    -an alert fires once, when its pool's price (in the client's direction) falls below lower or rises
+     above upper, & is then removed
+    -bounds are stored as canonical prices (base is tokenX, see watchlist.pool_key), so an alert on the
+     inverted pair has its bounds inverted & swapped: price < lower is canonical price > 1/lower
+    -per pool, 'below' bounds fire when the canonical price drops under them & 'above' bounds when it rises
+     over them, each kept sorted, so the alerts a price triggers are a suffix of one list & a prefix of the
+     other, found by bisection: evaluation is O(log n + matches) rather than a scan of every alert
+    -prices of -1 (not enough liquidity) never trigger alerts
+"""
+
+import bisect
+import threading
+import itertools
+
+
+class price_alert:
+    """ A single registered alert
+    """
+    __slots__ = ('alert_id','key','base_asset','quote_asset','inverted','lower','upper','stream_token','callback_url')
+
+    def __init__(self,alert_id,key,base_asset,quote_asset,lower,upper,stream_token=None,callback_url=None):
+        """ Init
+        """
+        self.alert_id = alert_id
+        self.key = key # canonical pool key
+        self.base_asset = base_asset # interned_address, in the client's direction
+        self.quote_asset = quote_asset
+        self.inverted = base_asset.value > quote_asset.value # the client's base token is tokenY
+        self.lower = lower # in the client's direction, None if unbounded
+        self.upper = upper
+        self.stream_token = stream_token # token of the stream the alert is pushed to
+        self.callback_url = callback_url # or the webhook it's posted to
+
+
+    def canonical_bounds(self):
+        """ Returns (below bound,above bound) in canonical prices, None if unbounded
+        """
+        if not self.inverted:
+            return self.lower,self.upper
+        return (1/self.upper if self.upper is not None else None,
+                1/self.lower if self.lower is not None else None)
+
+
+class sorted_bounds:
+    """ Bounds sorted ascending, with the id of the alert each belongs to
+    """
+    __slots__ = ('bounds','alert_ids')
+
+    def __init__(self):
+        """ Init
+        """
+        self.bounds = []
+        self.alert_ids = []
+
+
+    def insert(self,bound,alert_id):
+        i = bisect.bisect_right(self.bounds,bound)
+        self.bounds.insert(i,bound)
+        self.alert_ids.insert(i,alert_id)
+
+
+    def remove(self,bound,alert_id):
+        i = bisect.bisect_left(self.bounds,bound)
+        while self.alert_ids[i] != alert_id: # alerts with equal bounds are next to each other
+            i += 1
+        del self.bounds[i]
+        del self.alert_ids[i]
+
+
+    def __len__(self):
+        return len(self.bounds)
+
+
+class alert_index:
+    """ Pool key -> sorted below & above bounds of its alerts, plus alert id -> price_alert
+    """
+    def __init__(self,max_alerts=100_000):
+        """ Init
+        """
+        self.max_alerts = max_alerts
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.alerts = {} # alert id -> price_alert
+        self.below = {} # pool key -> sorted_bounds, fire when the canonical price is under the bound
+        self.above = {} # pool key -> sorted_bounds, fire when the canonical price is over the bound
+
+
+    def add(self,key,base_asset,quote_asset,lower,upper,stream_token=None,callback_url=None):
+        """ Registers an alert, returns it (with its id), None if the index is full
+        """
+        with self.lock:
+            if len(self.alerts) >= self.max_alerts:
+                return None
+            alert = price_alert(next(self.ids),key,base_asset,quote_asset,lower,upper,stream_token,callback_url)
+            below,above = alert.canonical_bounds()
+            if below is not None:
+                self.below.setdefault(key,sorted_bounds()).insert(below,alert.alert_id)
+            if above is not None:
+                self.above.setdefault(key,sorted_bounds()).insert(above,alert.alert_id)
+            self.alerts[alert.alert_id] = alert
+            return alert
+
+
+    def remove(self,alert_id):
+        """ Removes an alert, returns it, None if there's no such alert (e.g. it already fired)
+        """
+        with self.lock:
+            alert = self.alerts.get(alert_id)
+            if alert is not None:
+                self.remove_alert(alert)
+            return alert
+
+
+    def remove_alert(self,alert):
+        """ Removes an alert from the index
+            -must hold the lock
+        """
+        del self.alerts[alert.alert_id]
+        for bound,bounds in zip(alert.canonical_bounds(),(self.below,self.above)):
+            if bound is None:
+                continue
+            pool_bounds = bounds[alert.key]
+            pool_bounds.remove(bound,alert.alert_id)
+            if len(pool_bounds) == 0:
+                del bounds[alert.key]
+
+
+    def evaluate(self,key,price):
+        """ Returns the alerts of a pool triggered by its canonical price, removing them from the index
+        """
+        if price == -1:
+            return []
+        with self.lock:
+            alerts = []
+            below = self.below.get(key)
+            if below is not None: # bounds over the price, a suffix
+                start = bisect.bisect_right(below.bounds,price)
+                alerts += [self.alerts[alert_id] for alert_id in below.alert_ids[start:]]
+                del below.bounds[start:],below.alert_ids[start:]
+            above = self.above.get(key)
+            if above is not None: # bounds under the price, a prefix
+                end = bisect.bisect_left(above.bounds,price)
+                alerts += [self.alerts[alert_id] for alert_id in above.alert_ids[:end]]
+                del above.bounds[:end],above.alert_ids[:end]
+
+            # the triggered bounds are already gone, only the other bound of each alert is left to remove
+            for alert in alerts: # lower < upper, so an alert can't trigger twice
+                del self.alerts[alert.alert_id]
+                below_bound,above_bound = alert.canonical_bounds()
+                if below_bound is not None and below_bound <= price:
+                    below.remove(below_bound,alert.alert_id)
+                if above_bound is not None and above_bound >= price:
+                    above.remove(above_bound,alert.alert_id)
+            for bounds in (self.below,self.above):
+                if key in bounds and len(bounds[key]) == 0:
+                    del bounds[key]
+            return alerts
+
+
+    def pools(self):
+        """ Returns the keys of every pool with at least one alert
+        """
+        with self.lock:
+            return set(self.below)|set(self.above)
+
+
+    def has_alerts(self,key):
+        """ Whether a pool has at least one alert
+        """
+        with self.lock:
+            return key in self.below or key in self.above
+
+
+    def __len__(self):
+        return len(self.alerts)
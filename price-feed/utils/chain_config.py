@@ -0,0 +1,110 @@
+""" Per chain configuration: RPC endpoint, factories, multicall & the Chainlink feeds of the core tokens
+    -without CHAINS_CONFIG, the single chain is configured from the RPC/FACTORY_*/MULTICALL/WATCHLIST env
+     as before, named DEFAULT_CHAIN (default 'arbitrum')
+    -CHAINS_CONFIG is the path of a json file mapping chain name -> config, string values of the form
+     '$NAME' are read from the env, so RPC urls (which often hold API keys) can stay out of the file
+    -the chain name is the route prefix, e.g. /avalanche/v2_1/prices/..., so it can't clash with a route
+"""
+
+import os
+import json
+from dotenv import load_dotenv
+
+
+RESERVED_NAMES = ('v1','v2','v2_1','ready','chains','alerts','docs','redoc','openapi.json')
+
+# USDC and USDC.e use the same chainlink address, both used across pairs
+ARBITRUM_CHAINLINK_INFO = {
+    '0xaf88d065e77c8cC2239327C5EDb3A432268e5831':{'token_precision':1e6,'name':'USDC',
+                                                  'chainlink_address':'0x50834F3163758fcC1Df9973b6e91f0F0F0434aD3'},
+    '0xFF970A61A04b1cA14834A43f5dE4533eBDDB5CC8':{'token_precision':1e6,'name':'USDC.e',
+                                                  'chainlink_address':'0x50834F3163758fcC1Df9973b6e91f0F0F0434aD3'},
+    '0xFd086bC7CD5C481DCC9C85ebE478A1C0b69FCbb9':{'token_precision':1e6,'name':'USDT',
+                                                  'chainlink_address':'0x3f3f5dF88dC9F13eac63DF89EC16ef6e7E25DdE7'},
+    '0x82aF49447D8a07e3bd95BD0d56f35241523fBab1':{'token_precision':1e18,'name':'wETH',
+                                                  'chainlink_address':'0x639Fe6ab55C921f74e7fac1ee960C0B6293ba612'},
+}
+
+
+class chain_config:
+    """ Settings of a single chain, everything else (cache sizes, timeouts) is shared by every chain
+    """
+    def __init__(self,name,rpc,factory_v1,factory_v2,factory_v2_1,multicall,chainlink_info,
+                 rate_limit_per_min=100,watchlist=''):
+        """ Init
+        """
+        self.name = name
+        self.rpc = rpc
+        self.factory_v1 = factory_v1
+        self.factory_v2 = factory_v2
+        self.factory_v2_1 = factory_v2_1
+        self.multicall = multicall
+        self.chainlink_info = chainlink_info # core token -> {'token_precision','name','chainlink_address'}
+        self.rate_limit_per_min = rate_limit_per_min
+        self.watchlist = watchlist # same format as the WATCHLIST env
+
+
+def resolve_env(value):
+    """ Reads '$NAME' values from the env, other values are returned as is
+    """
+    if isinstance(value,str) and value.startswith('$'):
+        return os.getenv(value[1:])
+    return value
+
+
+def check_chain_name(name):
+    """ Raises ValueError if the chain name can't be used as a route prefix
+    """
+    if name in RESERVED_NAMES or name == "" or '/' in name:
+        raise ValueError("Chain name '{}' can't be used as a route prefix.".format(name))
+
+
+def default_chain_config():
+    """ Config of the single chain served when CHAINS_CONFIG isn't set, from the original env vars
+    """
+    name = os.getenv('DEFAULT_CHAIN','arbitrum')
+    check_chain_name(name)
+    return chain_config(name,os.getenv('RPC'),os.getenv('FACTORY_V1'),os.getenv('FACTORY_V2'),
+                        os.getenv('FACTORY_V2_1'),os.getenv('MULTICALL'),ARBITRUM_CHAINLINK_INFO,
+                        rate_limit_per_min=int(os.getenv('RATE_LIMIT_PER_MIN','100')),
+                        watchlist=os.getenv('WATCHLIST',''))
+
+
+def parse_chain_configs(configs):
+    """ Parses the chain name -> config mapping of CHAINS_CONFIG, returns a list of chain_config
+        -raises ValueError if a chain is missing a field or has a reserved name
+    """
+    chains = []
+    for name,config in configs.items():
+        check_chain_name(name)
+        try:
+            chainlink_info = {token:{'token_precision':float(info['token_precision']),'name':info['name'],
+                                     'chainlink_address':info['chainlink_address']}
+                              for token,info in config['chainlink'].items()}
+            chains.append(chain_config(name,resolve_env(config['rpc']),resolve_env(config['factory_v1']),
+                                       resolve_env(config['factory_v2']),resolve_env(config['factory_v2_1']),
+                                       resolve_env(config['multicall']),chainlink_info,
+                                       rate_limit_per_min=int(config.get('rate_limit_per_min',100)),
+                                       watchlist=resolve_env(config.get('watchlist','')) or ''))
+        except KeyError as e:
+            raise ValueError("Chain '{}' is missing {}.".format(name,e))
+    return chains
+
+
+def load_chain_configs():
+    """ Returns the config of every chain served, the first one is the default chain
+        -the default chain serves the unprefixed routes, it's DEFAULT_CHAIN if that's one of the chains
+    """
+    load_dotenv()
+    path = os.getenv('CHAINS_CONFIG','')
+    if path == "":
+        return [default_chain_config()]
+
+    with open(path) as f:
+        chains = parse_chain_configs(json.load(f))
+    if len(chains) == 0:
+        raise ValueError("CHAINS_CONFIG needs to define at least one chain.")
+
+    default = os.getenv('DEFAULT_CHAIN')
+    chains.sort(key=lambda chain:chain.name != default) # stable, so the file order is kept otherwise
+    return chains
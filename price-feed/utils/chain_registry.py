@@ -0,0 +1,57 @@
+""" Registry of the chains served by one process, each with its own tx_handler & rate limiter
+    -every chain has its own connection, caches (pool store, price cache, watchlist, valuation routes),
+     admission slots & rate budget, so a slow or busy chain doesn't affect the others
+    -what doesn't depend on the chain is shared: parsed abi(s) (see rpc_wrapper.load_abi), the codec &
+     the decoder process pool
+    -construction makes no RPC calls, same as tx_handler
+"""
+
+from utils.rpc_wrapper import tx_handler,default_decoder
+from utils.rate_limiter import rate_limiter
+from utils.chain_config import load_chain_configs
+
+
+class served_chain:
+    """ Handler & rate limiter of a chain
+    """
+    def __init__(self,config,handler,limiter):
+        """ Init
+        """
+        self.name = config.name
+        self.config = config
+        self.handler = handler
+        self.rate_limiter = limiter
+
+
+class chain_registry:
+    """ Chain name -> served_chain, the first chain is the default (served by the unprefixed routes)
+    """
+    def __init__(self,abi_path,configs=None):
+        """ Init
+            -configs is a list of chain_config, the chains configured by the env by default
+        """
+        configs = configs if configs is not None else load_chain_configs()
+        self.decoder = default_decoder() # shared by every chain
+        self.chains = {}
+        for config in configs:
+            if config.name in self.chains:
+                raise ValueError("Chain '{}' is configured twice.".format(config.name))
+            self.chains[config.name] = served_chain(config,tx_handler(abi_path,config,self.decoder),
+                                                    rate_limiter(config.rate_limit_per_min))
+        self.default = self.chains[configs[0].name]
+
+
+    def get(self,name):
+        """ Returns the served_chain of a chain, the default chain if name is None, None if it isn't served
+        """
+        if name is None:
+            return self.default
+        return self.chains.get(name)
+
+
+    def __iter__(self):
+        return iter(self.chains.values())
+
+
+    def __len__(self):
+        return len(self.chains)
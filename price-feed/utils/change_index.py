@@ -0,0 +1,66 @@
+""" Per-block index of the pools whose price changed, for 'changes since block N' requests
+    -the price cache records every pool whose canonical price (including -1, not enough liquidity)
+     changed or was first seen, under the block the new price was fetched at
+    -blocks are kept in ascending order, so the changes in a range of blocks are found by bisection &
+     cost is proportional to the no. changes rather than the no. pools
+    -only the last max_blocks blocks are kept, requests from before what the index covers (or from before
+     the server started) can't be answered with a delta & get a full response instead
+"""
+
+import bisect
+import threading
+
+
+class change_index:
+    """ Sorted block number -> set of pool keys (see watchlist.pool_key) whose price changed at that block
+    """
+    def __init__(self,max_blocks=10_000):
+        """ Init
+        """
+        self.max_blocks = max_blocks
+        self.lock = threading.Lock()
+        self.blocks = [] # ascending block numbers
+        self.changes = [] # set of pool keys, per block
+        self.covered_from = None # changes after this block are all in the index
+
+
+    def record(self,block_number,keys):
+        """ Records the pools whose price changed at a block
+        """
+        if len(keys) == 0:
+            return
+        with self.lock:
+            if self.covered_from is None: # nothing is known about the blocks before the first one recorded
+                self.covered_from = block_number-1
+
+            i = bisect.bisect_left(self.blocks,block_number)
+            if i < len(self.blocks) and self.blocks[i] == block_number:
+                self.changes[i].update(keys)
+            elif block_number > self.covered_from: # late recordings of evicted blocks are dropped
+                self.blocks.insert(i,block_number)
+                self.changes.insert(i,set(keys))
+
+            if len(self.blocks) > self.max_blocks:
+                evicted = len(self.blocks)-self.max_blocks
+                self.covered_from = self.blocks[evicted-1]
+                del self.blocks[:evicted]
+                del self.changes[:evicted]
+
+
+    def changed_between(self,since_block,until_block):
+        """ Returns the set of pools whose price changed after since_block, up to & including until_block
+            -returns None if the index doesn't cover every block after since_block
+        """
+        with self.lock:
+            if self.covered_from is None or since_block < self.covered_from:
+                return None
+            start = bisect.bisect_right(self.blocks,since_block)
+            end = bisect.bisect_right(self.blocks,until_block)
+            changed = set()
+            for keys in self.changes[start:end]:
+                changed.update(keys)
+            return changed
+
+
+    def __len__(self):
+        return len(self.blocks)
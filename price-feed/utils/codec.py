@@ -0,0 +1,92 @@
+""" Request/response encoding for the price endpoints
+    -responses are rendered with orjson, or with MessagePack when the client sends Accept: application/msgpack
+    -batch bodies (json or msgpack) are parsed straight into the three parallel lists, with
+     bin_steps packed into a compact uint16 array, skipping the per-field pydantic validation
+    -falls back to the standard json module if orjson isn't installed, msgpack is optional
+"""
+
+import json
+from array import array
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
+
+MSGPACK_MEDIA_TYPES = ('application/msgpack','application/x-msgpack')
+
+
+def is_msgpack(media_type):
+    """ Checks whether a Content-Type/Accept header value asks for MessagePack
+    """
+    return media_type is not None and any(t in media_type for t in MSGPACK_MEDIA_TYPES)
+
+
+def dumps_json(content):
+    """ Serializes content to json bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content,separators=(',',':')).encode('utf-8')
+
+
+def loads_json(body):
+    """ Parses json bytes
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+class fast_json_response(Response):
+    """ Default response class for the app, renders with orjson when available
+    """
+    media_type = 'application/json'
+
+    def render(self,content):
+        return dumps_json(content)
+
+
+def encode_response(request,content,status_code=200,headers=None):
+    """ Renders content in the format the client asked for through the Accept header
+    """
+    if is_msgpack(request.headers.get('accept')) and msgpack is not None:
+        return Response(content=msgpack.packb(content),status_code=status_code,
+                        headers=headers,media_type=MSGPACK_MEDIA_TYPES[0])
+    return fast_json_response(content=content,status_code=status_code,headers=headers)
+
+
+def decode_batch_body(body,content_type,with_bin_steps):
+    """ Parses a batch-prices body into (base_assets,quote_assets,bin_steps)
+        -bin_steps is None for v1 bodies
+        -raises ValueError if the body is malformed, the assets themselves are checked by tx_handler
+    """
+    use_msgpack = is_msgpack(content_type)
+    if use_msgpack and msgpack is None:
+        raise ValueError("MessagePack is not supported.")
+    try:
+        data = msgpack.unpackb(body) if use_msgpack else loads_json(body)
+    except Exception:
+        raise ValueError("Request body could not be decoded.")
+
+    if type(data) != dict or type(data.get('base_assets')) != list or type(data.get('quote_assets')) != list:
+        raise ValueError("Request body requires base_assets and quote_assets lists.")
+
+    if not with_bin_steps:
+        return data['base_assets'],data['quote_assets'],None
+
+    if type(data.get('bin_steps')) != list:
+        raise ValueError("Request body requires a bin_steps list.")
+    try:
+        bin_steps = array('H',data['bin_steps']) # bin steps are uint16 on-chain
+    except (TypeError,OverflowError):
+        raise ValueError("bin_steps need to be integers between 0 and 65535.")
+
+    return data['base_assets'],data['quote_assets'],bin_steps
@@ -0,0 +1,80 @@
+""" Block-based ETags for the price endpoints
+    -the ETag of a response is derived from the request & the latest block at which any of its pools'
+     prices changed (see price_cache.last_changed_block), so it only changes when a block changes the answer
+    -like tracing, tx_handler records the block through a contextvar bound to the current request
+    -requests answered from memory (watchlist, or the price cache within max_age) are checked against
+     If-None-Match without any RPC calls
+    -ETags are weak validators: responses with the same prices can still differ in their bytes (e.g. age,
+     block_number), so they're equivalent but not byte for byte identical
+"""
+
+import hashlib
+import contextvars
+
+
+current_version = contextvars.ContextVar('current_version',default=None)
+
+IGNORED_QUERY_PARAMS = ('trace','stream') # don't change the prices returned
+
+
+class response_version:
+    """ Block the prices of the current request last changed at
+    """
+    __slots__ = ('block_number',)
+
+    def __init__(self):
+        """ Init
+        """
+        self.block_number = None
+
+
+def start_versioning():
+    """ Starts versioning the current request, returns the version & the token needed to stop it
+    """
+    version = response_version()
+    return version,current_version.set(version)
+
+
+def finish_versioning(token):
+    """ Stops versioning the current request
+    """
+    current_version.reset(token)
+
+
+def record_version(block_number):
+    """ Records the block the current request's prices last changed at, no-op when not versioning
+    """
+    version = current_version.get()
+    if version is not None:
+        version.block_number = block_number
+
+
+def request_digest(method,path,query_params,accept,body):
+    """ Short hash identifying a request, including the representation asked for
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    query = sorted((key,value) for key,value in query_params.multi_items() if key not in IGNORED_QUERY_PARAMS)
+    for part in (method,path,repr(query),accept or ''):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def make_etag(block_number,digest):
+    """ ETag of a response, a weak validator as only the prices for a given block & request are fixed
+    """
+    return 'W/"{}-{}"'.format(block_number,digest)
+
+
+def etag_matches(if_none_match,etag):
+    """ Checks an If-None-Match header against an ETag, handling lists
+        -uses the weak comparison If-None-Match calls for, so the W/ prefix is ignored on both sides
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag[2:] if etag.startswith('W/') else etag
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return any((candidate[2:] if candidate.startswith('W/') else candidate) == opaque_tag for candidate in candidates)
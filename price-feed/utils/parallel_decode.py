@@ -0,0 +1,104 @@
+""" Decoding of multicall return data, optionally spread over a process pool for huge batches
+    -the calls batched by tx_handler all return static types, so each value is read straight out of its
+     32 byte word rather than going through abi.decode
+    -a layout describes what to read from every return value: a tuple of (word index,kind), with kind
+     'uint' or 'address', & decoding returns one column per entry
+    -addresses are returned as lowercase hex, checksums are left to the address registry which only
+     computes them the first time it sees an address
+    -above min_parallel_items (& with workers > 0), the return data is joined & written into shared memory
+     in one copy, & each worker is handed only the name of the block & the offsets of its contiguous slice,
+     which it reads through memoryviews without copying, the decoded columns are then merged in order
+    -the pool is off by default, tests/benchmarks.py compares it (parallel_decode_bin_reserves) with decoding
+     in process, it's only worth enabling where that shows a gain at the batch sizes served
+"""
+
+import math
+import threading
+import itertools
+from array import array
+from multiprocessing import get_context,shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+
+def decode_items(items,layout):
+    """ Decodes each item (bytes or memoryview) according to the layout, returns a list of columns
+    """
+    columns = [[] for _ in layout]
+    for item in items:
+        for column,(word,kind) in zip(columns,layout):
+            start = 32*word
+            if kind == 'address':
+                column.append('0x'+bytes(item[start+12:start+32]).hex())
+            else:
+                column.append(int.from_bytes(item[start:start+32],'big'))
+    return columns
+
+
+def decode_shared_slice(shm_name,offsets,layout):
+    """ Worker side, decodes the items between consecutive offsets of a shared memory block
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = shm.buf
+    try:
+        return decode_items((buffer[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)),layout)
+    finally:
+        del buffer # views need to be released before the block can be closed
+        shm.close()
+
+
+class abi_decoder:
+    """ Decodes multicall return data in process, or across a process pool for huge batches
+    """
+    def __init__(self,workers=0,min_parallel_items=20_000):
+        """ Init
+        """
+        self.workers = workers # 0 disables the process pool
+        self.min_parallel_items = min_parallel_items
+        self.pool = None # started on first use
+        self.pool_lock = threading.Lock()
+
+
+    def decode(self,items,layout):
+        """ Returns one column per layout entry, each with a value per item
+        """
+        if self.workers <= 0 or len(items) < self.min_parallel_items:
+            return decode_items(items,layout)
+        return self.decode_in_parallel(items,layout)
+
+
+    def decode_in_parallel(self,items,layout):
+        """ Writes the items into shared memory in one copy, then decodes contiguous slices of it in the pool
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,mp_context=get_context('spawn'))
+
+        data = b''.join(items)
+        offsets = array('Q',[0])
+        offsets.extend(itertools.accumulate(map(len,items)))
+
+        shm = shared_memory.SharedMemory(create=True,size=max(len(data),1))
+        try:
+            shm.buf[:len(data)] = data
+            del data
+
+            chunk_size = math.ceil(len(items)/self.workers)
+            futures = [self.pool.submit(decode_shared_slice,shm.name,offsets[start:start+chunk_size+1],layout)
+                       for start in range(0,len(items),chunk_size)]
+
+            columns = [[] for _ in layout]
+            for future in futures: # merged in order
+                for column,decoded in zip(columns,future.result()):
+                    column.extend(decoded)
+            return columns
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+    def shutdown(self):
+        """ Stops the process pool, if it was started
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,214 @@
+""" Columnar store of per pool state, the backing store of the in-memory caches (price cache, prefetch active ids)
+    -each pool is given a slot, & each field is a typed array indexed by slot, so a pool costs ~80 bytes
+     of machine values rather than a tuple of boxed python ints & floats
+    -pools are keyed the same way as the watchlist, see watchlist.pool_key, the key is canonical so the
+     base token is always tokenX & reserve_x belongs to the base token
+    -reserves are stored as doubles, they're only ever used in float arithmetic (prices & USD values)
+    -a field is only meaningful if its flag is set, e.g. v1 pools have no active id
+    -single pools are read into pool_state records (__slots__), many pools at once with snapshot
+    -when full, the least recently used 1/8 of the pools are evicted in one go, so updates stay O(1) amortised
+    -memory (tracemalloc, 50k v2_1 pools with price & active id): ~170 bytes per pool, against ~410 for the
+     OrderedDicts of tuples it replaced, so ~2.5x rather than an order of magnitude: the columns are ~75 bytes,
+     the rest is the dict from pool key to slot (key tuple, dict entry, slot int), which is kept so that
+     lookups from a pool key stay a single dict access, an array-backed hash table would save most of it
+     but probe in python on every lookup of the hot path
+"""
+
+import threading
+from array import array
+
+
+HAS_PRICE = 1
+HAS_ACTIVE_ID = 2
+HAS_RESERVES = 4
+
+# name -> (array typecode,value of an empty slot)
+COLUMNS = {
+    'price':('d',0.0), # canonical price, -1 if not enough liquidity
+    'block_number':('q',-1), # block the price was fetched at
+    'fetched_at':('d',0.0), # time the price was fetched at
+    'changed_block':('q',-1), # block the price last changed at
+    'active_id':('q',-1),
+    'bin_step':('H',0), # 0 for v1 pools
+    'reserve_x':('d',0.0),
+    'reserve_y':('d',0.0),
+    'state_block':('q',-1), # block the active id/reserves were read at
+    'flags':('B',0),
+}
+
+
+class pool_state:
+    """ Copy of the state of a single pool
+    """
+    __slots__ = ('key',)+tuple(COLUMNS)
+
+    def __init__(self,key,values):
+        """ Init
+        """
+        self.key = key
+        for name,value in zip(COLUMNS,values):
+            setattr(self,name,value)
+
+
+class pool_store:
+    """ Bounded columnar store of pool key -> pool state
+        -methods are thread safe, callers making several calls which need to be consistent hold lock
+    """
+    def __init__(self,max_size=100_000):
+        """ Init
+        """
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.slots = {} # key -> slot
+        self.keys = [] # slot -> key, None if free
+        self.free = [] # free slots
+        self.columns = {name:array(typecode) for name,(typecode,_) in COLUMNS.items()}
+        self.last_used = array('Q') # slot -> value of clock when last used, for eviction
+        self.clock = 0
+
+
+    def slot(self,key):
+        """ Returns the slot of a pool, None if it isn't stored
+        """
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.clock += 1
+                self.last_used[slot] = self.clock
+            return slot
+
+
+    def allocate(self,key):
+        """ Returns the slot of a pool, creating an empty one if it isn't stored
+        """
+        with self.lock:
+            slot = self.slot(key)
+            if slot is not None:
+                return slot
+
+            if len(self.slots) >= self.max_size:
+                self.evict(max(self.max_size//8,1))
+            if len(self.free) > 0:
+                slot = self.free.pop()
+                self.keys[slot] = key
+                for name,(_,empty) in COLUMNS.items():
+                    self.columns[name][slot] = empty
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                for name,(_,empty) in COLUMNS.items():
+                    self.columns[name].append(empty)
+                self.last_used.append(0)
+
+            self.slots[key] = slot
+            self.clock += 1
+            self.last_used[slot] = self.clock
+            return slot
+
+
+    def evict(self,count):
+        """ Frees the count least recently used slots
+            -must hold the lock
+        """
+        used = sorted(self.slots.values(),key=self.last_used.__getitem__)
+        for slot in used[:count]:
+            self.remove_slot(slot)
+
+
+    def remove(self,key):
+        """ Removes a pool, if it's stored
+        """
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.remove_slot(slot)
+
+
+    def remove_slot(self,slot):
+        """ Frees a slot
+            -must hold the lock
+        """
+        del self.slots[self.keys[slot]]
+        self.keys[slot] = None
+        self.columns['flags'][slot] = 0
+        self.free.append(slot)
+
+
+    def set_price(self,key,price,block_number,fetched_at,bin_step=None):
+        """ Stores the price of a pool, returns the block its price last changed at
+            -prices older than the stored one are ignored (e.g. a slow request finishing after a faster one),
+             so neither the price nor changed_block go back
+        """
+        with self.lock:
+            slot = self.allocate(key)
+            columns = self.columns
+            if columns['flags'][slot] & HAS_PRICE and block_number < columns['block_number'][slot]:
+                return columns['changed_block'][slot]
+            if not columns['flags'][slot] & HAS_PRICE or columns['price'][slot] != price:
+                columns['changed_block'][slot] = block_number
+            columns['price'][slot] = price
+            columns['block_number'][slot] = block_number
+            columns['fetched_at'][slot] = fetched_at
+            columns['bin_step'][slot] = bin_step or 0
+            columns['flags'][slot] |= HAS_PRICE
+            return columns['changed_block'][slot]
+
+
+    def set_active_id(self,key,active_id,block_number):
+        """ Stores the active id of a v2/v2_1 pool
+        """
+        with self.lock:
+            slot = self.allocate(key)
+            self.columns['active_id'][slot] = active_id
+            self.columns['state_block'][slot] = block_number
+            self.columns['flags'][slot] |= HAS_ACTIVE_ID
+
+
+    def set_reserves(self,key,reserve_x,reserve_y,block_number):
+        """ Stores the reserves of a v1 pool
+        """
+        with self.lock:
+            slot = self.allocate(key)
+            self.columns['reserve_x'][slot] = reserve_x
+            self.columns['reserve_y'][slot] = reserve_y
+            self.columns['state_block'][slot] = block_number
+            self.columns['flags'][slot] |= HAS_RESERVES
+
+
+    def get(self,key):
+        """ Returns a pool_state copy of a pool, None if it isn't stored
+        """
+        with self.lock:
+            slot = self.slot(key)
+            if slot is None:
+                return None
+            return pool_state(key,[self.columns[name][slot] for name in COLUMNS])
+
+
+    def snapshot(self,keys=None,names=None):
+        """ Bulk read, returns (keys,name -> values) for the given pools & columns (default all)
+            -for given keys, values are lists & pools which aren't stored have None for every value
+            -without keys, every slot is returned as copies of the columns (arrays), with None as the key
+             (& flags 0) for free slots
+        """
+        names = list(COLUMNS) if names is None else names
+        with self.lock:
+            if keys is None:
+                return list(self.keys),{name:array(self.columns[name].typecode,self.columns[name]) for name in names}
+
+            slots = [self.slots.get(key) for key in keys]
+            values = {}
+            for name in names:
+                column = self.columns[name]
+                values[name] = [column[slot] if slot is not None else None for slot in slots]
+            return keys,values
+
+
+    def nbytes(self):
+        """ Bytes used by the columns, excluding the key index
+        """
+        return sum(column.itemsize*len(column) for column in self.columns.values())+self.last_used.itemsize*len(self.last_used)
+
+
+    def __len__(self):
+        return len(self.slots)
@@ -0,0 +1,95 @@
+""" Cache of the latest canonical price of every pool, for stale-while-revalidate serving
+    -every price computed by the normal request path or the watchlist refresher is stored with the
+     block number & time it was fetched at
+    -clients opt into cached prices per request with a max staleness (max_age seconds and/or
+     max_blocks_behind the latest block seen), the request is then answered from memory & the pools
+     are refreshed in the background
+    -each entry also keeps the block at which its price last changed, which versions the price for
+     conditional requests (ETags)
+    -pools are keyed the same way as the watchlist, see watchlist.pool_key
+    -entries live in the shared pool_store, so are evicted along with the rest of the pool's state
+    -pools whose price changed are also recorded in the change index, if given, for delta requests
+"""
+
+import time
+from utils.watchlist import pool_key
+from utils.pool_store import pool_store,HAS_PRICE
+
+
+class price_cache:
+    """ Pool key -> (canonical price,block number,time fetched,block the price last changed at), kept in a pool_store
+    """
+    def __init__(self,store=None,changes=None):
+        """ Init
+        """
+        self.store = store if store is not None else pool_store()
+        self.changes = changes # change_index, or None
+        self.latest_block = 0 # highest block seen from the RPC
+
+
+    def update(self,version,base_tokens,quote_tokens,bin_steps,prices,block_number,fetched_at=None):
+        """ Stores the canonical prices of the given pools, tokens must be in canonical order
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        changed = []
+        with self.store.lock:
+            for i in range(len(base_tokens)):
+                bin_step = bin_steps[i] if bin_steps is not None else None
+                key = pool_key(version,base_tokens[i],quote_tokens[i],bin_step)
+                if self.store.set_price(key,prices[i],block_number,fetched_at,bin_step) == block_number:
+                    changed.append(key)
+        if self.changes is not None:
+            self.changes.record(block_number,changed)
+        self.observe_block(block_number)
+
+
+    def observe_block(self,block_number):
+        """ Records a block the RPC has returned, max_blocks_behind is measured against the latest one
+        """
+        if block_number is not None and block_number > self.latest_block:
+            self.latest_block = block_number
+
+
+    def lookup(self,version,base_tokens,quote_tokens,bin_steps,max_age=None,max_blocks_behind=None):
+        """ Returns (prices,time fetched,block number) if every pool is cached within the staleness bounds, else None
+            -the time & block returned are those of the oldest price used
+        """
+        now = time.time()
+        prices = []
+        oldest_fetched_at,oldest_block = now,None
+        columns = self.store.columns
+        with self.store.lock:
+            for i in range(len(base_tokens)):
+                bin_step = bin_steps[i] if bin_steps is not None else None
+                slot = self.store.slot(pool_key(version,base_tokens[i],quote_tokens[i],bin_step))
+                if slot is None or not columns['flags'][slot] & HAS_PRICE:
+                    return None
+
+                price,block_number,fetched_at = columns['price'][slot],columns['block_number'][slot],columns['fetched_at'][slot]
+                if max_age is not None and now-fetched_at > max_age:
+                    return None
+                if max_blocks_behind is not None and self.latest_block-block_number > max_blocks_behind:
+                    return None
+
+                prices.append(-1 if price == -1 else price) # stored as a double, -1 is returned as is
+                oldest_fetched_at = min(oldest_fetched_at,fetched_at)
+                oldest_block = block_number if oldest_block is None else min(oldest_block,block_number)
+
+        return prices,oldest_fetched_at,oldest_block
+
+
+    def last_changed_block(self,version,base_tokens,quote_tokens,bin_steps):
+        """ Returns the latest block at which any of the given pools' prices changed, None if any aren't cached
+            -this only moves forward when a price changes, so it versions the prices of the whole request
+        """
+        last_changed = None
+        columns = self.store.columns
+        with self.store.lock:
+            for i in range(len(base_tokens)):
+                bin_step = bin_steps[i] if bin_steps is not None else None
+                slot = self.store.slot(pool_key(version,base_tokens[i],quote_tokens[i],bin_step))
+                if slot is None or not columns['flags'][slot] & HAS_PRICE or columns['changed_block'][slot] < 0:
+                    return None
+                changed_block = columns['changed_block'][slot]
+                last_changed = changed_block if last_changed is None else max(last_changed,changed_block)
+        return last_changed
@@ -0,0 +1,79 @@
+""" Off-chain swap quotes for v2 & v2_1 (Liquidity Book) pools
+    -simulates a swap across a snapshot of bins, rather than calling the router's quoting functions
+     (each of which walks the bins on-chain), so any number of trade sizes share one fetch of state
+    -bins are (bin id,reserve_x,reserve_y,price) with price in tokenY per tokenX (raw units),
+     ordered from the active bin outwards in the direction of the swap
+    -swapping X for Y consumes the Y reserves of the active bin & moves down through lower bins,
+     swapping Y for X consumes X reserves & moves up
+    -only the static base fee is applied, the variable (volatility) fee is not modelled
+"""
+
+
+def get_base_fee(base_factor,bin_step):
+    """ Returns the base fee as a fraction of the amount in, as defined by the LB fee parameters
+    """
+    return base_factor*bin_step/1e8
+
+
+def quote_exact_in(bins,amount_in,swap_for_y,fee):
+    """ Simulates swapping amount_in (with fees) across the bins
+        -returns (amount_in_filled,amount_out,bins_crossed,complete)
+        -complete is False if the bins ran out of liquidity, in which case only amount_in_filled is swapped
+    """
+    amount_in_left = amount_in
+    amount_out = 0
+    bins_crossed = 0
+    for bin_id,reserve_x,reserve_y,price in bins:
+        reserve_out = reserve_y if swap_for_y else reserve_x
+        if reserve_out == 0:
+            continue
+
+        # max amount that can be swapped in this bin, before & after fees
+        max_amount_in = reserve_out/price if swap_for_y else reserve_out*price
+        max_amount_in_with_fees = max_amount_in/(1-fee)
+
+        if amount_in_left >= max_amount_in_with_fees: # bin is emptied, continue onto the next bin
+            amount_out += reserve_out
+            amount_in_left -= max_amount_in_with_fees
+            bins_crossed += 1
+        else:
+            amount_in_net = amount_in_left*(1-fee)
+            amount_out += amount_in_net*price if swap_for_y else amount_in_net/price
+            amount_in_left = 0
+            break
+
+    return amount_in-amount_in_left,amount_out,bins_crossed,amount_in_left == 0
+
+
+def quote_exact_out(bins,amount_out,swap_for_y,fee):
+    """ Simulates the amount in (with fees) required to receive amount_out across the bins
+        -returns (amount_in,amount_out_filled,bins_crossed,complete)
+        -complete is False if the bins ran out of liquidity, in which case only amount_out_filled is received
+    """
+    amount_out_left = amount_out
+    amount_in = 0
+    bins_crossed = 0
+    for bin_id,reserve_x,reserve_y,price in bins:
+        reserve_out = reserve_y if swap_for_y else reserve_x
+        if reserve_out == 0:
+            continue
+
+        amount_out_bin = min(amount_out_left,reserve_out)
+        amount_in_net = amount_out_bin/price if swap_for_y else amount_out_bin*price
+        amount_in += amount_in_net/(1-fee)
+        amount_out_left -= amount_out_bin
+
+        if amount_out_left == 0:
+            break
+        bins_crossed += 1
+
+    return amount_in,amount_out-amount_out_left,bins_crossed,amount_out_left == 0
+
+
+def get_price_impact(spot_price,amount_in,amount_out):
+    """ Relative difference between the execution price & the spot price (both in tokens out per token in)
+        -includes the fee paid
+    """
+    if amount_in == 0:
+        return 0.0
+    return 1-(amount_out/amount_in)/spot_price
@@ -1,99 +1,230 @@
 """ Wrapper for Web3py logic
     - all calls are wrapped into a Multicall function call
+    - batches are first reduced to their unique pools (repeated & inverted pairs are fetched once)
     - each API call (not checking price) involves 2 RPC requests: 
         1) first to determine whether the pairs exist
         2) then to get the info required to calculate the price of the pairs
     - the API component for checking min USD liquidity involves:
-        1) gather the prices of the core tokens (USDC,USDT,ETH)
+        1) gather the prices of the core tokens (USDC,USDT,ETH), these are cached for a few seconds
+            - other tokens are valued through routes of known liquid pools to a core token (valuation_graph)
             - for v1 pools, this is the only call required
-        2) for v2/v2_1 pools loop through to get reserves for +/- 5 closest bins
-            - this entails one extra call per requested base/quote pair
+        2) for v2/v2_1 pools get reserves for the +/- bin_window closest bins of every pair (5 for prices)
+            - this entails one extra call, shared by all requested base/quote pairs
+            - pairs seen before have these bins prefetched around their last known active id, in the same
+              call as their state, so the extra call is only needed for pairs whose active id moved
 """
 
 import os
 import json
 import time
+import threading
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from web3 import Web3
 from eth_abi import abi
 from dotenv import load_dotenv
 from web3.middleware import geth_poa_middleware
 from web3.middleware import validation
+from utils.tracer import trace_stage,record_rpc_call,record_cache
+from utils.address_registry import address_registry
+from utils.valuation_graph import valuation_graph
+from utils.watchlist import watchlist,watched_pool,parse_watchlist,pool_key
+from utils.price_cache import price_cache
+from utils.change_index import change_index
+from utils.pool_store import pool_store,HAS_ACTIVE_ID
+from utils.admission import admission_controller,admit
+from utils.etag import record_version
+from utils.parallel_decode import abi_decoder
+from utils.chain_config import default_chain_config
+from utils.alert_index import alert_index
+from utils.alert_delivery import alert_delivery
+from utils.quote_engine import get_base_fee,quote_exact_in,quote_exact_out,get_price_impact
 validation.METHODS_TO_VALIDATE = [] # removes the chainId validation, to reduce no. calls
 
 
+@lru_cache(maxsize=None)
+def load_abi(abi_path,file_name):
+    """ Parses an abi file, the result is shared by every tx_handler in the process
+    """
+    with open(abi_path+file_name) as f:
+        return json.load(f)
+
+
+def default_decoder():
+    """ Decoder configured by the env, see utils.parallel_decode
+    """
+    return abi_decoder(workers=int(os.getenv('PARALLEL_DECODE_WORKERS','0')),
+                       min_parallel_items=int(os.getenv('PARALLEL_DECODE_MIN_ITEMS','20000')))
+
+
 class tx_handler:
     """ Logic for interacting with RPC endpoint
+        -construction is cheap & makes no RPC calls, the contracts are built on first use (or via connect)
+        -warm_up is what actually reaches out to the RPC, marking the handler as ready on success
     """
-    def __init__(self,abi_path):
+    def __init__(self,abi_path,chain=None,decoder=None):
         """ Init
+            -chain is a chain_config, the chain configured by the env (see utils.chain_config) by default
+            -decoder can be shared by the handlers of several chains, so they use one process pool
         """
-        self.gather_and_instantiate_contracts(abi_path)
+        load_dotenv()
+        self.abi_path = abi_path
+        self.chain = chain if chain is not None else default_chain_config()
         self.address_zero = '0x0000000000000000000000000000000000000000'
+        self.connect_lock = threading.Lock()
+        self.connected = False # contracts have been instantiated
+        self.ready = False # a call to the RPC has succeeded & the caches are warm
+
+        self.core_prices_ttl = float(os.getenv('CORE_PRICES_TTL','10')) # chainlink answers change slowly, so are cached briefly
+        self.core_prices_cache = None # (time fetched,prices)
+
+        self.chainlink_info = self.chain.chainlink_info
+
+        # interned addresses, so checksums are computed once & token ordering/core membership are integer checks
+        registry_size = int(os.getenv('ADDRESS_REGISTRY_SIZE','100000'))
+        self.tokens = address_registry(self.chainlink_info.keys(),registry_size)
+        self.pairs = address_registry((),registry_size)
+
+        # USD routes for tokens without a chainlink price, learned from pools which pass the liquidity checks
+        self.valuation_graph = valuation_graph([int(token,16) for token in self.chainlink_info],
+                                               max_hops=int(os.getenv('VALUATION_MAX_HOPS','3')),
+                                               ttl=float(os.getenv('VALUATION_GRAPH_TTL','10')))
+
+        # hot pools refreshed in the background & served from memory, see refresh_watchlist
+        self.watchlist = watchlist(max_learned=int(os.getenv('WATCHLIST_SIZE','50')),
+                                   min_hits=int(os.getenv('WATCHLIST_MIN_HITS','3')),
+                                   max_age=float(os.getenv('WATCHLIST_MAX_AGE','5')),
+                                   learn_interval=float(os.getenv('WATCHLIST_LEARN_INTERVAL','60')),
+                                   max_tracked=int(os.getenv('WATCHLIST_MAX_TRACKED','10000')))
+        for version,token_a,token_b,bin_step in parse_watchlist(self.chain.watchlist):
+            token_a,token_b = sorted([self.tokens.intern(token_a),self.tokens.intern(token_b)],key=lambda t:t.value)
+            self.watchlist.add_configured(version,token_a,token_b,bin_step)
+
+        # state of every pool seen (price, active id, reserves), the backing store of the caches below
+        self.pool_store = pool_store(int(os.getenv('PRICE_CACHE_SIZE','100000')))
+
+        # latest prices of every pool, served to requests which accept a bounded staleness
+        self.change_index = change_index(int(os.getenv('CHANGE_INDEX_BLOCKS','10000')))
+        self.price_cache = price_cache(self.pool_store,self.change_index)
+        self.revalidate_executor = ThreadPoolExecutor(max_workers=int(os.getenv('REVALIDATE_WORKERS','4')),
+                                                      thread_name_prefix='revalidate')
+        self.revalidating = set() # requests currently being refreshed in the background
+        self.revalidate_lock = threading.Lock()
+        self.call_state = threading.local() # block number of the last multicall made by the current thread
+
+        # the bins around the last known active id of each v2 & v2_1 pair are read along with the pair's state
+        self.bin_prefetch_margin = int(os.getenv('BIN_PREFETCH_MARGIN','3')) # negative disables prefetching
+
+        # decoding of the return data of huge batches can be spread over a process pool
+        self.decoder = decoder if decoder is not None else default_decoder()
+
+        # price-threshold alerts, evaluated by the watchlist refresher & pushed to streams or webhooks
+        self.alerts = alert_index(max_alerts=int(os.getenv('ALERT_MAX','100000')))
+        self.alert_watch_lock = threading.Lock() # keeps a pool watched iff it has alerts
+        self.alert_delivery = alert_delivery(buffer_size=int(os.getenv('ALERT_BUFFER_SIZE','1000')),
+                                             webhook_timeout=float(os.getenv('ALERT_WEBHOOK_TIMEOUT','5')),
+                                             allowed_hosts=[host.strip() for host in
+                                                            os.getenv('ALERT_WEBHOOK_ALLOWED_HOSTS','').split(',')
+                                                            if host.strip() != ""])
+
+        # caps the no. requests doing RPC work at once, see utils.admission
+        self.admission = admission_controller(max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT','16')),
+                                              max_queue=int(os.getenv('ADMISSION_MAX_QUEUE','16')))
+
+
+    def connect(self):
+        """ Instantiates the contracts if this hasn't been done yet, safe to call from any thread
+            -doesn't make any RPC calls, so can't fail if the RPC is briefly unavailable
+        """
+        if self.connected:
+            return
+        with self.connect_lock:
+            if not self.connected:
+                self.gather_and_instantiate_contracts(self.abi_path)
+                self.connected = True
 
-        self.chainlink_info = { # USDC and USDC.e use the same chainlink address, both used across pairs
-            '0xaf88d065e77c8cC2239327C5EDb3A432268e5831':{'token_precision':1e6,'name':'USDC',
-                                                          'chainlink_address':'0x50834F3163758fcC1Df9973b6e91f0F0F0434aD3'},
-            '0xFF970A61A04b1cA14834A43f5dE4533eBDDB5CC8':{'token_precision':1e6,'name':'USDC.e',
-                                                          'chainlink_address':'0x50834F3163758fcC1Df9973b6e91f0F0F0434aD3'},
-            '0xFd086bC7CD5C481DCC9C85ebE478A1C0b69FCbb9':{'token_precision':1e6,'name':'USDT',
-                                                          'chainlink_address':'0x3f3f5dF88dC9F13eac63DF89EC16ef6e7E25DdE7'},
-            '0x82aF49447D8a07e3bd95BD0d56f35241523fBab1':{'token_precision':1e18,'name':'wETH',
-                                                          'chainlink_address':'0x639Fe6ab55C921f74e7fac1ee960C0B6293ba612'},
-        }
+
+    def warm_up(self):
+        """ Makes the first RPC call (gathering the core token prices), marks the handler as ready on success
+            -raises if the RPC is unreachable, callers are expected to retry
+        """
+        self.connect()
+        self.gather_core_usd_prices()
+        self.ready = True
 
 
     def gather_and_instantiate_contracts(self,abi_path):
         """ Gathers all the contract abi(s) and instantiates the factory + multicall contracts
+            -abi(s) are parsed once per process, & calls without arguments are encoded once here
         """
         # instantiating the connection to RPC endpoint
-        load_dotenv()
-        rpc = os.getenv('RPC')
-        self.w3 = Web3(Web3.HTTPProvider(rpc))
+        self.w3 = Web3(Web3.HTTPProvider(self.chain.rpc))
         self.w3.middleware_onion.inject(geth_poa_middleware,layer=0)
-        assert(self.w3.isConnected() == True)
 
         # instantiating factory contracts & multicall
-        joe_v2_factory_abi = json.load(open(abi_path+"JoeV2Factory.json"))
-        self.joe_v2_factory = self.w3.eth.contract(address=os.getenv('FACTORY_V2'),abi=joe_v2_factory_abi)
-        self.joe_v2_1_factory = self.w3.eth.contract(address=os.getenv('FACTORY_V2_1'),abi=joe_v2_factory_abi)
+        joe_v2_factory_abi = load_abi(abi_path,"JoeV2Factory.json")
+        self.joe_v2_factory = self.w3.eth.contract(address=self.chain.factory_v2,abi=joe_v2_factory_abi)
+        self.joe_v2_1_factory = self.w3.eth.contract(address=self.chain.factory_v2_1,abi=joe_v2_factory_abi)
 
-        joe_v1_factory_abi = json.load(open(abi_path+"JoeV1Factory.json"))
-        self.joe_v1_factory = self.w3.eth.contract(address=os.getenv('FACTORY_V1'),abi=joe_v1_factory_abi)
+        joe_v1_factory_abi = load_abi(abi_path,"JoeV1Factory.json")
+        self.joe_v1_factory = self.w3.eth.contract(address=self.chain.factory_v1,abi=joe_v1_factory_abi)
 
-        multicall_abi = json.load(open(abi_path+"Multicall.json"))
-        self.multicall = self.w3.eth.contract(address=os.getenv('MULTICALL'),abi=multicall_abi)
+        multicall_abi = load_abi(abi_path,"Multicall.json")
+        self.multicall = self.w3.eth.contract(address=self.chain.multicall,abi=multicall_abi)
 
         # pair addresses are used to encode abi
-        lb_pair_v2_abi = json.load(open(abi_path+"LBPairV2.json"))
+        lb_pair_v2_abi = load_abi(abi_path,"LBPairV2.json")
         self.lb_pair_v2 = self.w3.eth.contract(abi=lb_pair_v2_abi)
 
-        lb_pair_v2_1_abi = json.load(open(abi_path+"LBPairV2_1.json"))
+        lb_pair_v2_1_abi = load_abi(abi_path,"LBPairV2_1.json")
         self.lb_pair_v2_1 = self.w3.eth.contract(abi=lb_pair_v2_1_abi)
 
-        joe_pair_abi = json.load(open(abi_path+"JoePair.json"))
+        joe_pair_abi = load_abi(abi_path,"JoePair.json")
         self.joe_pair = self.w3.eth.contract(abi=joe_pair_abi)
 
-        chainlink_abi = json.load(open(abi_path+"Chainlink.json"))
+        chainlink_abi = load_abi(abi_path,"Chainlink.json")
         self.chainlink_feed = self.w3.eth.contract(abi=chainlink_abi)
 
+        # call data which is the same for every request
+        self.reserves_and_id_call = self.lb_pair_v2.encodeABI(fn_name="getReservesAndId",args=[])
+        self.active_id_call = self.lb_pair_v2_1.encodeABI(fn_name="getActiveId",args=[])
+        self.get_reserves_call = self.joe_pair.encodeABI(fn_name="getReserves",args=[])
+        self.latest_answer_call = self.chainlink_feed.encodeABI(fn_name="latestAnswer",args=[])
+        self.v2_fee_parameters_call = self.lb_pair_v2.encodeABI(fn_name="feeParameters",args=[])
+        self.v2_1_static_fee_parameters_call = self.lb_pair_v2_1.encodeABI(fn_name="getStaticFeeParameters",args=[])
+        self.get_bin_selector = self.lb_pair_v2.encodeABI(fn_name="getBin",args=[0])[:10] # same for v2/v2_1
+        self.oracle_parameters_call = self.lb_pair_v2_1.encodeABI(fn_name="getOracleParameters",args=[])
+        self.oracle_sample_selector = self.lb_pair_v2_1.encodeABI(fn_name="getOracleSampleAt",args=[0])[:10]
+        self.block_timestamp_call = self.multicall.encodeABI(fn_name="getCurrentBlockTimestamp",args=[])
+
 
     def attempt_multicall_request(self,multicall_inputs):
         """ Calls the multicall contract with inputs, attempts call 2 more times if failure
+            -output is (block number,return data), successful calls are recorded on the request trace
+            -the request must first be admitted, raises overloaded_error if it isn't
         """
+        with trace_stage('admission'):
+            admit(self.admission)
         try:
-            return self.multicall.functions.aggregate(multicall_inputs).call()
+            multicall_output = self.multicall.functions.aggregate(multicall_inputs).call()
         except:
             time.sleep(1)
             try:
-                return self.multicall.functions.aggregate(multicall_inputs).call()
+                multicall_output = self.multicall.functions.aggregate(multicall_inputs).call()
             except:
                 time.sleep(3)
-                return self.multicall.functions.aggregate(multicall_inputs).call()
+                multicall_output = self.multicall.functions.aggregate(multicall_inputs).call()
+
+        record_rpc_call(len(multicall_inputs),multicall_output[0])
+        self.call_state.block_number = multicall_output[0]
+        self.price_cache.observe_block(multicall_output[0])
+        return multicall_output
 
 
     def check_valid_v2_inputs(self,base_assets,quote_assets,bin_steps):
         """ Checks whether user inputs are valid for the call they are attempting for v2 & v2_1 pools
-            -return error string if there is an error, else empty string
+            -return error string if there is an error, else the interned (base_tokens,quote_tokens)
         """
         if len(base_assets) != len(quote_assets) or len(quote_assets) != len(bin_steps): # check equal len
             return "Length of base_assets, quote_assets, and bin_steps needs to be equal."
@@ -104,22 +235,71 @@ class tx_handler:
     def check_valid_v1_inputs(self,base_assets,quote_assets):
         """ Checks whether user inputs are valid for the call they are attempting for v1 pools
         """
+        if len(base_assets) != len(quote_assets): # check equal len
+            return "Length of base_assets and quote_assets needs to be equal."
+
         return self.check_valid_inputs(base_assets,quote_assets)
 
 
     def check_valid_inputs(self,base_assets,quote_assets):
         """ Generic validation checks for both v1 and v2/v2_1 pools
+            -interns each asset, which gives its checksum address without modifying the caller's lists
         """
+        all_tokens = []
         for assets in [base_assets,quote_assets]: # check address formatting
+            tokens = []
             for asset in assets:
                 if type(asset)!=str or len(asset)!=42 or asset==self.address_zero:
                     return "Asset addresses are incorrectly formatted."
+                try:
+                    tokens.append(self.tokens.intern(asset))
+                except ValueError: # not hex
+                    return "Asset addresses are incorrectly formatted."
+            all_tokens.append(tokens)
 
-        for assets in [base_assets,quote_assets]: # ensure addresses are checksum
-            for i in range(len(assets)):
-                assets[i] = Web3.toChecksumAddress(assets[i])
+        return tuple(all_tokens)
 
-        return ""
+
+    def plan_unique_pools(self,base_tokens,quote_tokens,bin_steps=None):
+        """ Reduces a batch to its unique pools, so repeated & inverted pairs are only fetched once
+            -each unique pool is requested in its canonical direction, with tokenX (the 'smaller' address) as base
+            -returns the unique (base_tokens,quote_tokens,bin_steps) & the plan used to fill in the batch,
+             which is (unique pool index,whether the price needs inverting) per requested pair
+            -bin_steps is None for v1 pools
+        """
+        unique_indexes = {} # (tokenX id,tokenY id,bin step) -> index into the unique lists
+        unique_base_tokens,unique_quote_tokens,unique_bin_steps = [],[],[]
+        request_plan = []
+        for i in range(len(base_tokens)):
+            inverted = base_tokens[i].value > quote_tokens[i].value
+            token_x,token_y = (quote_tokens[i],base_tokens[i]) if inverted else (base_tokens[i],quote_tokens[i])
+            bin_step = bin_steps[i] if bin_steps is not None else None
+
+            key = (token_x.id,token_y.id,bin_step)
+            index = unique_indexes.get(key)
+            if index is None:
+                index = unique_indexes[key] = len(unique_base_tokens)
+                unique_base_tokens.append(token_x)
+                unique_quote_tokens.append(token_y)
+                unique_bin_steps.append(bin_step)
+            request_plan.append((index,inverted))
+
+        return (unique_base_tokens,unique_quote_tokens,
+                unique_bin_steps if bin_steps is not None else None,request_plan)
+
+
+    def fill_planned_prices(self,unique_prices,request_plan):
+        """ Expands the prices of the unique pools back out to every requested pair, in request order
+            -prices of -1 (not enough liquidity) stay -1 when inverted
+        """
+        prices = []
+        for index,inverted in request_plan:
+            price = unique_prices[index]
+            if inverted and price != -1:
+                price = price ** -1
+            prices.append(price)
+
+        return prices
 
 
     def calculate_lb_pool_price(self,active_id,bin_step):
@@ -129,28 +309,28 @@ class tx_handler:
         return (1 + bin_step / 10_000) ** (active_id - 8388608)
 
 
-    def return_v2_and_v2_1_prices(self,base_assets,quote_assets,bin_steps,all_pair_active_ids):
+    def return_v2_and_v2_1_prices(self,base_tokens,quote_tokens,bin_steps,all_pair_active_ids):
         """ Returns the price for v2 and v2_1 pools, based on active bin id & token ordering
             -by default the 'smaller' address is used as the denominator for pool price calc.
             -therefore simply need to check if the smaller address is the base asset (done)
             -on the other hand, if base asset address is 'larger', then need to invert price
         """
         prices = []
-        for i in range(len(base_assets)):
+        for i in range(len(base_tokens)):
             price = self.calculate_lb_pool_price(all_pair_active_ids[i],bin_steps[i])
-            if base_assets[i].lower() > quote_assets[i].lower(): # determine if price needs to be swapped
+            if base_tokens[i].value > quote_tokens[i].value: # determine if price needs to be swapped
                 price = price ** -1
             prices.append(price)
 
         return prices
 
 
-    def return_v1_prices(self,base_assets,quote_assets,all_pair_reserves):
+    def return_v1_prices(self,base_tokens,quote_tokens,all_pair_reserves):
         """ Returns the price for v1 pools, simply the ratio of the token reserves
         """
         prices = []
-        for i in range(len(base_assets)):
-            if base_assets[i].lower() < quote_assets[i].lower():
+        for i in range(len(base_tokens)):
+            if base_tokens[i].value < quote_tokens[i].value:
                 prices.append(all_pair_reserves[i][1]/all_pair_reserves[i][0])
             else:
                 prices.append(all_pair_reserves[i][0]/all_pair_reserves[i][1])
@@ -158,55 +338,153 @@ class tx_handler:
         return prices
 
 
-    def gather_v1_pair_addresses(self,base_assets,quote_assets):
+    def gather_v1_pair_addresses(self,base_tokens,quote_tokens):
         """ Logic for gathering the pair addresses for v1 pools
         """
         # gather all of the addresses of the pairs specified by the user
         multicall_input = []
-        for i in range(len(base_assets)):
+        for i in range(len(base_tokens)):
             abi_encoding = self.joe_v1_factory.encodeABI(fn_name="getPair",
-                                                         args=[base_assets[i],quote_assets[i]])
+                                                         args=[base_tokens[i].address,quote_tokens[i].address])
             multicall_input.append([self.joe_v1_factory.address,abi_encoding])
         
         multicall_output = self.attempt_multicall_request(multicall_input)
 
         # determine whether all pairs are valid by getting pair address
-        all_pair_addresses = [] # indiv pairs requested prices for
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['address'],multicall_output[1][i])
-            decoded_address = decoding[0]
-            if decoded_address == self.address_zero: # check if requested pair exists
-                return {'status':'ERROR','output':'At least one pair specified does not exist.'}
-            all_pair_addresses.append(Web3.toChecksumAddress(decoded_address)) # not checksum by default
-
-        return all_pair_addresses
+        with trace_stage('decode_pair_addresses'):
+            decoded_addresses = self.decoder.decode(multicall_output[1],((0,'address'),))[0]
+        return self.intern_pair_addresses(decoded_addresses)
 
 
-    def gather_v2_and_v2_1_pair_addresses(self,base_assets,quote_assets,bin_steps,factory_address):
+    def gather_v2_and_v2_1_pair_addresses(self,base_tokens,quote_tokens,bin_steps,factory_address):
         """ Logic for gathering pair addresses, is the same for both v2 and v2_1
         """
         # gather all of the addresses of the pairs specified by the user
         multicall_input = []
-        for i in range(len(base_assets)):
+        for i in range(len(base_tokens)):
             abi_encoding = self.joe_v2_factory.encodeABI(fn_name="getLBPairInformation",
-                                                         args=[base_assets[i],quote_assets[i],bin_steps[i]])
+                                                         args=[base_tokens[i].address,quote_tokens[i].address,
+                                                               bin_steps[i]])
             multicall_input.append([factory_address,abi_encoding])
         
         multicall_output = self.attempt_multicall_request(multicall_input)
 
-        # determine whether all pairs are valid by getting pair address
+        # determine whether all pairs are valid by getting pair address, (binStep,LBPair,createdByOwner,ignored)
+        with trace_stage('decode_pair_addresses'):
+            decoded_addresses = self.decoder.decode(multicall_output[1],((1,'address'),))[0]
+        return self.intern_pair_addresses(decoded_addresses)
+
+
+    def intern_pair_addresses(self,decoded_addresses):
+        """ Interns the decoded pair addresses, returns an error if any pair doesn't exist
+        """
         all_pair_addresses = [] # indiv pairs requested prices for
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['uint16','address','bool','bool'],multicall_output[1][i])
-            decoded_address = decoding[1]
+        for decoded_address in decoded_addresses:
             if decoded_address == self.address_zero: # check if requested pair exists
                 return {'status':'ERROR','output':'At least one pair specified does not exist.'}
-            all_pair_addresses.append(Web3.toChecksumAddress(decoded_address)) # not checksum by default
+            all_pair_addresses.append(self.pairs.intern(decoded_address).address) # not checksum by default
 
         return all_pair_addresses
 
 
-    def handle_v2_requests(self,base_assets,quote_assets,bin_steps):
+    def gather_v2_and_v2_1_active_ids(self,all_pair_addresses,is_v2_1):
+        """ Gathers the active bin id of each pair, which determines the current price
+            -v2 pairs expose this through getReservesAndId, v2_1 pairs through getActiveId
+        """
+        active_id_call = self.active_id_call if is_v2_1 else self.reserves_and_id_call
+
+        multicall_input = []
+        for pair_address in all_pair_addresses:
+            multicall_input.append([pair_address,active_id_call])
+
+        multicall_output = self.attempt_multicall_request(multicall_input)
+
+        # decoding pair info from multicall, getActiveId is (activeId), getReservesAndId is (reserveX,reserveY,activeId)
+        with trace_stage('decode_active_ids'):
+            return self.decoder.decode(multicall_output[1],((0,'uint'),) if is_v2_1 else ((2,'uint'),))[0]
+
+
+    def gather_v2_and_v2_1_pair_state(self,version,base_tokens,quote_tokens,bin_steps,all_pair_addresses,bin_window=5):
+        """ Gathers the active id of each pair, speculatively along with the bins its liquidity check needs
+            -for pairs with a known active id (& a token which can be valued in USD), the bins within
+             bin_window+bin_prefetch_margin of that id are read in the same multicall as the active ids
+            -pairs whose active id moved by more than the margin have their bins gathered by the liquidity check
+            -returns (active ids,per pair dict of bin id -> (reserve_x,reserve_y), None if nothing was prefetched)
+        """
+        is_v2_1 = version == 'v2_1'
+        keys = [pool_key(version,base_tokens[i],quote_tokens[i],bin_steps[i]) for i in range(len(base_tokens))]
+        last_active_ids = self.last_active_ids(keys)
+        if self.bin_prefetch_margin < 0 or all(active_id is None for active_id in last_active_ids):
+            all_pair_active_ids = self.gather_v2_and_v2_1_active_ids(all_pair_addresses,is_v2_1)
+            self.remember_active_ids(keys,all_pair_active_ids)
+            return all_pair_active_ids,[None]*len(all_pair_addresses)
+
+        with trace_stage('gather_core_usd_prices'):
+            usd_rates = self.gather_usd_rates()
+        spread = bin_window+self.bin_prefetch_margin
+        active_id_call = self.active_id_call if is_v2_1 else self.reserves_and_id_call
+
+        multicall_input = []
+        for pair_address in all_pair_addresses:
+            multicall_input.append([pair_address,active_id_call])
+        prefetched = [] # (pair index,first bin id prefetched)
+        for i,active_id in enumerate(last_active_ids):
+            if active_id is None or (base_tokens[i].value not in usd_rates and quote_tokens[i].value not in usd_rates):
+                continue # the pair won't need a liquidity check
+            prefetched.append((i,active_id-spread))
+            for bin_id in range(active_id-spread,active_id+spread+1):
+                multicall_input.append([all_pair_addresses[i],self.encode_get_bin_call(bin_id)])
+
+        multicall_output = self.attempt_multicall_request(multicall_input)
+        outputs = multicall_output[1]
+
+        with trace_stage('decode_active_ids'):
+            all_pair_active_ids = self.decoder.decode(outputs[:len(all_pair_addresses)],
+                                                      ((0,'uint'),) if is_v2_1 else ((2,'uint'),))[0]
+        with trace_stage('decode_bin_reserves'):
+            all_reserves_x,all_reserves_y = self.decoder.decode(outputs[len(all_pair_addresses):],
+                                                                ((0,'uint'),(1,'uint')))
+
+        all_prefetched_bins = [None]*len(all_pair_addresses)
+        j = 0
+        for i,first_bin_id in prefetched:
+            bin_ids = range(first_bin_id,first_bin_id+2*spread+1)
+            all_prefetched_bins[i] = dict(zip(bin_ids,zip(all_reserves_x[j:j+len(bin_ids)],
+                                                          all_reserves_y[j:j+len(bin_ids)])))
+            record_cache('bin_prefetch',abs(all_pair_active_ids[i]-last_active_ids[i]) <= self.bin_prefetch_margin)
+            j += len(bin_ids)
+
+        self.remember_active_ids(keys,all_pair_active_ids)
+        return all_pair_active_ids,all_prefetched_bins
+
+
+    def last_active_ids(self,keys):
+        """ Returns the last known active id of each (canonical) pool, None if it isn't known
+        """
+        _,state = self.pool_store.snapshot(keys,('active_id','flags'))
+        return [active_id if flags is not None and flags & HAS_ACTIVE_ID else None
+                for active_id,flags in zip(state['active_id'],state['flags'])]
+
+
+    def remember_active_ids(self,keys,all_pair_active_ids):
+        """ Records the latest active id of each (canonical) pool, which the next request prefetches bins around
+        """
+        block_number = self.call_state.block_number
+        with self.pool_store.lock:
+            for key,active_id in zip(keys,all_pair_active_ids):
+                self.pool_store.set_active_id(key,active_id,block_number)
+
+
+    def remember_v1_reserves(self,keys,all_pair_reserves):
+        """ Records the latest reserves of each (canonical) v1 pool, the base token is token0 (reserve_x)
+        """
+        block_number = self.call_state.block_number
+        with self.pool_store.lock:
+            for key,reserves in zip(keys,all_pair_reserves):
+                self.pool_store.set_reserves(key,reserves[0],reserves[1],block_number)
+
+
+    def handle_v2_requests(self,base_assets,quote_assets,bin_steps,max_age=None,max_blocks_behind=None):
         """ Handles n-number of requests for getting prices of v2 pools
             -returns an error if any of the pools requested don't exist
 
@@ -214,49 +492,66 @@ class tx_handler:
             base_assets (list): addresses of the base assets
             quote_assets (list): addresses of the quote assets
             bin_steps (list): sizes of the bins for the pairs
+            max_age (float): if set, cached prices up to this many seconds old are accepted
+            max_blocks_behind (int): if set, cached prices up to this many blocks behind are accepted
 
         Returns:
             List of amount of quote currency is required to get one unit of base currency
             -returns -1 for the price if pool doesn't have enough liquidity in local bins
+            -if a staleness bound is given, also returns the age & block number of the (oldest) price
         """
-        validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps) # check params
-        if validity != "":
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_staleness(max_age,max_blocks_behind) # check params
+            if validity == "":
+                validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps)
+        if type(validity)==str:
             return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        # reduce the batch to its unique pools, each is fetched once in its canonical direction
+        requested_bin_steps = bin_steps # the caller's, used as is for background revalidation
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,bin_steps,request_plan = self.plan_unique_pools(base_tokens,quote_tokens,bin_steps)
+
+        # hot pools are served from the watchlist snapshot, others from the price cache if the client allows
+        report_age = max_age is not None or max_blocks_behind is not None
+        pools = ('v2',base_tokens,quote_tokens,bin_steps)
+        with trace_stage('lookup_cached_prices'):
+            cached = self.lookup_cached_prices('v2',base_tokens,quote_tokens,bin_steps,max_age,max_blocks_behind,
+                                               self.handle_v2_requests,base_assets,quote_assets,requested_bin_steps)
+        if cached is not None:
+            return self.planned_result(pools,*cached,request_plan,report_age)
 
         # gather all pair addresses based on user input
         factory_address = self.joe_v2_factory.address
-        all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_assets,quote_assets,
-                                                                    bin_steps,factory_address)
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,
+                                                                        bin_steps,factory_address)
         if type(all_pair_addresses)==dict: # error occured
             return all_pair_addresses
 
         # gather the price info from the individual pairs
-        reserves_func_call = self.lb_pair_v2.encodeABI(fn_name="getReservesAndId",args=[])
-        
-        multicall_input = []
-        for pair_address in all_pair_addresses:
-            multicall_input.append([pair_address,reserves_func_call])
-
-        multicall_output = self.attempt_multicall_request(multicall_input)
-
-        # decoding pair info from multicall
-        all_pair_active_ids = [] # activeId specifies the current bin, which determines the current price
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['uint256','uint256','uint256'],multicall_output[1][i])
-            decoded_active_id = decoding[2]
-            all_pair_active_ids.append(decoded_active_id)
+        with trace_stage('gather_pair_state'):
+            all_pair_active_ids,all_prefetched_bins = self.gather_v2_and_v2_1_pair_state(
+                'v2',base_tokens,quote_tokens,bin_steps,all_pair_addresses)
+            block_number = self.call_state.block_number
 
         # gathering the prices requested by user
-        all_prices = self.return_v2_and_v2_1_prices(base_assets,quote_assets,bin_steps,all_pair_active_ids)
+        with trace_stage('calculate_prices'):
+            all_prices = self.return_v2_and_v2_1_prices(base_tokens,quote_tokens,bin_steps,all_pair_active_ids)
 
         # check if pool bins have enough liquidity, convert price to -1 if they don't
-        all_prices = self.check_v2_and_v2_1_liquidity(base_assets,quote_assets,all_prices,
-                                                      all_pair_active_ids,all_pair_addresses)
+        with trace_stage('check_liquidity'):
+            all_prices = self.check_v2_and_v2_1_liquidity(base_tokens,quote_tokens,all_prices,
+                                                          all_pair_active_ids,all_pair_addresses,
+                                                          all_prefetched_bins=all_prefetched_bins)
 
-        return {'status':'SUCCESS','output':all_prices}
+        self.price_cache.update('v2',base_tokens,quote_tokens,bin_steps,all_prices,block_number)
+        return self.planned_result(pools,all_prices,time.time(),block_number,request_plan,report_age)
 
 
-    def handle_v2_1_requests(self,base_assets,quote_assets,bin_steps):
+    def handle_v2_1_requests(self,base_assets,quote_assets,bin_steps,max_age=None,max_blocks_behind=None):
         """ Handles n-number of requests for getting prices of v2_1 pools
             -returns an error if any of the pools requested don't exist
 
@@ -264,123 +559,276 @@ class tx_handler:
             base_assets (list): addresses of the base assets
             quote_assets (list): addresses of the quote assets
             bin_steps (list): sizes of the bins for the pairs
+            max_age (float): if set, cached prices up to this many seconds old are accepted
+            max_blocks_behind (int): if set, cached prices up to this many blocks behind are accepted
 
         Returns:
             List of amount of quote currency is required to get one unit of base currency
             -returns -1 for the price if pool doesn't have enough liquidity in local bins
+            -if a staleness bound is given, also returns the age & block number of the (oldest) price
         """
-        validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps) # check params
-        if validity != "":
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_staleness(max_age,max_blocks_behind) # check params
+            if validity == "":
+                validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps)
+        if type(validity)==str:
             return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        # reduce the batch to its unique pools, each is fetched once in its canonical direction
+        requested_bin_steps = bin_steps # the caller's, used as is for background revalidation
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,bin_steps,request_plan = self.plan_unique_pools(base_tokens,quote_tokens,bin_steps)
+
+        # hot pools are served from the watchlist snapshot, others from the price cache if the client allows
+        report_age = max_age is not None or max_blocks_behind is not None
+        pools = ('v2_1',base_tokens,quote_tokens,bin_steps)
+        with trace_stage('lookup_cached_prices'):
+            cached = self.lookup_cached_prices('v2_1',base_tokens,quote_tokens,bin_steps,max_age,max_blocks_behind,
+                                               self.handle_v2_1_requests,base_assets,quote_assets,requested_bin_steps)
+        if cached is not None:
+            return self.planned_result(pools,*cached,request_plan,report_age)
 
         # gather all pair addresses based on user input
         factory_address = self.joe_v2_1_factory.address
-        all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_assets,quote_assets,
-                                                                    bin_steps,factory_address)
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,
+                                                                        bin_steps,factory_address)
         if type(all_pair_addresses)==dict: # error occured
             return all_pair_addresses
 
         # gather the price info from the individual pairs
-        active_id_func_call = self.lb_pair_v2_1.encodeABI(fn_name="getActiveId",args=[])
-        
+        with trace_stage('gather_pair_state'):
+            all_pair_active_ids,all_prefetched_bins = self.gather_v2_and_v2_1_pair_state(
+                'v2_1',base_tokens,quote_tokens,bin_steps,all_pair_addresses)
+            block_number = self.call_state.block_number
+
+        # gathering the prices requested by user
+        with trace_stage('calculate_prices'):
+            all_prices = self.return_v2_and_v2_1_prices(base_tokens,quote_tokens,bin_steps,all_pair_active_ids)
+
+        # check if pool bins have enough liquidity, convert price to -1 if they don't
+        with trace_stage('check_liquidity'):
+            all_prices = self.check_v2_and_v2_1_liquidity(base_tokens,quote_tokens,all_prices,
+                                                          all_pair_active_ids,all_pair_addresses,
+                                                          all_prefetched_bins=all_prefetched_bins)
+
+        self.price_cache.update('v2_1',base_tokens,quote_tokens,bin_steps,all_prices,block_number)
+        return self.planned_result(pools,all_prices,time.time(),block_number,request_plan,report_age)
+
+
+    def stream_requests(self,handle_requests,chunk_size,*request_lists):
+        """ Splits a batch into chunks & yields the result of each chunk as soon as it has been handled
+            -handle_requests is one of handle_v1_requests,handle_v2_requests,handle_v2_1_requests
+            -each result carries the 'offset' of its chunk within the batch
+            -stops after the first chunk which errors, as the non-streaming call would have errored too
+        """
+        for offset in range(0,len(request_lists[0]),chunk_size):
+            chunk = [request_list[offset:offset+chunk_size] for request_list in request_lists]
+            try:
+                result = handle_requests(*chunk)
+            except Exception as e: # will catch e.g. RPC errors
+                result = {'status':'ERROR','output':str(e)}
+
+            result['offset'] = offset
+            yield result
+            if result['status'] == 'ERROR':
+                return
+
+
+    def encode_get_bin_call(self,bin_id):
+        """ Encodes getBin(bin_id), without going through the contract's abi encoder
+        """
+        return self.get_bin_selector+format(bin_id,'064x')
+
+
+    def gather_bin_reserves(self,all_pair_addresses,all_pair_bin_ids):
+        """ Gathers the reserves of the given bins of each pair, for all of the pairs in a single multicall
+            -returns a list (per pair) of (reserve_x,reserve_y) tuples, in the same order as the bin ids
+        """
         multicall_input = []
-        for pair_address in all_pair_addresses:
-            multicall_input.append([pair_address,active_id_func_call])
+        for pair_address,bin_ids in zip(all_pair_addresses,all_pair_bin_ids):
+            for bin_id in bin_ids:
+                multicall_input.append([pair_address,self.encode_get_bin_call(bin_id)])
 
-        multicall_output = self.attempt_multicall_request(multicall_input)
+        with trace_stage('gather_bin_reserves'):
+            multicall_output = self.attempt_multicall_request(multicall_input)
 
-        # decoding pair info from multicall
-        all_pair_active_ids = [] # activeId specifies the current bin, which determines the current price
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['uint24'],multicall_output[1][i])
-            decoded_active_id = decoding[0]
-            all_pair_active_ids.append(decoded_active_id)
+        with trace_stage('decode_bin_reserves'):
+            all_reserves_x,all_reserves_y = self.decoder.decode(multicall_output[1],((0,'uint'),(1,'uint')))
 
-        # gathering the prices requested by user
-        all_prices = self.return_v2_and_v2_1_prices(base_assets,quote_assets,bin_steps,all_pair_active_ids)
+        all_pair_bin_reserves = []
+        j = 0
+        for bin_ids in all_pair_bin_ids:
+            all_pair_bin_reserves.append(list(zip(all_reserves_x[j:j+len(bin_ids)],all_reserves_y[j:j+len(bin_ids)])))
+            j += len(bin_ids)
+
+        return all_pair_bin_reserves
 
-        # check if pool bins have enough liquidity, convert price to -1 if they don't
-        all_prices = self.check_v2_and_v2_1_liquidity(base_assets,quote_assets,all_prices,
-                                                      all_pair_active_ids,all_pair_addresses)
 
-        return {'status':'SUCCESS','output':all_prices}
+    def handle_v2_quote_requests(self,base_asset,quote_asset,bin_step,amounts_in=(),amounts_out=(),bin_window=50):
+        """ Quotes swaps of base_asset for quote_asset in a v2 pool, see handle_lb_quote_requests
+        """
+        return self.handle_lb_quote_requests(False,base_asset,quote_asset,bin_step,amounts_in,amounts_out,bin_window)
 
 
-    def check_v2_and_v2_1_liquidity(
-            self,base_assets,quote_assets,all_prices,all_pair_active_ids,
-            all_pair_addresses,min_liquidity_per_bin_usd=10):
-        """ Determines whether there is enough liquidity in v2 & v2_1 pairs
-            -skips over pairs which are not paired with (USDC,USDT,ETH)
-            -results in price of -1 being returned if pool does not have enough liquidity
-            -this is based on checking the USD value of the 5 bins above and below the current active bin
+    def handle_v2_1_quote_requests(self,base_asset,quote_asset,bin_step,amounts_in=(),amounts_out=(),bin_window=50):
+        """ Quotes swaps of base_asset for quote_asset in a v2_1 pool, see handle_lb_quote_requests
         """
-        core_prices = self.gather_core_usd_prices()
-        surrounding_bins = [-5,-4,-3,-2,-1,1,2,3,4,5] # offset of bins which will be checked
+        return self.handle_lb_quote_requests(True,base_asset,quote_asset,bin_step,amounts_in,amounts_out,bin_window)
 
-        for i in range(len(base_assets)):
-            # first checks whether this pair should be skipped
-            if base_assets[i] not in core_prices and quote_assets[i] not in core_prices:
-                ##print('could not price pool')
-                continue
 
-            # for each token, first gather the reserves in the +/- 5 bins around the current active bin
-            pool_surrounding_bins = [all_pair_active_ids[i]+offset for offset in surrounding_bins]
+    def handle_lb_quote_requests(self,is_v2_1,base_asset,quote_asset,bin_step,amounts_in,amounts_out,bin_window):
+        """ Quotes any number of trade sizes for selling base_asset for quote_asset, from a single snapshot of bins
+            -the bins from the active bin up to bin_window bins away (in the direction of the swap) are fetched
+             in one multicall, then every swap is simulated locally (see utils.quote_engine)
 
-            multicall_input = []
-            for local_bin in pool_surrounding_bins:
-                bin_reserves_func_call = self.lb_pair_v2.encodeABI(fn_name="getBin",args=[local_bin]) # same for v2/v2_1
-                multicall_input.append([all_pair_addresses[i],bin_reserves_func_call])
+        Args:
+            base_asset (str): address of the asset being sold
+            quote_asset (str): address of the asset being bought
+            bin_step (int): size of the bins for the pair
+            amounts_in (list): exact amounts of base_asset to sell, in raw token units
+            amounts_out (list): exact amounts of quote_asset to buy, in raw token units
+            bin_window (int): no. bins past the active bin to simulate across
 
+        Returns:
+            The spot price (quote per base, raw units), the base fee & a quote per amount
+            -amounts are floats in raw token units: the bins are walked in float arithmetic, so they're estimates
+             accurate to ~15 significant digits, not the exact integer amounts the router would return
+            -complete is False if the fetched bins didn't have enough liquidity to fill the amount,
+             the amounts returned are then those that could be filled
+        """
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_quote_inputs(amounts_in,amounts_out,bin_window) # check params
+            if validity == "":
+                validity = self.check_valid_v2_inputs([base_asset],[quote_asset],[bin_step])
+        if type(validity)==str:
+            return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        # gather the pair address based on user input
+        factory_address = (self.joe_v2_1_factory if is_v2_1 else self.joe_v2_factory).address
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,
+                                                                        [bin_step],factory_address)
+        if type(all_pair_addresses)==dict: # error occured
+            return all_pair_addresses
+        pair_address = all_pair_addresses[0]
+
+        # gather the active id & fee parameters of the pair
+        if is_v2_1:
+            multicall_input = [[pair_address,self.active_id_call],[pair_address,self.v2_1_static_fee_parameters_call]]
+        else:
+            multicall_input = [[pair_address,self.reserves_and_id_call],[pair_address,self.v2_fee_parameters_call]]
+
+        with trace_stage('gather_pair_state'):
             multicall_output = self.attempt_multicall_request(multicall_input)
 
-            all_bin_reserves = []
-            for j in range(len(multicall_output[1])):
-                decoding = abi.decode(['uint256','uint256'],multicall_output[1][j])
-                all_bin_reserves.append(decoding) # reserveX,reserveY; recall that reserveX is for the 'smaller' of the two tokens
+        if is_v2_1:
+            active_id = abi.decode(['uint24'],multicall_output[1][0])[0]
+            base_factor = abi.decode(['uint16']*4+['uint24','uint16','uint24'],multicall_output[1][1])[0]
+        else:
+            active_id = abi.decode(['uint256','uint256','uint256'],multicall_output[1][0])[2]
+            base_factor = abi.decode(['uint16']*5+['uint24','uint16']+['uint24']*4+['uint40'],multicall_output[1][1])[1]
+        fee = get_base_fee(base_factor,bin_step)
+
+        # gather the bins the swaps can move through, X for Y moves down through the bins, Y for X moves up
+        swap_for_y = base_tokens[0].value < quote_tokens[0].value
+        direction = -1 if swap_for_y else 1
+        bin_ids = [active_id+direction*offset for offset in range(bin_window+1)]
+        bin_reserves = self.gather_bin_reserves([pair_address],[bin_ids])[0]
+
+        with trace_stage('simulate_swaps'):
+            bins = [(bin_id,reserve_x,reserve_y,self.calculate_lb_pool_price(bin_id,bin_step))
+                    for bin_id,(reserve_x,reserve_y) in zip(bin_ids,bin_reserves)]
+            spot_price = bins[0][3] if swap_for_y else bins[0][3] ** -1 # tokens out per token in
+
+            exact_in_quotes = []
+            for amount_in in amounts_in:
+                amount_in,amount_out,bins_crossed,complete = quote_exact_in(bins,amount_in,swap_for_y,fee)
+                exact_in_quotes.append({'amount_in':float(amount_in),'amount_out':float(amount_out),
+                                        'price_impact':get_price_impact(spot_price,amount_in,amount_out),
+                                        'bins_crossed':bins_crossed,'complete':complete})
+
+            exact_out_quotes = []
+            for amount_out in amounts_out:
+                amount_in,amount_out,bins_crossed,complete = quote_exact_out(bins,amount_out,swap_for_y,fee)
+                exact_out_quotes.append({'amount_in':float(amount_in),'amount_out':float(amount_out),
+                                         'price_impact':get_price_impact(spot_price,amount_in,amount_out),
+                                         'bins_crossed':bins_crossed,'complete':complete})
+
+        return {'status':'SUCCESS','output':{'spot_price':spot_price,'fee':fee,'active_id':active_id,
+                                             'exact_in':exact_in_quotes,'exact_out':exact_out_quotes}}
+
+
+    def check_valid_quote_inputs(self,amounts_in,amounts_out,bin_window,max_bin_window=1000):
+        """ Checks the amounts & window of a quote request
+            -return error string if there is an error, else empty string
+        """
+        for amounts in [amounts_in,amounts_out]:
+            for amount in amounts:
+                if type(amount)!=int or amount<0:
+                    return "Amounts need to be non-negative integers."
+
+        if type(bin_window)!=int or bin_window<0 or bin_window>max_bin_window:
+            return "bin_window needs to be between 0 and {}.".format(max_bin_window)
+
+        return ""
 
-            bins_have_enough_liq = self.convert_bin_reserves_to_price(base_assets[i],quote_assets[i],all_prices[i],
-                                                                      all_bin_reserves,core_prices,
+
+    def check_v2_and_v2_1_liquidity(
+            self,base_tokens,quote_tokens,all_prices,all_pair_active_ids,
+            all_pair_addresses,min_liquidity_per_bin_usd=10,bin_window=5,all_prefetched_bins=None):
+        """ Determines whether there is enough liquidity in v2 & v2_1 pairs
+            -skips over pairs where neither token can be valued in USD (see gather_usd_rates)
+            -results in price of -1 being returned if pool does not have enough liquidity
+            -this is based on checking the USD value of the bin_window bins above and below the current active bin
+            -bins already prefetched (see gather_v2_and_v2_1_pair_state) are used as is, the bins of every
+             other pair are gathered in a single multicall
+        """
+        with trace_stage('gather_core_usd_prices'):
+            usd_rates = self.gather_usd_rates()
+        surrounding_bins = [offset for offset in range(-bin_window,bin_window+1) if offset != 0] # offset of bins which will be checked
+
+        # first checks which pairs can be priced in USD, the rest are skipped
+        checked_pairs = [i for i in range(len(base_tokens))
+                         if base_tokens[i].value in usd_rates or quote_tokens[i].value in usd_rates]
+
+        # for each pair, the reserves in the +/- bin_window bins around the current active bin
+        all_bin_ids = {i:[all_pair_active_ids[i]+offset for offset in surrounding_bins] for i in checked_pairs}
+        all_bin_reserves = {}
+        for i in checked_pairs:
+            prefetched_bins = all_prefetched_bins[i] if all_prefetched_bins is not None else None
+            if prefetched_bins is not None and all(bin_id in prefetched_bins for bin_id in all_bin_ids[i]):
+                all_bin_reserves[i] = [prefetched_bins[bin_id] for bin_id in all_bin_ids[i]]
+
+        missed_pairs = [i for i in checked_pairs if i not in all_bin_reserves] # active id moved, or wasn't known
+        if len(missed_pairs) > 0:
+            gathered = self.gather_bin_reserves([all_pair_addresses[i] for i in missed_pairs],
+                                                [all_bin_ids[i] for i in missed_pairs])
+            all_bin_reserves.update(zip(missed_pairs,gathered))
+
+        for i in checked_pairs:
+            pair_bin_reserves = all_bin_reserves[i]
+            bins_have_enough_liq = self.convert_bin_reserves_to_price(base_tokens[i],quote_tokens[i],all_prices[i],
+                                                                      pair_bin_reserves,usd_rates,
                                                                       min_liquidity_per_bin_usd)
             if bins_have_enough_liq == False:
                 all_prices[i]=-1
 
+        self.update_valuation_graph(base_tokens,quote_tokens,all_prices,all_pair_addresses,checked_pairs)
         return all_prices
 
 
     def convert_bin_reserves_to_price(
-        self,base_asset,quote_asset,price,all_bin_reserves,
-        core_prices,min_liquidity_per_bin_usd):
+        self,base_token,quote_token,price,all_bin_reserves,
+        usd_rates,min_liquidity_per_bin_usd):
         """ Determines the USD price for each of the bins based on their reserves
             -returns True/False for whether all of the local bins have >= min_liquidity_per_bin_usd
         """
-        for reserves in all_bin_reserves:
-            reserve_x,reserve_y = reserves
-            #assert(reserve_x==0 or reserve_y==0) # invariant
-
-            if base_asset.lower() < quote_asset.lower(): # base token is reserve_x, quote token is reserve_y
-                base_amount = reserve_x
-                quote_amount = reserve_y
-            else:
-                base_amount = reserve_y
-                quote_amount = reserve_x
-
-            # remember that the default price is stored in (quote/base)
-
-            if base_asset in core_prices: # we have USD value for the base_asset
-                # calculate the value of reserve_x
-                bin_value_usd = base_amount/core_prices[base_asset]['token_precision']*core_prices[base_asset]['price']
-                # calculate the value of reserve_y
-                # -price is currently quote/base, so need to swap to base/quote
-                # -final eq: quote_amount * (base/quote) / (base precision) * (base price)
-                bin_value_usd += quote_amount*(price ** -1)/core_prices[base_asset]['token_precision']*core_prices[base_asset]['price']
-
-            else: # we have USD value of quote asset
-                bin_value_usd = quote_amount/core_prices[quote_asset]['token_precision']*core_prices[quote_asset]['price']
-                # calcualte the value of reserve_x
-                # -price is currently quote/base, which is what we need
-                # -final eq: base_amount * (quote/base) / (quote precision) * (quote price)
-                bin_value_usd += base_amount*(price)/core_prices[quote_asset]['token_precision']*core_prices[quote_asset]['price']
-
+        for bin_value_usd in self.value_bins_usd(base_token,quote_token,price,all_bin_reserves,usd_rates):
             ##print("-bin value:",bin_value_usd)
             if bin_value_usd < min_liquidity_per_bin_usd: # at least on bin didn't have enough liquidity
                 return False
@@ -388,105 +836,873 @@ class tx_handler:
         return True
 
 
-    def handle_v1_requests(self,base_assets,quote_assets):
+    def value_bins_usd(self,base_token,quote_token,price,all_bin_reserves,usd_rates):
+        """ Returns the USD value of each bin, based on its reserves
+            -one of the tokens must have a USD rate, the other is valued through the pool price (quote/base)
+            -the USD value of a raw unit of each token is computed once, then applied to every bin
+        """
+        if base_token.value in usd_rates: # we have USD value for the base_asset
+            usd_per_base = usd_rates[base_token.value]
+            usd_per_quote = usd_per_base*(price ** -1) # price is quote/base, so need to swap to base/quote
+        else: # we have USD value of quote asset
+            usd_per_quote = usd_rates[quote_token.value]
+            usd_per_base = usd_per_quote*price # price is quote/base, which is what we need
+
+        if base_token.value < quote_token.value: # base token is reserve_x, quote token is reserve_y
+            usd_per_x,usd_per_y = usd_per_base,usd_per_quote
+        else:
+            usd_per_x,usd_per_y = usd_per_quote,usd_per_base
+
+        return [reserve_x*usd_per_x+reserve_y*usd_per_y for reserve_x,reserve_y in all_bin_reserves]
+
+
+    def handle_v2_depth_requests(self,base_assets,quote_assets,bin_steps,bin_window=5,min_liquidity_per_bin_usd=10):
+        """ Handles n-number of requests for the liquidity depth of v2 pools, see handle_v2_and_v2_1_depth_requests
+        """
+        return self.handle_v2_and_v2_1_depth_requests(False,base_assets,quote_assets,bin_steps,
+                                                      bin_window,min_liquidity_per_bin_usd)
+
+
+    def handle_v2_1_depth_requests(self,base_assets,quote_assets,bin_steps,bin_window=5,min_liquidity_per_bin_usd=10):
+        """ Handles n-number of requests for the liquidity depth of v2_1 pools, see handle_v2_and_v2_1_depth_requests
+        """
+        return self.handle_v2_and_v2_1_depth_requests(True,base_assets,quote_assets,bin_steps,
+                                                      bin_window,min_liquidity_per_bin_usd)
+
+
+    def handle_v2_and_v2_1_depth_requests(
+            self,is_v2_1,base_assets,quote_assets,bin_steps,bin_window,min_liquidity_per_bin_usd):
+        """ Handles n-number of requests for the USD liquidity depth around the active bin of v2 & v2_1 pools
+            -the bins of every pool are gathered in a single multicall & valued in a single pass
+
+        Args:
+            base_assets (list): addresses of the base assets
+            quote_assets (list): addresses of the quote assets
+            bin_steps (list): sizes of the bins for the pairs
+            bin_window (int): no. bins either side of the active bin to return
+            min_liquidity_per_bin_usd (float): USD value every bin in the window needs for the price to be returned
+
+        Returns:
+            Per pair, the price & the USD value of the active bin, of each bin on either side & cumulatively
+            -bids are the bins priced below the current price (holding the quote asset), asks above it (holding
+             the base asset), both ordered outwards from the active bin
+            -price is -1 if any bin in the window is below min_liquidity_per_bin_usd
+            -USD values are None for pairs where neither token can be valued in USD
+        """
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_depth_inputs(bin_window,min_liquidity_per_bin_usd) # check params
+            if validity == "":
+                validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps)
+        if type(validity)==str:
+            return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        # reduce the batch to its unique pools, each is fetched once in its canonical direction (base is tokenX)
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,bin_steps,request_plan = self.plan_unique_pools(base_tokens,quote_tokens,bin_steps)
+
+        factory_address = (self.joe_v2_1_factory if is_v2_1 else self.joe_v2_factory).address
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,
+                                                                        bin_steps,factory_address)
+        if type(all_pair_addresses)==dict: # error occured
+            return all_pair_addresses
+
+        with trace_stage('gather_pair_state'):
+            all_pair_active_ids = self.gather_v2_and_v2_1_active_ids(all_pair_addresses,is_v2_1)
+
+        # gather the active bin & the bins either side of it for every pool at once
+        window = range(-bin_window,bin_window+1)
+        all_bin_reserves = self.gather_bin_reserves(all_pair_addresses,
+                                                    [[active_id+offset for offset in window]
+                                                     for active_id in all_pair_active_ids])
+
+        with trace_stage('gather_core_usd_prices'):
+            usd_rates = self.gather_usd_rates()
+
+        with trace_stage('value_bins'):
+            all_prices = self.return_v2_and_v2_1_prices(base_tokens,quote_tokens,bin_steps,all_pair_active_ids)
+
+            all_depths = []
+            for i in range(len(base_tokens)):
+                if base_tokens[i].value not in usd_rates and quote_tokens[i].value not in usd_rates: # unable to value this pool
+                    all_depths.append({'price':all_prices[i],'active_bin_usd':None,'bids_usd':None,'asks_usd':None,
+                                       'cumulative_bids_usd':None,'cumulative_asks_usd':None})
+                    continue
+
+                # canonical direction, so bins below the active bin hold the quote asset (tokenY) & are bids
+                bins_usd = self.value_bins_usd(base_tokens[i],quote_tokens[i],all_prices[i],
+                                               all_bin_reserves[i],usd_rates)
+                bids_usd = bins_usd[:bin_window][::-1]
+                asks_usd = bins_usd[bin_window+1:]
+
+                price = all_prices[i]
+                if any(bin_usd < min_liquidity_per_bin_usd for bin_usd in bids_usd+asks_usd):
+                    price = -1
+
+                all_depths.append({'price':price,'active_bin_usd':bins_usd[bin_window],
+                                   'bids_usd':bids_usd,'asks_usd':asks_usd,
+                                   'cumulative_bids_usd':list(accumulate(bids_usd)),
+                                   'cumulative_asks_usd':list(accumulate(asks_usd))})
+
+        # expand back out to every requested pair, inverted pairs swap sides
+        output = []
+        for index,inverted in request_plan:
+            depth = all_depths[index]
+            if inverted:
+                depth = {'price':depth['price'] ** -1 if depth['price'] != -1 else -1,
+                         'active_bin_usd':depth['active_bin_usd'],
+                         'bids_usd':depth['asks_usd'],'asks_usd':depth['bids_usd'],
+                         'cumulative_bids_usd':depth['cumulative_asks_usd'],
+                         'cumulative_asks_usd':depth['cumulative_bids_usd']}
+            output.append(depth)
+
+        return {'status':'SUCCESS','output':output}
+
+
+    def check_valid_depth_inputs(self,bin_window,min_liquidity_usd,max_bin_window=100):
+        """ Checks the window & threshold of a depth request
+            -return error string if there is an error, else empty string
+        """
+        if type(bin_window)!=int or bin_window<1 or bin_window>max_bin_window:
+            return "bin_window needs to be between 1 and {}.".format(max_bin_window)
+
+        return self.check_valid_min_liquidity(min_liquidity_usd)
+
+
+    def check_valid_min_liquidity(self,min_liquidity_usd):
+        """ Checks the liquidity threshold of a depth request
+            -return error string if there is an error, else empty string
+        """
+        if type(min_liquidity_usd) not in (int,float) or min_liquidity_usd<0:
+            return "Minimum liquidity needs to be a non-negative number."
+
+        return ""
+
+
+    def handle_v1_requests(self,base_assets,quote_assets,max_age=None,max_blocks_behind=None):
         """ Handles n-number of requests for getting prices of v1 pools
             -returns an error if any of the pools requested don't exist
 
         Args:
             base_assets (list): addresses of the base assets
             quote_assets (list): addresses of the quote assets
+            max_age (float): if set, cached prices up to this many seconds old are accepted
+            max_blocks_behind (int): if set, cached prices up to this many blocks behind are accepted
 
         Returns:
             List of amount of quote currency is required to get one unit of base currency
             -returns -1 for the price if pool doesn't have enough liquidity
+            -if a staleness bound is given, also returns the age & block number of the (oldest) price
         """
-        validity = self.check_valid_v1_inputs(base_assets,quote_assets) # check params
-        if validity != "":
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_staleness(max_age,max_blocks_behind) # check params
+            if validity == "":
+                validity = self.check_valid_v1_inputs(base_assets,quote_assets)
+        if type(validity)==str:
             return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        # reduce the batch to its unique pools, each is fetched once in its canonical direction
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,_,request_plan = self.plan_unique_pools(base_tokens,quote_tokens)
+
+        # hot pools are served from the watchlist snapshot, others from the price cache if the client allows
+        report_age = max_age is not None or max_blocks_behind is not None
+        pools = ('v1',base_tokens,quote_tokens,None)
+        with trace_stage('lookup_cached_prices'):
+            cached = self.lookup_cached_prices('v1',base_tokens,quote_tokens,None,max_age,max_blocks_behind,
+                                               self.handle_v1_requests,base_assets,quote_assets)
+        if cached is not None:
+            return self.planned_result(pools,*cached,request_plan,report_age)
 
         # gather all pair addresses based on user input
-        all_pair_addresses = self.gather_v1_pair_addresses(base_assets,quote_assets)
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v1_pair_addresses(base_tokens,quote_tokens)
         if type(all_pair_addresses)==dict: # error occured
             return all_pair_addresses
 
         # gather the reserves info from the individual pairs
-        get_reserves_func_call = self.joe_pair.encodeABI(fn_name="getReserves",args=[])
-        
+        with trace_stage('gather_pair_state'):
+            all_pair_reserves = self.gather_v1_reserves(all_pair_addresses)
+            block_number = self.call_state.block_number
+        self.remember_v1_reserves([pool_key('v1',base_tokens[i],quote_tokens[i],None) for i in range(len(base_tokens))],
+                                  all_pair_reserves)
+
+        # gathering the prices requested by user
+        with trace_stage('calculate_prices'):
+            all_prices = self.return_v1_prices(base_tokens,quote_tokens,all_pair_reserves)
+
+        # check if pools have enough liquidity, convert price to -1 if they don't
+        with trace_stage('check_liquidity'):
+            all_prices = self.check_v1_liquidity(base_tokens,quote_tokens,all_pair_reserves,all_prices,
+                                                 all_pair_addresses)
+
+        self.price_cache.update('v1',base_tokens,quote_tokens,None,all_prices,block_number)
+        return self.planned_result(pools,all_prices,time.time(),block_number,request_plan,report_age)
+
+
+    def handle_v2_1_twap_requests(self,base_assets,quote_assets,bin_steps,windows):
+        """ Handles n-number of requests for time-weighted average prices of v2_1 pools, over several windows
+            -uses the oracle samples built into the pairs, which accumulate the active id over time
+            -the average active id over a window is (cumulativeId now - cumulativeId then)/window, the TWAP
+             is the price of that (fractional) id, i.e. the time-weighted geometric mean price
+            -the samples of every pair & window are gathered in a single multicall
+
+        Args:
+            base_assets (list): addresses of the base assets
+            quote_assets (list): addresses of the quote assets
+            bin_steps (list): sizes of the bins for the pairs
+            windows (list): lengths of the windows to average over, in seconds
+
+        Returns:
+            Per pair, the TWAP (quote per base) for each window, in the same order as the windows
+            -the TWAP is None when the pair's oracle doesn't reach back over the whole window
+        """
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_twap_inputs(windows) # check params
+            if validity == "":
+                validity = self.check_valid_v2_inputs(base_assets,quote_assets,bin_steps)
+        if type(validity)==str:
+            return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,bin_steps,request_plan = self.plan_unique_pools(base_tokens,quote_tokens,bin_steps)
+
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,
+                                                                        bin_steps,self.joe_v2_1_factory.address)
+        if type(all_pair_addresses)==dict: # error occured
+            return all_pair_addresses
+
+        # gather how far back each pair's oracle reaches, along with the current block timestamp
+        multicall_input = [[pair_address,self.oracle_parameters_call] for pair_address in all_pair_addresses]
+        multicall_input.append([self.multicall.address,self.block_timestamp_call])
+
+        with trace_stage('gather_oracle_parameters'):
+            multicall_output = self.attempt_multicall_request(multicall_input)
+
+        now = abi.decode(['uint256'],multicall_output[1][-1])[0]
+        all_first_timestamps = [] # timestamp of the oldest sample, None if the oracle has no samples
+        for i in range(len(all_pair_addresses)):
+            _,size,active_size,_,first_timestamp = abi.decode(['uint8','uint16','uint16','uint40','uint40'],
+                                                              multicall_output[1][i])
+            all_first_timestamps.append(first_timestamp if active_size > 0 else None)
+
+        # gather the samples at now & at the start of every window which the oracle reaches back to,
+        # looking up a timestamp older than the oldest sample would revert the whole multicall
+        lookups = [] # (pair index,window index or None for now)
         multicall_input = []
-        for pair_address in all_pair_addresses:
-            multicall_input.append([pair_address,get_reserves_func_call])
+        for i,pair_address in enumerate(all_pair_addresses):
+            if all_first_timestamps[i] is None:
+                continue
+            lookups.append((i,None))
+            multicall_input.append([pair_address,self.encode_oracle_sample_call(now)])
+            for j,window in enumerate(windows):
+                if now-window >= all_first_timestamps[i]:
+                    lookups.append((i,j))
+                    multicall_input.append([pair_address,self.encode_oracle_sample_call(now-window)])
+
+        all_twaps = [[None]*len(windows) for _ in all_pair_addresses]
+        if len(multicall_input) > 0:
+            with trace_stage('gather_oracle_samples'):
+                multicall_output = self.attempt_multicall_request(multicall_input)
+
+            cumulative_id_now = None
+            for (i,j),output in zip(lookups,multicall_output[1]):
+                cumulative_id = abi.decode(['uint64','uint64','uint64'],output)[0]
+                if j is None: # lookups for a pair start with now
+                    cumulative_id_now = cumulative_id
+                    continue
+
+                average_id = (cumulative_id_now-cumulative_id)/windows[j]
+                all_twaps[i][j] = self.calculate_lb_pool_price(average_id,bin_steps[i]) # canonical, base is tokenX
+
+        # expand back out to every requested pair, inverting where needed
+        output = []
+        for index,inverted in request_plan:
+            twaps = all_twaps[index]
+            if inverted:
+                twaps = [twap ** -1 if twap is not None else None for twap in twaps]
+            output.append(twaps)
+
+        return {'status':'SUCCESS','output':output}
+
+
+    def encode_oracle_sample_call(self,lookup_timestamp):
+        """ Encodes getOracleSampleAt(lookup_timestamp), without going through the contract's abi encoder
+        """
+        return self.oracle_sample_selector+format(lookup_timestamp,'064x')
 
-        multicall_output = self.attempt_multicall_request(multicall_input)
 
-        # decoding pair info from multicall
-        all_pair_reserves = [] # reserves of (tokenX,tokenY)
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['uint112','uint112','uint32'],multicall_output[1][i])
-            decoded_token_x_reserves,decoded_token_y_reserves,_ = decoding
-            all_pair_reserves.append((decoded_token_x_reserves,decoded_token_y_reserves))
+    def check_valid_twap_inputs(self,windows,max_windows=32):
+        """ Checks the windows of a TWAP request
+            -return error string if there is an error, else empty string
+        """
+        if len(windows) == 0 or len(windows) > max_windows:
+            return "Between 1 and {} windows need to be requested.".format(max_windows)
 
-        # gathering the prices requested by user
-        all_prices = self.return_v1_prices(base_assets,quote_assets,all_pair_reserves)
+        for window in windows:
+            if type(window)!=int or window<=0:
+                return "Windows need to be positive integers (seconds)."
 
-        # check if pools have enough liquidity, convert price to -1 if they don't
-        all_prices = self.check_v1_liquidity(base_assets,quote_assets,all_pair_reserves,all_prices)
+        return ""
 
-        return {'status':'SUCCESS','output':all_prices}
 
+    def gather_v1_reserves(self,all_pair_addresses):
+        """ Gathers the reserves of (tokenX,tokenY) for each v1 pair
+        """
+        multicall_input = []
+        for pair_address in all_pair_addresses:
+            multicall_input.append([pair_address,self.get_reserves_call])
+
+        multicall_output = self.attempt_multicall_request(multicall_input)
 
-    def check_v1_liquidity(self,base_assets,quote_assets,all_pair_reserves,all_prices,min_liquidity_usd=100):
+        # decoding pair info from multicall, (reserve0,reserve1,blockTimestampLast)
+        with trace_stage('decode_reserves'):
+            all_reserves_x,all_reserves_y = self.decoder.decode(multicall_output[1],((0,'uint'),(1,'uint')))
+        return list(zip(all_reserves_x,all_reserves_y)) # reserves of (tokenX,tokenY)
+
+
+    def check_v1_liquidity(
+            self,base_tokens,quote_tokens,all_pair_reserves,all_prices,all_pair_addresses,min_liquidity_usd=100):
         """ Determines whether there is enough liquidity in v1 pairs 
-            -skips over pairs which are not paired with (USDC,USDT,ETH)
+            -skips over pairs where neither token can be valued in USD (see gather_usd_rates)
             -results in price of -1 being returned if pool does not have enough liquidity
-            -v1 pools don't require the price between assets, b/c the USD value of both tokens are equal
         """
-        core_prices = self.gather_core_usd_prices()
+        with trace_stage('gather_core_usd_prices'):
+            usd_rates = self.gather_usd_rates()
+
+        all_pair_values_usd = self.value_v1_pools_usd(base_tokens,quote_tokens,all_pair_reserves,usd_rates)
+        checked_pairs = []
+        for i in range(len(base_tokens)):
+            if all_pair_values_usd[i] is None: # unable to price this pool
+                ##print('could not price pool')
+                continue
+
+            checked_pairs.append(i)
+            if all_pair_values_usd[i] < min_liquidity_usd: # not enough liquidity
+                all_prices[i]=-1
+
+        self.update_valuation_graph(base_tokens,quote_tokens,all_prices,all_pair_addresses,checked_pairs)
+        return all_prices
 
-        for i in range(len(base_assets)):
-            if base_assets[i].lower() < quote_assets[i].lower(): # base asset is tokenX, quote asset is tokenY
+
+    def value_v1_pools_usd(self,base_tokens,quote_tokens,all_pair_reserves,usd_rates):
+        """ Returns the total USD value of each v1 pool, None for pools where neither token has a USD rate
+            -v1 pools don't require the price between assets, b/c the USD value of both tokens are equal
+        """
+        all_pair_values_usd = []
+        for i in range(len(base_tokens)):
+            if base_tokens[i].value < quote_tokens[i].value: # base asset is tokenX, quote asset is tokenY
                 base_amount = all_pair_reserves[i][0]
                 quote_amount = all_pair_reserves[i][1]
             else:
                 base_amount = all_pair_reserves[i][1]
                 quote_amount = all_pair_reserves[i][0]
 
-            if base_assets[i] in core_prices: # we have USD price for base asset
-                total_liquidity = (base_amount/core_prices[base_assets[i]]['token_precision'])*2
+            if base_tokens[i].value in usd_rates: # we have USD price for base asset
+                all_pair_values_usd.append(base_amount*2*usd_rates[base_tokens[i].value])
 
-                total_price = total_liquidity*core_prices[base_assets[i]]['price']
-                if total_price < min_liquidity_usd: # not enough liquidity
-                    all_prices[i]=-1
+            elif quote_tokens[i].value in usd_rates: # we have USD price for quote asset
+                all_pair_values_usd.append(quote_amount*2*usd_rates[quote_tokens[i].value])
 
-            elif quote_assets[i] in core_prices: # we have USD price for quote asset
-                total_liquidity = (quote_amount/core_prices[quote_assets[i]]['token_precision'])*2
+            else: # unable to price this pool
+                all_pair_values_usd.append(None)
 
-                total_price = total_liquidity*core_prices[quote_assets[i]]['price']
-                if total_price < min_liquidity_usd: # not enough liquidity
-                    all_prices[i]=-1
+        return all_pair_values_usd
 
-            else: # unable to price this pool
-                ##print('could not price pool')
+
+    def handle_v1_depth_requests(self,base_assets,quote_assets,min_liquidity_usd=100):
+        """ Handles n-number of requests for the USD liquidity of v1 pools
+
+        Args:
+            base_assets (list): addresses of the base assets
+            quote_assets (list): addresses of the quote assets
+            min_liquidity_usd (float): USD value the pool needs for the price to be returned
+
+        Returns:
+            Per pair, the price & the total USD value of the pool
+            -price is -1 if the pool is below min_liquidity_usd
+            -USD value is None for pairs where neither token can be valued in USD
+        """
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_min_liquidity(min_liquidity_usd) # check params
+            if validity == "":
+                validity = self.check_valid_v1_inputs(base_assets,quote_assets)
+        if type(validity)==str:
+            return {'status':'ERROR','output':validity}
+        base_tokens,quote_tokens = validity
+
+        with trace_stage('plan_unique_pools'):
+            base_tokens,quote_tokens,_,request_plan = self.plan_unique_pools(base_tokens,quote_tokens)
+
+        with trace_stage('gather_pair_addresses'):
+            all_pair_addresses = self.gather_v1_pair_addresses(base_tokens,quote_tokens)
+        if type(all_pair_addresses)==dict: # error occured
+            return all_pair_addresses
+
+        with trace_stage('gather_pair_state'):
+            all_pair_reserves = self.gather_v1_reserves(all_pair_addresses)
+
+        with trace_stage('gather_core_usd_prices'):
+            usd_rates = self.gather_usd_rates()
+
+        all_prices = self.return_v1_prices(base_tokens,quote_tokens,all_pair_reserves)
+        all_pair_values_usd = self.value_v1_pools_usd(base_tokens,quote_tokens,all_pair_reserves,usd_rates)
+
+        output = []
+        for index,inverted in request_plan:
+            price,value_usd = all_prices[index],all_pair_values_usd[index]
+            if value_usd is not None and value_usd < min_liquidity_usd:
+                price = -1
+            elif inverted:
+                price = price ** -1
+            output.append({'price':price,'total_usd':value_usd})
+
+        return {'status':'SUCCESS','output':output}
+
+
+    def gather_usd_rates(self):
+        """ Returns token address value -> USD value of one raw unit of the token
+            -covers the core tokens, plus every token with a route of liquid pools to a core token
+            -routes are precomputed by the valuation graph, so this is a lookup unless the core prices changed
+        """
+        return self.valuation_graph.get_usd_rates(self.gather_core_usd_prices())
+
+
+    def update_valuation_graph(self,base_tokens,quote_tokens,all_prices,all_pair_addresses,checked_pairs):
+        """ Adds the pools which passed a liquidity check to the valuation graph, & removes those which failed
+        """
+        for i in checked_pairs:
+            if all_prices[i] == -1:
+                self.valuation_graph.remove_pool(base_tokens[i].value,quote_tokens[i].value,all_pair_addresses[i])
+            else:
+                self.valuation_graph.add_pool(base_tokens[i].value,quote_tokens[i].value,
+                                              all_prices[i],all_pair_addresses[i])
+
+
+    def lookup_cached_prices(
+            self,version,base_tokens,quote_tokens,bin_steps,max_age,max_blocks_behind,handle_requests,*request_lists):
+        """ Returns (prices,time fetched,block number) of the (canonical) pools from memory, or None
+            -pools which are all watched are served from the watchlist snapshot, if it meets the client's
+             staleness bounds, without bounds only if it's from the latest block seen
+            -otherwise, if the client gave a staleness bound, from the price cache, in which case the
+             request is also refreshed in the background (stale-while-revalidate)
+            -every request is counted towards learning which pools to watch
+        """
+        self.watchlist.record_requests(version,base_tokens,quote_tokens,bin_steps)
+        unbounded = max_age is None and max_blocks_behind is None
+        cached = self.watchlist.lookup(version,base_tokens,quote_tokens,bin_steps,max_age,
+                                       0 if unbounded else max_blocks_behind,self.price_cache.latest_block)
+        record_cache('watchlist',cached is not None)
+        if cached is not None or unbounded:
+            return cached
+
+        cached = self.price_cache.lookup(version,base_tokens,quote_tokens,bin_steps,max_age,max_blocks_behind)
+        record_cache('price_cache',cached is not None)
+        if cached is not None:
+            bin_steps_key = tuple(bin_steps) if bin_steps is not None else None
+            self.revalidate((version,tuple(base_tokens),tuple(quote_tokens),bin_steps_key),
+                            handle_requests,*request_lists)
+        return cached
+
+
+    def revalidate(self,key,handle_requests,*request_lists):
+        """ Refreshes a request in the background, requests already being refreshed aren't repeated
+            -the refreshed prices land in the price cache, which is what later requests are served from
+        """
+        with self.revalidate_lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        def refresh():
+            try:
+                handle_requests(*request_lists)
+            except Exception: # e.g. RPC errors, the next stale request will try again
+                pass
+            finally:
+                with self.revalidate_lock:
+                    self.revalidating.discard(key)
+
+        self.revalidate_executor.submit(refresh)
+
+
+    def planned_result(self,pools,unique_prices,fetched_at,block_number,request_plan,report_age):
+        """ Builds the response of a price request from the prices of its unique pools
+            -pools is (version,base_tokens,quote_tokens,bin_steps) of the unique pools
+            -report_age adds how old the prices are, for requests which accepted cached prices
+            -records the block the prices last changed at, which the ETag of the response is derived from
+        """
+        record_version(self.price_cache.last_changed_block(*pools))
+        result = {'status':'SUCCESS','output':self.fill_planned_prices(unique_prices,request_plan)}
+        if report_age:
+            result['age'] = round(max(time.time()-fetched_at,0),3)
+            result['block_number'] = block_number
+        return result
+
+
+    def handle_v1_price_changes(self,base_assets,quote_assets,since_block,max_age=None,max_blocks_behind=None):
+        """ Handles a 'changes since block' request for a watched set of v1 pools, see handle_price_changes
+        """
+        return self.handle_price_changes('v1',self.handle_v1_requests,since_block,max_age,max_blocks_behind,
+                                         base_assets,quote_assets)
+
+
+    def handle_v2_price_changes(self,base_assets,quote_assets,bin_steps,since_block,max_age=None,max_blocks_behind=None):
+        """ Handles a 'changes since block' request for a watched set of v2 pools, see handle_price_changes
+        """
+        return self.handle_price_changes('v2',self.handle_v2_requests,since_block,max_age,max_blocks_behind,
+                                         base_assets,quote_assets,bin_steps)
+
+
+    def handle_v2_1_price_changes(self,base_assets,quote_assets,bin_steps,since_block,max_age=None,max_blocks_behind=None):
+        """ Handles a 'changes since block' request for a watched set of v2_1 pools, see handle_price_changes
+        """
+        return self.handle_price_changes('v2_1',self.handle_v2_1_requests,since_block,max_age,max_blocks_behind,
+                                         base_assets,quote_assets,bin_steps)
+
+
+    def handle_price_changes(self,version,handle_requests,since_block,max_age,max_blocks_behind,*request_lists):
+        """ Returns only the pairs of a watched set whose price (or liquidity status, -1) changed after since_block
+            -the prices are gathered as for a batch request, so are fresh unless max_age/max_blocks_behind
+             accept cached prices, which also records any new changes in the change index
+            -the changed pools come from the change index, so the response grows with activity, not with the watched set
+            -head_block is the (oldest) block the prices are current as of, which the next poll sends as since_block
+            -if the index doesn't cover every block after since_block (e.g. a first poll with since_block 0,
+             or a client too far behind) every pair is returned & full is set
+
+        Returns:
+            {'head_block','full','indexes' (positions of the changed pairs in the watched set),'prices'}
+        """
+        if type(since_block)!=int or since_block<0:
+            return {'status':'ERROR','output':"since_block needs to be a non-negative integer."}
+
+        if max_age is None and max_blocks_behind is None:
+            max_age = 0 # fresh prices, but reported with the block they're from
+        result = handle_requests(*request_lists,max_age,max_blocks_behind)
+        if result['status'] != 'SUCCESS':
+            return result
+        head_block = result['block_number']
+
+        changed = self.change_index.changed_between(since_block,head_block) if since_block < head_block else set()
+        base_tokens,quote_tokens = self.check_valid_inputs(request_lists[0],request_lists[1]) # interned, so cheap
+        bin_steps = request_lists[2] if len(request_lists) > 2 else None
+
+        indexes,prices = [],[]
+        for i in range(len(base_tokens)):
+            if changed is not None:
+                if len(changed) == 0:
+                    break
+                token_x,token_y = sorted((base_tokens[i],quote_tokens[i]),key=lambda token:token.value)
+                if pool_key(version,token_x,token_y,bin_steps[i] if bin_steps is not None else None) not in changed:
+                    continue
+            indexes.append(i)
+            prices.append(result['output'][i])
+
+        return {'status':'SUCCESS','output':{'head_block':head_block,'full':changed is None,
+                                              'indexes':indexes,'prices':prices}}
+
+
+    def check_valid_staleness(self,max_age,max_blocks_behind):
+        """ Checks the staleness bounds of a price request
+            -return error string if there is an error, else empty string
+        """
+        if max_age is not None and (type(max_age) not in (int,float) or max_age<0):
+            return "max_age needs to be a non-negative number (seconds)."
+
+        if max_blocks_behind is not None and (type(max_blocks_behind)!=int or max_blocks_behind<0):
+            return "max_blocks_behind needs to be a non-negative integer."
+
+        return ""
+
+
+    def refresh_watchlist(self,bin_window=5,min_liquidity_per_bin_usd=10,min_liquidity_usd=100):
+        """ Refreshes the prices & liquidity status of every watched pool, called once per block by the refresher
+            -the core token prices, the state of every pool & the bins around each pool's last known
+             active id are gathered in one combined multicall
+            -only pools whose active id moved since the last refresh need a second call, for their new bins
+            -returns the block number of the refresh, None if nothing is watched
+        """
+        self.connect()
+        self.watchlist.update_learned()
+        pools = self.watchlist.watched_pools()
+        self.resolve_watched_pair_addresses([pool for pool in pools if pool.pair_address is None])
+        pools = [pool for pool in pools if pool.pair_address is not None]
+        if len(pools) == 0:
+            return None
+
+        surrounding_bins = [offset for offset in range(-bin_window,bin_window+1) if offset != 0]
+        state_calls = {'v1':self.get_reserves_call,'v2':self.reserves_and_id_call,'v2_1':self.active_id_call}
+
+        multicall_input = []
+        for token in self.chainlink_info:
+            multicall_input.append([self.chainlink_info[token]['chainlink_address'],self.latest_answer_call])
+        for pool in pools:
+            multicall_input.append([pool.pair_address,state_calls[pool.version]])
+        prefetched = [pool for pool in pools if pool.active_id is not None] # only v2 & v2_1 pools have ids
+        for pool in prefetched:
+            for offset in surrounding_bins:
+                multicall_input.append([pool.pair_address,self.encode_get_bin_call(pool.active_id+offset)])
+
+        multicall_output = self.attempt_multicall_request(multicall_input)
+        block_number,outputs = multicall_output[0],multicall_output[1]
+
+        # core prices are shared with the normal request path
+        self.core_prices_cache = (time.time(),self.decode_core_usd_prices(outputs[:len(self.chainlink_info)]))
+        usd_rates = self.gather_usd_rates()
+
+        j = len(self.chainlink_info)
+        states = {} # key -> v1 reserves or v2/v2_1 active id
+        for pool in pools:
+            if pool.version == 'v1':
+                states[pool.key] = abi.decode(['uint112','uint112','uint32'],outputs[j])[:2]
+            elif pool.version == 'v2':
+                states[pool.key] = abi.decode(['uint256','uint256','uint256'],outputs[j])[2]
+            else:
+                states[pool.key] = abi.decode(['uint24'],outputs[j])[0]
+            j += 1
+
+        bin_reserves = {} # key -> reserves of the surrounding bins, for pools whose active id didn't move
+        for pool in prefetched:
+            if states[pool.key] == pool.active_id:
+                bin_reserves[pool.key] = [abi.decode(['uint256','uint256'],output)
+                                          for output in outputs[j:j+len(surrounding_bins)]]
+            j += len(surrounding_bins)
+
+        moved = [pool for pool in pools if pool.version != 'v1' and pool.key not in bin_reserves]
+        if len(moved) > 0:
+            all_bin_reserves = self.gather_bin_reserves([pool.pair_address for pool in moved],
+                                                        [[states[pool.key]+offset for offset in surrounding_bins]
+                                                         for pool in moved])
+            for pool,pair_bin_reserves in zip(moved,all_bin_reserves):
+                bin_reserves[pool.key] = pair_bin_reserves
+
+        lb_pools = [pool for pool in pools if pool.version != 'v1'] # also prefetched by the normal request path
+        self.remember_active_ids([pool.key for pool in lb_pools],[states[pool.key] for pool in lb_pools])
+        v1_pools = [pool for pool in pools if pool.version == 'v1']
+        self.remember_v1_reserves([pool.key for pool in v1_pools],[states[pool.key] for pool in v1_pools])
+
+        # canonical prices, with the same liquidity checks as the normal request path
+        prices = {}
+        for pool in pools:
+            valued = pool.base_token.value in usd_rates or pool.quote_token.value in usd_rates
+            if pool.version == 'v1':
+                price = self.return_v1_prices([pool.base_token],[pool.quote_token],[states[pool.key]])[0]
+                value_usd = self.value_v1_pools_usd([pool.base_token],[pool.quote_token],[states[pool.key]],usd_rates)[0]
+                if value_usd is not None and value_usd < min_liquidity_usd:
+                    price = -1
+            else:
+                pool.active_id = states[pool.key]
+                price = self.calculate_lb_pool_price(pool.active_id,pool.bin_step)
+                if valued and not self.convert_bin_reserves_to_price(pool.base_token,pool.quote_token,price,
+                                                                     bin_reserves[pool.key],usd_rates,
+                                                                     min_liquidity_per_bin_usd):
+                    price = -1
+            prices[pool.key] = price
+
+            if valued:
+                self.update_valuation_graph([pool.base_token],[pool.quote_token],[price],[pool.pair_address],[0])
+
+        self.watchlist.update_snapshot(prices,block_number)
+        for pool in pools:
+            self.price_cache.update(pool.version,[pool.base_token],[pool.quote_token],[pool.bin_step],
+                                    [prices[pool.key]],block_number)
+        self.evaluate_alerts(prices,block_number)
+        return block_number
+
+
+    def handle_alert_registration(self,version,base_asset,quote_asset,bin_step=None,lower=None,upper=None,
+                                  stream_token=None,callback_url=None):
+        """ Registers a price-threshold alert on a pool, see utils.alert_index
+            -the pool is watched while it has alerts, so its price is recomputed by the refresher every block
+            -returns an error if the pool doesn't exist
+
+        Args:
+            version (str): 'v1','v2' or 'v2_1'
+            base_asset (str): address of the base asset
+            quote_asset (str): address of the quote asset
+            bin_step (int): size of the bins for the pair, v2 & v2_1 only
+            lower (float): the alert fires when the price (quote per base) drops below this, None if unbounded
+            upper (float): the alert fires when the price rises above this, None if unbounded
+            stream_token (str): token of the stream the alert is pushed to, a new stream if neither this
+                                nor callback_url is set
+            callback_url (str): or the url the alert is posted to
+
+        Returns:
+            The id of the alert, which fires once & is then removed
+            -stream alerts also return the token of their stream, needed to read it & to add alerts to it
+        """
+        self.connect()
+        with trace_stage('validate_inputs'):
+            validity = self.check_valid_alert_inputs(version,bin_step,lower,upper,stream_token,callback_url)
+            if validity == "":
+                validity = self.check_valid_inputs([base_asset],[quote_asset])
+        if type(validity)==str:
+            return {'status':'ERROR','output':validity}
+        base_token,quote_token = validity[0][0],validity[1][0]
+
+        bin_step = None if version == 'v1' else bin_step
+        token_x,token_y = sorted([base_token,quote_token],key=lambda t:t.value)
+        with trace_stage('gather_pair_addresses'):
+            pair_addresses = self.gather_watched_pair_addresses(version,[watched_pool(None,version,token_x,token_y,bin_step)])
+        if type(pair_addresses)==dict: # pool doesn't exist
+            return pair_addresses
+
+        if callback_url is None:
+            stream_token = self.alert_delivery.open_stream(stream_token)
+            if stream_token is None:
+                return {'status':'ERROR','output':"No alert stream with this stream_token."}
+
+        key = pool_key(version,token_x,token_y,bin_step)
+        with self.alert_watch_lock:
+            alert = self.alerts.add(key,base_token,quote_token,lower,upper,stream_token,callback_url)
+            if alert is None:
+                if stream_token is not None:
+                    self.alert_delivery.close_stream(stream_token)
+                return {'status':'ERROR','output':"Too many alerts registered."}
+            self.watchlist.watch_for_alerts(version,token_x,token_y,bin_step)
+
+        if stream_token is None:
+            return {'status':'SUCCESS','output':{'alert_id':alert.alert_id}}
+        return {'status':'SUCCESS','output':{'alert_id':alert.alert_id,'stream_token':stream_token}}
+
+
+    def handle_alert_removal(self,alert_id):
+        """ Removes an alert which hasn't fired yet
+        """
+        alert = self.alerts.remove(alert_id)
+        if alert is None:
+            return {'status':'ERROR','output':"No alert with id {}.".format(alert_id)}
+        if alert.stream_token is not None:
+            self.alert_delivery.close_stream(alert.stream_token)
+        self.unwatch_if_no_alerts(alert.key)
+        return {'status':'SUCCESS','output':{'alert_id':alert_id}}
+
+
+    def check_valid_alert_inputs(self,version,bin_step,lower,upper,stream_token,callback_url):
+        """ Checks the parameters of an alert registration
+            -return error string if there is an error, else empty string
+        """
+        if version not in ('v1','v2','v2_1'):
+            return "version needs to be one of v1, v2 or v2_1."
+
+        if version != 'v1' and (type(bin_step)!=int or bin_step<=0):
+            return "bin_step needs to be a positive integer for v2 and v2_1 pools."
+
+        if lower is None and upper is None:
+            return "At least one of lower and upper needs to be set."
+        for bound in [lower,upper]:
+            if bound is not None and (type(bound) not in (int,float) or bound<=0):
+                return "lower and upper need to be positive numbers."
+        if lower is not None and upper is not None and lower >= upper:
+            return "lower needs to be less than upper."
+
+        if stream_token is not None and callback_url is not None:
+            return "Alerts are pushed to either a stream or a callback_url, not both."
+        if callback_url is not None:
+            return self.alert_delivery.check_callback_url(callback_url)
+
+        return ""
+
+
+    def evaluate_alerts(self,prices,block_number):
+        """ Evaluates the alerts of every pool with a fresh price, pushing the triggered ones
+            -prices are canonical, keyed by pool key
+        """
+        for key in self.alerts.pools():
+            price = prices.get(key)
+            if price is None: # not refreshed, e.g. pool only just registered
+                continue
+            for alert in self.alerts.evaluate(key,price):
+                self.alert_delivery.publish(alert,{'alert_id':alert.alert_id,'version':key[0],
+                                                   'base_asset':alert.base_asset.address,
+                                                   'quote_asset':alert.quote_asset.address,'bin_step':key[3],
+                                                   'price':1/price if alert.inverted else price,
+                                                   'lower':alert.lower,'upper':alert.upper,
+                                                   'block_number':block_number})
+            self.unwatch_if_no_alerts(key)
+
+
+    def unwatch_if_no_alerts(self,key):
+        """ Stops watching a pool for alerts once its last alert has fired or been removed
+        """
+        with self.alert_watch_lock:
+            if not self.alerts.has_alerts(key):
+                self.watchlist.unwatch_for_alerts(key)
+
+
+    def resolve_watched_pair_addresses(self,pools):
+        """ Gathers the pair addresses of newly watched pools, pools which don't exist stop being watched
+            -addresses are gathered per version in one multicall, falling back to one pool at a time on error
+        """
+        for version in ('v1','v2','v2_1'):
+            version_pools = [pool for pool in pools if pool.version == version]
+            if len(version_pools) == 0:
                 continue
 
-        return all_prices
+            all_pair_addresses = self.gather_watched_pair_addresses(version,version_pools)
+            if type(all_pair_addresses)==dict: # at least one pool doesn't exist
+                all_pair_addresses = []
+                for pool in version_pools:
+                    pair_addresses = self.gather_watched_pair_addresses(version,[pool])
+                    all_pair_addresses.append(pair_addresses[0] if type(pair_addresses)==list else None)
+
+            for pool,pair_address in zip(version_pools,all_pair_addresses):
+                if pair_address is None:
+                    self.watchlist.remove(pool.key)
+                pool.pair_address = pair_address
+
+
+    def gather_watched_pair_addresses(self,version,pools):
+        """ Gathers the pair addresses of watched pools of a single version
+        """
+        base_tokens = [pool.base_token for pool in pools]
+        quote_tokens = [pool.quote_token for pool in pools]
+        if version == 'v1':
+            return self.gather_v1_pair_addresses(base_tokens,quote_tokens)
+
+        factory_address = (self.joe_v2_1_factory if version == 'v2_1' else self.joe_v2_factory).address
+        return self.gather_v2_and_v2_1_pair_addresses(base_tokens,quote_tokens,[pool.bin_step for pool in pools],
+                                                      factory_address)
 
 
     def gather_core_usd_prices(self,precision=1e8):
         """ Gathers the USD prices for main price comparison tokens (USDC,USDT,ETH)
             -done by querying the USD prices from chainlink (which have 1e8 precision)
+            -results are cached for core_prices_ttl seconds
         """
-        get_latest_answer_call = self.chainlink_feed.encodeABI(fn_name="latestAnswer",args=[])
+        self.connect()
+        cached = self.core_prices_cache
+        if cached is not None and time.time()-cached[0] < self.core_prices_ttl:
+            record_cache('core_usd_prices',True)
+            return cached[1]
+        record_cache('core_usd_prices',False)
 
         multicall_input = []
         for token in self.chainlink_info:
-            multicall_input.append([self.chainlink_info[token]['chainlink_address'],get_latest_answer_call])
+            multicall_input.append([self.chainlink_info[token]['chainlink_address'],self.latest_answer_call])
 
         multicall_output = self.attempt_multicall_request(multicall_input)
 
+        prices = self.decode_core_usd_prices(multicall_output[1],precision)
+        self.core_prices_cache = (time.time(),prices)
+        return prices
+
+
+    def decode_core_usd_prices(self,outputs,precision=1e8):
+        """ Decodes the chainlink answers of the core tokens, in the order of chainlink_info
+        """
         # decoding prices
         all_token_prices = []
-        for i in range(len(multicall_output[1])):
-            decoding = abi.decode(['int256'],multicall_output[1][i])
+        for i in range(len(outputs)):
+            decoding = abi.decode(['int256'],outputs[i])
             price = decoding[0]/precision # remove precision, convert to float
             all_token_prices.append(price)
 
@@ -0,0 +1,188 @@
+""" Opt-in per-request tracing
+    -a trace is bound to the current request through a contextvar, so tx_handler can record
+     its costs without the trace being passed through every call
+    -records stage timings, RPC round trips, multicall sub-calls, cache hits/misses & block number
+    -traced requests slower than a threshold can have their stacks sampled & dumped in the
+     folded format used by flamegraph.pl / speedscope
+"""
+
+import os
+import sys
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+current_trace = contextvars.ContextVar('current_trace',default=None)
+
+
+class request_trace:
+    """ Cost breakdown of a single request
+    """
+    def __init__(self):
+        """ Init
+        """
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident() # thread currently doing the work, used by the sampler
+        self.stages = {} # stage name -> total ms, stages entered more than once are summed
+        self.rpc_round_trips = 0
+        self.multicall_sub_calls = 0
+        self.cache = {} # cache name -> {'hit':n,'miss':n}
+        self.block_number = None
+        self.stack_counts = None # folded stack -> no. samples, only set when the sampler is active
+
+
+    def elapsed_ms(self):
+        """ Time since the trace was started
+        """
+        return (time.perf_counter()-self.start)*1000
+
+
+    def summary(self):
+        """ Returns the trace as a json serializable dict
+        """
+        return {'total_ms':round(self.elapsed_ms(),3),
+                'stages_ms':{stage:round(ms,3) for stage,ms in self.stages.items()},
+                'rpc_round_trips':self.rpc_round_trips,
+                'multicall_sub_calls':self.multicall_sub_calls,
+                'cache':self.cache,
+                'block_number':self.block_number}
+
+
+class stack_sampler:
+    """ Background thread which periodically samples the stack of every thread doing traced work
+        -a single daemon thread is shared by all traces, started on first use
+    """
+    def __init__(self,interval_ms):
+        """ Init
+        """
+        self.interval = interval_ms/1000
+        self.traces = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    def register(self,trace):
+        """ Starts sampling the stacks of the given trace
+        """
+        trace.stack_counts = {}
+        with self.lock:
+            self.traces.add(trace)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,name='stack_sampler',daemon=True)
+                self.thread.start()
+
+
+    def unregister(self,trace):
+        """ Stops sampling the stacks of the given trace
+        """
+        with self.lock:
+            self.traces.discard(trace)
+
+
+    def run(self):
+        """ Sampling loop
+        """
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                traces = list(self.traces)
+            if len(traces) == 0:
+                continue
+
+            frames = sys._current_frames()
+            for trace in traces:
+                frame = frames.get(trace.thread_id)
+                if frame is None:
+                    continue
+                stack = fold_stack(frame)
+                trace.stack_counts[stack] = trace.stack_counts.get(stack,0)+1
+
+
+def fold_stack(frame):
+    """ Converts a frame into a single 'root;...;leaf' line
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name,os.path.basename(code.co_filename),frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+profile_dir = os.getenv('TRACE_PROFILE_DIR','') # stacks are only sampled when this is set
+profile_threshold_ms = float(os.getenv('TRACE_PROFILE_THRESHOLD_MS','500'))
+sampler = stack_sampler(float(os.getenv('TRACE_PROFILE_INTERVAL_MS','5')))
+
+
+def start_trace():
+    """ Starts tracing the current request, returns the trace & the token needed to stop it
+    """
+    trace = request_trace()
+    if profile_dir != "":
+        sampler.register(trace)
+    return trace,current_trace.set(trace)
+
+
+def finish_trace(trace,token):
+    """ Stops tracing the current request & returns its summary
+        -if the request was slower than the threshold then the sampled stacks are dumped to disk
+    """
+    current_trace.reset(token)
+    summary = trace.summary()
+    if trace.stack_counts is not None:
+        sampler.unregister(trace)
+        if summary['total_ms'] >= profile_threshold_ms and len(trace.stack_counts) > 0:
+            summary['profile'] = dump_stacks(trace)
+    return summary
+
+
+def dump_stacks(trace):
+    """ Writes the sampled stacks of a trace to disk in folded format, returns the file path
+    """
+    os.makedirs(profile_dir,exist_ok=True)
+    path = os.path.join(profile_dir,"trace-{}-{}.folded".format(int(time.time()*1000),id(trace)))
+    with open(path,'w') as f:
+        for stack,count in trace.stack_counts.items():
+            f.write("{} {}\n".format(stack,count))
+    return path
+
+
+@contextmanager
+def trace_stage(name):
+    """ Times the enclosed block as a stage of the current trace, no-op when not tracing
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    trace.thread_id = threading.get_ident()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.stages[name] = trace.stages.get(name,0)+(time.perf_counter()-start)*1000
+
+
+def record_rpc_call(sub_calls,block_number=None):
+    """ Records a single RPC round trip, along with the no. multicall sub-calls it contained
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+    trace.rpc_round_trips += 1
+    trace.multicall_sub_calls += sub_calls
+    if block_number is not None:
+        trace.block_number = block_number
+
+
+def record_cache(name,hit):
+    """ Records a cache hit/miss for the given cache
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+    counts = trace.cache.setdefault(name,{'hit':0,'miss':0})
+    counts['hit' if hit else 'miss'] += 1
@@ -0,0 +1,132 @@
+""" USD valuation of tokens which aren't core tokens, through routes of known pools
+    -every pool which passes a liquidity check becomes an edge between its two tokens, weighted by its
+     latest price, & pools which fail the check are removed again
+    -routes are found with a single breadth first search outwards from all the core tokens at once, so
+     every token gets its shortest route (fewest hops) to a core token in O(tokens+pools)
+    -the USD value of a raw unit of every reachable token is computed in the same pass & cached, it is
+     only rebuilt when the core prices change or the graph has changed & the ttl has expired, so requests
+     look tokens up rather than searching for a route
+    -tokens are keyed by the integer value of their address (see address_registry)
+"""
+
+import time
+import threading
+from collections import deque
+
+
+class valuation_graph:
+    """ Graph of tokens (nodes) & liquid pools (edges)
+    """
+    def __init__(self,core_values,max_hops=3,ttl=10,edge_max_age=3600):
+        """ Init
+        """
+        self.core_values = set(core_values)
+        self.max_hops = max_hops # tokens further than this from a core token are not valued
+        self.ttl = ttl # min seconds between rebuilds caused by edge changes
+        self.edge_max_age = edge_max_age # edges not seen for this long are dropped on rebuild
+        self.lock = threading.Lock()
+        self.edges = {} # token value -> {neighbour value: (raw neighbour per raw token,pool key,time seen)}
+        self.dirty = False # edges have changed since the last rebuild
+
+        self.core_prices = None # core prices the cached rates were built from
+        self.built_at = 0
+        self.routes = {} # token value -> (next token value towards a core token,hops), core tokens excluded
+        self.usd_rates = {} # token value -> USD value of one raw unit of the token
+
+
+    def add_pool(self,base_value,quote_value,price,pool_key):
+        """ Adds/updates the edge of a pool, price is the raw amount of quote per raw amount of base
+        """
+        if price <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.edges.setdefault(base_value,{})[quote_value] = (price,pool_key,now)
+            self.edges.setdefault(quote_value,{})[base_value] = (price ** -1,pool_key,now)
+            self.dirty = True
+
+
+    def remove_pool(self,base_value,quote_value,pool_key):
+        """ Removes the edge of a pool, if it is the pool currently linking the two tokens
+        """
+        with self.lock:
+            edge = self.edges.get(base_value,{}).get(quote_value)
+            if edge is None or edge[1] != pool_key:
+                return
+            del self.edges[base_value][quote_value]
+            del self.edges[quote_value][base_value]
+            self.dirty = True
+
+
+    def get_usd_rates(self,core_prices):
+        """ Returns token value -> USD value of one raw unit, for the core tokens & every routable token
+            -core_prices is the output of tx_handler.gather_core_usd_prices
+        """
+        with self.lock:
+            stale = self.dirty and time.time()-self.built_at >= self.ttl
+            if core_prices is not self.core_prices or stale:
+                self.rebuild(core_prices)
+            return self.usd_rates
+
+
+    def rebuild(self,core_prices):
+        """ Recomputes the routes & USD rates of every token reachable from the core tokens
+            -must hold the lock
+        """
+        now = time.time()
+        self.drop_expired_edges(now)
+
+        usd_rates = {}
+        queue = deque()
+        for address,info in core_prices.items():
+            value = int(address,16)
+            usd_rates[value] = info['price']/info['token_precision']
+            queue.append((value,0))
+
+        routes = {}
+        while len(queue) > 0:
+            value,hops = queue.popleft()
+            if hops == self.max_hops:
+                continue
+            for neighbour,(rate,_,_) in self.edges.get(value,{}).items():
+                if neighbour in usd_rates:
+                    continue
+                # rate is raw neighbour per raw token, so a raw neighbour is worth usd/rate
+                usd_rates[neighbour] = usd_rates[value]/rate
+                routes[neighbour] = (value,hops+1)
+                queue.append((neighbour,hops+1))
+
+        self.core_prices = core_prices
+        self.built_at = now
+        self.dirty = False
+        self.routes = routes
+        self.usd_rates = usd_rates # replaced rather than mutated, so readers never see a partial build
+
+
+    def drop_expired_edges(self,now):
+        """ Removes edges which haven't been seen within edge_max_age
+            -must hold the lock
+        """
+        for value in list(self.edges):
+            neighbours = self.edges[value]
+            for neighbour in [n for n,(_,_,seen) in neighbours.items() if now-seen > self.edge_max_age]:
+                del neighbours[neighbour]
+            if len(neighbours) == 0:
+                del self.edges[value]
+
+
+    def get_route(self,value):
+        """ Returns the route of token values from the given token to a core token, as of the last rebuild
+            -returns None if the token can't be routed
+        """
+        if value in self.core_values:
+            return [value]
+        route = [value]
+        while value in self.routes:
+            value = self.routes[value][0]
+            route.append(value)
+        return route if len(route) > 1 else None
+
+
+    def __len__(self):
+        return len(self.edges)
@@ -0,0 +1,207 @@
+""" Watchlist of hot pools, kept fresh in the background so their prices are served from memory
+    -pools are either configured (WATCHLIST env, always watched), watched while they have price alerts
+     (see utils.alert_index) or learned from request frequency
+    -learned pools are the most requested pools, request counts are halved
+     every learn_interval so the watchlist follows recent traffic
+    -at most max_tracked pools are counted, clients can send any number of distinct pools, so when full
+     the least requested 1/8 are dropped in one go (learned pools are kept)
+    -the refresher (tx_handler.refresh_watchlist) writes a snapshot of every watched pool's canonical
+     price, which is replaced in a single assignment so lookups never see a partial refresh
+    -pools are keyed by (version,tokenX value,tokenY value,bin step), bin step is None for v1 pools
+"""
+
+import time
+import heapq
+import threading
+
+
+class watched_pool:
+    """ A single watched pool, in its canonical direction (base is tokenX)
+    """
+    __slots__ = ('key','version','base_token','quote_token','bin_step','pair_address','active_id')
+
+    def __init__(self,key,version,base_token,quote_token,bin_step):
+        """ Init
+        """
+        self.key = key
+        self.version = version # 'v1','v2' or 'v2_1'
+        self.base_token = base_token # interned_address
+        self.quote_token = quote_token
+        self.bin_step = bin_step
+        self.pair_address = None # resolved by the first refresh which includes the pool
+        self.active_id = None # active id as of the last refresh, v2 & v2_1 only
+
+
+def pool_key(version,base_token,quote_token,bin_step):
+    """ Key of a pool, base_token & quote_token must be in canonical order
+    """
+    return (version,base_token.value,quote_token.value,bin_step)
+
+
+def parse_watchlist(config):
+    """ Parses the WATCHLIST env, comma separated 'version:token:token[:bin step]' entries
+        -returns a list of (version,token,token,bin step), raises ValueError if malformed
+    """
+    entries = []
+    for entry in config.split(','):
+        if entry.strip() == "":
+            continue
+        parts = entry.strip().split(':')
+        if parts[0] == 'v1' and len(parts) == 3:
+            entries.append((parts[0],parts[1],parts[2],None))
+        elif parts[0] in ('v2','v2_1') and len(parts) == 4:
+            entries.append((parts[0],parts[1],parts[2],int(parts[3])))
+        else:
+            raise ValueError("Watchlist entry '{}' needs to be version:token:token[:bin step].".format(entry))
+    return entries
+
+
+class watchlist:
+    """ Configured & learned hot pools, along with the snapshot of their latest prices
+    """
+    def __init__(self,max_learned=50,min_hits=3,max_age=5,learn_interval=60,max_tracked=10_000):
+        """ Init
+        """
+        self.max_learned = max_learned # max no. pools learned from traffic, on top of the configured pools
+        self.max_tracked = max_tracked # max no. pools whose requests are counted
+        self.min_hits = min_hits # decayed request count a pool needs to be learned
+        self.learn_interval = learn_interval # seconds between updates of the learned pools
+        self.learned_at = time.time()
+        self.max_age = max_age # snapshots older than this (seconds) aren't served, e.g. if the refresher stalls
+        self.lock = threading.Lock()
+        self.configured = {} # key -> watched_pool
+        self.alerted = {} # key -> watched_pool, pools with price alerts
+        self.learned = {} # key -> watched_pool
+        self.hits = {} # key -> [decayed request count,version,base token,quote token,bin step]
+        self.snapshot = ({},None,0) # (key -> canonical price (-1 if not enough liquidity),block number,time)
+
+
+    def add_configured(self,version,base_token,quote_token,bin_step):
+        """ Always watches the given pool, tokens must be in canonical order
+        """
+        key = pool_key(version,base_token,quote_token,bin_step)
+        with self.lock:
+            self.configured[key] = watched_pool(key,version,base_token,quote_token,bin_step)
+
+
+    def watch_for_alerts(self,version,base_token,quote_token,bin_step):
+        """ Watches a pool while it has price alerts, tokens must be in canonical order
+        """
+        key = pool_key(version,base_token,quote_token,bin_step)
+        with self.lock:
+            if key not in self.alerted:
+                self.alerted[key] = watched_pool(key,version,base_token,quote_token,bin_step)
+
+
+    def unwatch_for_alerts(self,key):
+        """ Stops watching a pool for its price alerts, it stays watched if it's configured or learned
+        """
+        with self.lock:
+            self.alerted.pop(key,None)
+
+
+    def record_requests(self,version,base_tokens,quote_tokens,bin_steps):
+        """ Counts requests per pool, including those served from the snapshot so learned pools stay watched
+            -tokens must be in canonical order
+        """
+        with self.lock:
+            for i in range(len(base_tokens)):
+                bin_step = bin_steps[i] if bin_steps is not None else None
+                key = pool_key(version,base_tokens[i],quote_tokens[i],bin_step)
+                if key in self.configured:
+                    continue
+                hit = self.hits.get(key)
+                if hit is None:
+                    if len(self.hits) >= self.max_tracked:
+                        self.evict_hits(max(self.max_tracked//8,1))
+                    self.hits[key] = [1,version,base_tokens[i],quote_tokens[i],bin_step]
+                else:
+                    hit[0] += 1
+
+
+    def evict_hits(self,count):
+        """ Stops counting the count least requested pools, learned pools keep their counts
+            -must hold the lock
+        """
+        candidates = (key for key in self.hits if key not in self.learned)
+        for key in heapq.nsmallest(count,candidates,key=lambda key:self.hits[key][0]):
+            del self.hits[key]
+
+
+    def update_learned(self):
+        """ Promotes the most requested pools into the watchlist & decays the request counts, every learn_interval
+            -learned pools which are no longer requested are dropped once they fall out of the top max_learned
+        """
+        with self.lock:
+            if time.time()-self.learned_at < self.learn_interval:
+                return
+            self.learned_at = time.time()
+
+            for key,pool in self.learned.items(): # learned pools compete on their hit counts too
+                self.hits.setdefault(key,[0,pool.version,pool.base_token,pool.quote_token,pool.bin_step])
+
+            ranked = sorted(self.hits.items(),key=lambda item:item[1][0],reverse=True)[:self.max_learned]
+            learned = {}
+            for key,(count,version,base_token,quote_token,bin_step) in ranked:
+                if count < self.min_hits and key not in self.learned:
+                    continue
+                if count == 0: # no longer requested
+                    continue
+                learned[key] = self.learned.get(key) or watched_pool(key,version,base_token,quote_token,bin_step)
+            self.learned = learned
+
+            for key in list(self.hits):
+                self.hits[key][0] //= 2
+                if self.hits[key][0] == 0 and key not in self.learned:
+                    del self.hits[key]
+
+
+    def watched_pools(self):
+        """ Returns every watched pool, configured first
+        """
+        with self.lock:
+            pools = list(self.configured.values())
+            pools += [pool for key,pool in self.alerted.items() if key not in self.configured]
+            pools += [pool for key,pool in self.learned.items() if key not in self.configured and key not in self.alerted]
+            return pools
+
+
+    def remove(self,key):
+        """ Stops watching a pool, e.g. because it doesn't exist
+        """
+        with self.lock:
+            self.configured.pop(key,None)
+            self.alerted.pop(key,None)
+            self.learned.pop(key,None)
+            self.hits.pop(key,None)
+
+
+    def update_snapshot(self,prices,block_number):
+        """ Replaces the snapshot with the prices of the latest refresh
+        """
+        self.snapshot = (prices,block_number,time.time())
+
+
+    def lookup(self,version,base_tokens,quote_tokens,bin_steps,max_age=None,max_blocks_behind=None,latest_block=None):
+        """ Returns (prices,time fetched,block number) if every pool is in a fresh snapshot, else None
+            -prices are canonical, tokens must be in canonical order
+            -the snapshot also needs to meet the client's staleness bounds, as for price_cache.lookup,
+             max_blocks_behind is measured against latest_block (the highest block seen from the RPC)
+        """
+        snapshot,block_number,fetched_at = self.snapshot
+        age = time.time()-fetched_at
+        if len(snapshot) == 0 or age > self.max_age:
+            return None
+        if max_age is not None and age > max_age:
+            return None
+        if max_blocks_behind is not None and latest_block is not None and latest_block-block_number > max_blocks_behind:
+            return None
+
+        prices = []
+        for i in range(len(base_tokens)):
+            bin_step = bin_steps[i] if bin_steps is not None else None
+            price = snapshot.get(pool_key(version,base_tokens[i],quote_tokens[i],bin_step))
+            if price is None:
+                return None
+            prices.append(price)
+        return prices,fetched_at,block_number